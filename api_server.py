@@ -5,20 +5,105 @@ import os
 import uuid
 import shutil
 import tempfile
-import subprocess  # 20250825_update: 用于调用 ffmpeg 与 node 构建脚本
 from typing import Optional
 from pydantic import BaseModel
+import re
 import json
-import base64
+import hashlib
+import threading
+import time
+import asyncio
+import importlib
 import requests  # 20250825_update: 外呼 Ollama/Dify 等 LLM 服务
+from talkingface.avatar_data import AVATAR_MANIFEST, publish_avatar_data
+from talkingface.web_runtime import build_runtime, create_avatar_site
+from talkingface.task_graph import TaskGraph
+from talkingface.stage_cache import set_file_digest
+from talkingface.upload_index import upload_key, find_avatar, register_avatar, clone_avatar_assets
+
+# 预处理/推理模块会引入 mediapipe、torch、OpenGL/glfw、sklearn，导入耗时数秒。
+# 这里只登记，首次使用或后台预热时才导入，保证 /health 立即可用。
+ENGINE_MODULES = {
+    "preparation": ["data_preparation_mini", "data_preparation_web"],
+    "inference": ["demo_mini"],
+}
+# 需要后台预热的子系统，为空则不预热、首次请求时再加载；/ready 只等待这里列出的子系统
+WARMUP_ENGINES = [i.strip() for i in os.getenv("DH_WARMUP_ENGINES", "preparation,inference").split(",") if i.strip() in ENGINE_MODULES]
+
+_engine_lock = threading.Lock()
+_engine_state = {name: {"status": "cold", "error": None, "load_seconds": None} for name in ENGINE_MODULES}
+
+
+def load_engine(name: str) -> None:
+    """导入指定子系统（线程安全，重复调用直接返回）。失败时抛出原异常，并记录到 /ready。"""
+    state = _engine_state[name]
+    if state["status"] == "ready":
+        return
+    with _engine_lock:
+        if state["status"] == "ready":
+            return
+        state["status"] = "loading"
+        start_time = time.time()
+        try:
+            for module_name in ENGINE_MODULES[name]:
+                module = importlib.import_module(module_name)
+                # 模块提供warmup时一并加载常驻模型(例如预处理的参考图编码器)
+                if hasattr(module, "warmup"):
+                    module.warmup()
+        except Exception as e:
+            state["status"] = "error"
+            state["error"] = str(e)
+            raise
+        state["status"] = "ready"
+        state["error"] = None
+        state["load_seconds"] = round(time.time() - start_time, 3)
+
+
+def data_preparation_mini(*args, **kwargs):
+    load_engine("preparation")
+    return importlib.import_module("data_preparation_mini").data_preparation_mini(*args, **kwargs)
+
+
+def validate_video(video_path: str) -> Optional[str]:
+    """上传视频预检查（抽样帧人脸检测、时长/分辨率），不合格时返回原因"""
+    load_engine("preparation")
+    module = importlib.import_module("data_preparation_mini")
+    try:
+        module.validate_video(video_path)
+    except module.EnvironmentError:
+        # ffmpeg未安装, 与预处理中相同按训练失败返回
+        raise
+    except module.VideoProcessingError as e:
+        return str(e)
+    return None
+
+
+def data_preparation_web(*args, **kwargs):
+    load_engine("preparation")
+    return importlib.import_module("data_preparation_web").data_preparation_web(*args, **kwargs)
+
+
+def interface_mini(*args, **kwargs):
+    load_engine("inference")
+    return importlib.import_module("demo_mini").interface_mini(*args, **kwargs)
+
 
-# 导入现有模块
-from data_preparation_mini import data_preparation_mini
-from data_preparation_web import data_preparation_web
-from demo_mini import interface_mini
+def _warmup_engines(names: list) -> None:
+    for name in names:
+        try:
+            load_engine(name)
+        except Exception as e:
+            print(f"预热 {name} 失败: {e}")
 
 app = FastAPI(title="数字人训练API", version="1.0.0")
 
+
+@app.on_event("startup")
+async def start_warmup():
+    """后台线程预热重量级子系统，不阻塞服务启动"""
+    if WARMUP_ENGINES:
+        threading.Thread(target=_warmup_engines, args=(WARMUP_ENGINES,), daemon=True).start()
+
 # 添加CORS中间件
 app.add_middleware(
     CORSMiddleware,
@@ -64,28 +149,6 @@ DIFY_API_URL = os.getenv("DIFY_API_URL", "https://api.dify.ai/v1")      # 202508
 DIFY_API_KEY = os.getenv("DIFY_API_KEY", "")                              # 20250825_update: 新增 Dify API Key
 
 
-def compress_webm(input_path: str, output_path: str, width: int = 480, crf: int = 40, bitrate: str = "500k") -> None:
-    # 20250825_update: 新增 - 生成移动端自动播放用的示例 webm
-    """使用ffmpeg压缩生成webm示例视频（用于移动端自动播放封面）。"""
-    cmd = [
-        "ffmpeg",
-        "-i", input_path,
-        "-vf", f"scale={width}:-2:flags=lanczos,split[s0][s1];[s0]reverse[r];[s1][r]concat",
-        "-c:v", "libvpx-vp9",
-        "-crf", str(crf),
-        "-b:v", bitrate,
-        "-row-mt", "1",
-        "-quality", "good",
-        "-cpu-used", "4",
-        "-an", "-loop", "0",
-        "-y", output_path
-    ]
-    try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        # 不中断主流程，仅记录
-        print(f"ffmpeg 生成示例视频失败: {e.stderr.decode(errors='ignore')}")
-
 @app.get("/")
 async def root():
     """API根路径"""
@@ -96,6 +159,13 @@ async def health_check():
     """健康检查"""
     return {"status": "healthy", "service": "digital-human-api"}
 
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：预热的子系统全部加载完成返回200，否则返回503；engines 中列出所有子系统的状态"""
+    ready = all(_engine_state[name]["status"] == "ready" for name in WARMUP_ENGINES)
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"ready": ready, "engines": _engine_state})
+
 @app.post("/train", response_model=TrainingResponse)
 async def train_digital_human(
     video: UploadFile = File(..., description="训练视频文件"),
@@ -119,97 +189,78 @@ async def train_digital_human(
         # 生成唯一ID
         digital_human_id = str(uuid.uuid4())
         
-        # 创建临时目录保存上传的视频
+        # 创建临时目录保存上传的视频, 分块写入并同时计算哈希, 用于复用相同视频的预处理结果
+        video_size = 0
+        sha256 = hashlib.sha256()
         with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video:
-            content = await video.read()
-            temp_video.write(content)
+            while True:
+                chunk = await video.read(1 << 20)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                video_size += len(chunk)
+                temp_video.write(chunk)
             temp_video_path = temp_video.name
+        set_file_digest(temp_video_path, sha256.hexdigest())
         
         try:
             # 执行数据预处理
             video_dir_path = f"video_data/{digital_human_id}"
             video_dir_path = os.path.join(os.path.dirname(__file__), video_dir_path)
             
-            # 调用现有的预处理函数
-            data_preparation_mini(temp_video_path, video_dir_path, False)
-            data_preparation_web(video_dir_path)
-            
             # 创建Web资源
             website_dir = f"website/{digital_human_id}"
             website_dir = os.path.join(os.path.dirname(__file__), website_dir)
-            
-            if os.path.exists(website_dir):
-                shutil.rmtree(website_dir)
-            
-            src_web_dir = os.path.join(os.path.dirname(__file__), "web_source")  # 20250825_update: 使用绝对路径更稳健
-            shutil.copytree(src_web_dir, website_dir)  # 20250825_update
-            
-            # 复制资源文件
             assets_dir = f"{website_dir}/assets"
-            if not os.path.exists(assets_dir):
-                os.makedirs(assets_dir)
-            
-            shutil.copy(f"{video_dir_path}/assets/01.mp4", f"{assets_dir}/01.mp4")
-            shutil.copy(f"{video_dir_path}/assets/data", f"{assets_dir}/data")
-
-            # 生成移动端预览示例视频，非关键步骤失败可忽略
-            try:
-                compress_webm(temp_video_path, f"{assets_dir}/example.webm", width=360, crf=45, bitrate="300k")  # 20250825_update
-            except Exception as _:
-                pass  # 20250825_update: 非关键失败忽略
-            
-            # 读取数据文件并转换为base64
-            with open(f"{video_dir_path}/assets/data", 'rb') as f:
-                file_data = f.read()
-            base64_data = base64.b64encode(file_data).decode('utf-8')
-            
-            # 更新JavaScript配置（先更新 js_source，再构建 jsCode15）
-            logic_path = f"{website_dir}/js_source/logic.js"  # 20250825_update: 训练后将数据二进制替换进 js
-            with open(logic_path, 'r', encoding='utf-8') as f:
-                js_content = f.read()
-            updated_js = js_content.replace("数据文件需要替换的地方", base64_data)
-            with open(logic_path, 'w', encoding='utf-8') as f:
-                f.write(updated_js)
-            
-            # 更新人物配置
-            human_logic_path = f"{website_dir}/js_source/humanLogic.js"
-            with open(human_logic_path, 'r', encoding='utf-8') as f:
-                human_logic_content = f.read()
-            
-            # 替换配置信息
             system_prompt = digital_config.system_prompt or generate_default_prompt(digital_config)
-            human_logic_content = human_logic_content.replace("大模型身份信息覆盖", system_prompt)
-            human_logic_content = human_logic_content.replace("声音id信息覆盖", get_voice_filename(digital_config.voice_type))
-            human_logic_content = human_logic_content.replace("是否开启视觉", str(digital_config.enable_vision).lower())
-            
-            with open(human_logic_path, 'w', encoding='utf-8') as f:
-                f.write(human_logic_content)
-            
-            # 构建混淆版脚本，确保 index.html 引用的 jsCode15 可用
-            test_js_path = os.path.join(website_dir, "test.js")  # 20250825_update: 构建混淆版 jsCode15
-            js_code15_dir = os.path.join(website_dir, "jsCode15")  # 20250825_update
-            js_source_dir = os.path.join(website_dir, "js_source")  # 20250825_update
-            if os.path.exists(test_js_path):
-                try:
-                    subprocess.run(["node", test_js_path], check=True)  # 20250825_update
-                except Exception as e:
-                    print(f"构建 jsCode15 失败: {e}")  # 20250825_update
+            avatar_config = {
+                "systemMessage": system_prompt,
+                "voiceType": get_voice_filename(digital_config.voice_type),
+                "isVLM": bool(digital_config.enable_vision),
+            }
+
+            # 相同视频已训练过时只写入新的配置, 视频和数据文件链接已有数字人的文件
+            prepared_key = upload_key(sha256.hexdigest(), False)
+            prepared_dir = find_avatar(prepared_key)
+            if prepared_dir is not None:
+                clone_avatar_assets(prepared_dir, create_avatar_site(website_dir, avatar_config))
+                print(f"训练 {digital_human_id} 复用已有数字人 {os.path.basename(prepared_dir)} 的资源")
+                return TrainingResponse(
+                    success=True,
+                    message="数字人训练完成（复用相同视频的预处理结果）",
+                    digital_human_id=digital_human_id,
+                    web_url=f"/digital-human/{digital_human_id}",
+                    assets_info={
+                        "video_size": video_size,
+                        "config": config_data
+                    }
+                )
+
+            # 预检查只解码少量抽样帧, 不合格的视频在1~2秒内返回, 不进入完整预处理
+            reason = await asyncio.to_thread(validate_video, temp_video_path)
+            if reason:
+                raise HTTPException(status_code=400, detail=f"视频不符合要求: {reason}")
+
+            def publish_assets(site_dir):
+                shutil.move(f"{video_dir_path}/assets/01.mp4", f"{assets_dir}/01.mp4")  # video_dir_path 处理完后会删除, 直接移动
+                # 移动端预览示例视频与 01.mp4 同一次解码生成, ffmpeg 不支持 VP9 时没有该文件
+                if os.path.isfile(f"{video_dir_path}/assets/example.webm"):
+                    shutil.move(f"{video_dir_path}/assets/example.webm", f"{assets_dir}/example.webm")
+                publish_avatar_data(f"{video_dir_path}/assets/data", assets_dir)  # 数据文件按内容哈希命名, 由 assets/manifest.json 指向
+
+            # 预处理与网页构建互不依赖, 按任务图并发执行
+            graph = TaskGraph()
+            graph.add("prep_mini", data_preparation_mini, args=(temp_video_path, video_dir_path, False))
+            graph.add("prep_web", data_preparation_web, args=(video_dir_path,), deps=["prep_mini"])
+            # 共享运行时(混淆后的 jsCode15 等)只在 web_source 变化后构建一次, 数字人目录只保存配置、数据和媒体文件
+            graph.add("runtime", build_runtime)
+            graph.add("site", create_avatar_site, args=(website_dir, avatar_config), inputs=["runtime"])
+            graph.add("publish", publish_assets, deps=["prep_web"], inputs=["site"])
+            # 训练耗时较长, 在线程中执行, 不阻塞事件循环(训练期间/health、/ready等接口仍可响应)
+            await asyncio.to_thread(graph.run)
+            print(f"训练 {digital_human_id} 各阶段耗时: {graph.report()}")
+            register_avatar(prepared_key, digital_human_id)
             
-            # 如果 jsCode15 仍缺少关键文件，退化为直接复制 js_source
-            required_js = [
-                "humanLogic.js", "zip.js", "v.js", "opengl.js",
-                "logic.js", "loadMode1.js", "loadMode2.js", "load.js"
-            ]
-            try:
-                os.makedirs(js_code15_dir, exist_ok=True)  # 20250825_update
-                for fname in required_js:
-                    src = os.path.join(js_source_dir, fname)
-                    dst = os.path.join(js_code15_dir, fname)
-                    if os.path.exists(src) and not os.path.exists(dst):
-                        shutil.copy(src, dst)  # 20250825_update: 回退复制，保障前端引用可用
-            except Exception as e:
-                print(f"复制 js_source 到 jsCode15 失败: {e}")  # 20250825_update
-
             # 清理临时文件
             shutil.rmtree(video_dir_path)
             
@@ -219,7 +270,7 @@ async def train_digital_human(
                 digital_human_id=digital_human_id,
                 web_url=f"/digital-human/{digital_human_id}",
                 assets_info={
-                    "video_size": len(content),
+                    "video_size": video_size,
                     "config": config_data
                 }
             )
@@ -229,6 +280,8 @@ async def train_digital_human(
             if os.path.exists(temp_video_path):
                 os.remove(temp_video_path)
                 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"训练失败: {str(e)}")
 
@@ -254,8 +307,14 @@ async def get_digital_human_assets(digital_human_id: str, asset_path: str):
     
     if not os.path.exists(asset_full_path):
         raise HTTPException(status_code=404, detail="资源文件不存在")
-    
-    return FileResponse(asset_full_path)
+
+    # 按内容哈希命名的数据文件内容不会变化, 可长期缓存; manifest.json 每次校验
+    headers = {}
+    if re.fullmatch(r"data\.[0-9a-f]{16}\.bin", asset_path):
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif asset_path == AVATAR_MANIFEST:
+        headers["Cache-Control"] = "no-cache"
+    return FileResponse(asset_full_path, headers=headers)
 
 # 20250825_update: 新增通配静态资源路由，服务 image/js_source/jsCode15 等全部子目录
 @app.api_route("/digital-human/{digital_human_id}/{static_path:path}", methods=["GET", "HEAD"])  # 20250825_update
@@ -267,6 +326,9 @@ async def get_digital_human_static(digital_human_id: str, static_path: str):
         raise HTTPException(status_code=400, detail="非法路径")
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="资源文件不存在")
+    if digital_human_id == "_runtime":
+        # 共享运行时目录按内容哈希命名, 内容不会变化
+        return FileResponse(file_path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
     return FileResponse(file_path)
 
 @app.post("/inference")
@@ -325,7 +387,7 @@ async def list_digital_humans():
     
     if os.path.exists(website_dir):
         for item in os.listdir(website_dir):
-            if os.path.isdir(os.path.join(website_dir, item)):
+            if os.path.isdir(os.path.join(website_dir, item)) and not item.startswith("_"):  # 跳过共享运行时 _runtime
                 digital_humans.append({
                     "id": item,
                     "url": f"/digital-human/{item}",
@@ -1,16 +1,20 @@
 # coding: utf-8
-import base64
 import os.path
 import shutil
 import cv2
 import gradio as gr
-import subprocess
 import uuid
 from PIL import Image
 
 import numpy as np
-from data_preparation_mini import data_preparation_mini
+from data_preparation_mini import data_preparation_mini, validate_video, VideoProcessingError, \
+    EnvironmentError as PreparationEnvironmentError
 from data_preparation_web import data_preparation_web
+from talkingface.avatar_data import publish_avatar_data
+from talkingface.web_runtime import build_runtime, create_avatar_site
+from talkingface.task_graph import TaskGraph
+from talkingface.stage_cache import file_digest
+from talkingface.upload_index import upload_key, find_avatar, register_avatar, clone_avatar_assets
  
 
 
@@ -355,36 +359,6 @@ footer {
 """
 
  
-def run_js_file(js_file_path):
-    try:
-        result = subprocess.run(
-            ['node', js_file_path],
-            check=True,
-            text=True,
-            capture_output=True
-        )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"执行失败: {e.stderr}")
-        return None
-    
-def compress_webm(input_path, output_path, width=480, crf=40, bitrate="500k"):
-    cmd = [
-        "ffmpeg",
-        "-i", input_path,
-        "-vf", f"scale={width}:-2:flags=lanczos,split[s0][s1];[s0]reverse[r];[s1][r]concat",
-        "-c:v", "libvpx-vp9",
-        "-crf", str(crf),
-        "-b:v", bitrate,
-        "-row-mt", "1",
-        "-quality", "good",
-        "-cpu-used", "4",
-        "-an", "-loop", "0",
-        "-y", output_path
-    ]
-    subprocess.run(cmd)
-    
-    
 # 假设你已经有了这两个函数
 def data_preparation(video1,llmSystemInfo,voiceId,model_radio): 
     if video1 is None or not os.path.exists(video1):
@@ -399,58 +373,68 @@ def data_preparation(video1,llmSystemInfo,voiceId,model_radio):
     # 处理视频的逻辑
     video_dir_path = "video_data/{}".format(pp)
     video_dir_path=os.path.join(os.path.dirname(__file__), video_dir_path)
-    data_preparation_mini(video1, video_dir_path, False)
-    data_preparation_web(video_dir_path)
-
-    #return "视频处理完成，保存至目录{}".format(video_dir_path)
 
     website = "website/{}".format(pp)
     website=os.path.join(os.path.dirname(__file__), website)
-    if os.path.exists(website):
-        shutil.rmtree(website)
-    
-    shutil.copytree("web_source", website)
-
-    websiteAssets= website+"/assets"
-    if not os.path.exists(websiteAssets):
-        os.makedirs(websiteAssets)
-    shutil.copy(video_dir_path+"/assets/01.mp4", website+"/assets/01.mp4")
-    shutil.copy(video_dir_path+"/assets/data", website+"/assets/data")
-
-    compress_webm(video1, websiteAssets+"/example.webm", width=360, crf=45, bitrate="300k")
-
-    with open(video_dir_path+"/assets/data", 'rb') as f:
-        file_data = f.read()
-    base64_data = base64.b64encode(file_data).decode('utf-8')
-
-    logicpath=website+"/js_source/logic.js" 
-    with open(logicpath, 'r', encoding='utf-8') as f:
-        js_content = f.read()
-    updated_js = js_content.replace("数据文件需要替换的地方", base64_data) 
-
-    with open(logicpath, 'w', encoding='utf-8') as f:
-        f.write(updated_js)
-
-
-    humanLogicpath=website+"/js_source/humanLogic.js" 
-    with open(humanLogicpath, 'r', encoding='utf-8') as f:
-        humanLogicjs_content = f.read()
-    humanLogicjs_content = humanLogicjs_content.replace("大模型身份信息覆盖", llmSystemInfo)
-
-    sddsdfg= get_audio_filename(voiceId) 
-    humanLogicjs_content = humanLogicjs_content.replace("声音id信息覆盖", sddsdfg) 
+    avatar_config = {
+        "systemMessage": llmSystemInfo,
+        "voiceType": get_audio_filename(voiceId),
+        "isVLM": bool(model_radio),
+    }
 
-    humanLogicjs_content = humanLogicjs_content.replace("是否开启视觉",  str(model_radio).lower()) 
+    # 相同视频(例如示例视频)已训练过时只写入新的配置, 视频、数据文件和缩略图链接已有数字人的文件
+    prepared_key = upload_key(file_digest(video1), False)
+    prepared_dir = find_avatar(prepared_key)
+    if prepared_dir is not None:
+        clone_avatar_assets(prepared_dir, create_avatar_site(website, avatar_config))
+        print("复用已有数字人 {} 的资源".format(os.path.basename(prepared_dir)))
+        return (
+            gr.Button("处理完成", variant="primary"),
+            f"<h3 id='result'>生成成功，数字人链接："
+            f"<a href='https://human-train.lkz.fit/{pp}' target='_blank'>https://human-train.lkz.fit/{pp}</a></h3>"
+        )
 
-    with open(humanLogicpath, 'w', encoding='utf-8') as f:
-        f.write(humanLogicjs_content)
+    # 预检查只解码少量抽样帧, 不合格的视频在1~2秒内提示, 不进入完整预处理
+    try:
+        validate_video(video1)
+    except PreparationEnvironmentError:
+        # ffmpeg未安装, 与预处理中相同直接报错
+        raise
+    except VideoProcessingError as e:
+        return (
+            gr.Button("处理失败", variant="primary"),
+            f"<h3 id='result'>视频不符合要求：{e}</h3>"
+        )
 
-    video_frame = get_video_thumbnail(video1)
-    Image.fromarray(video_frame).save(website+"/image/bg.jpg")
+    def publish_assets(site_dir, thumbnail):
+        # video_dir_path处理完后会删除, 直接移动文件
+        shutil.move(video_dir_path+"/assets/01.mp4", site_dir+"/assets/01.mp4")
+        # 示例视频与01.mp4同一次解码生成, ffmpeg不支持VP9时没有该文件
+        if os.path.isfile(video_dir_path+"/assets/example.webm"):
+            shutil.move(video_dir_path+"/assets/example.webm", site_dir+"/assets/example.webm")
+        publish_avatar_data(video_dir_path+"/assets/data", site_dir+"/assets")
+        Image.fromarray(thumbnail).save(site_dir+"/image/bg.jpg")
+
+    def load_thumbnail(prep_result):
+        # 缩略图取预处理解码时保存的首帧, 不再单独解码上传视频
+        return cv2.cvtColor(cv2.imread(prep_result["ref_frame"]), cv2.COLOR_BGR2RGB)
+
+    # 预处理与网页构建互不依赖, 按任务图并发执行
+    graph = TaskGraph()
+    graph.add("prep_mini", data_preparation_mini, args=(video1, video_dir_path, False))
+    graph.add("thumbnail", load_thumbnail, inputs=["prep_mini"])
+    # prep_web结束时删除data目录, 需在读取首帧之后
+    graph.add("prep_web", data_preparation_web, args=(video_dir_path,), deps=["prep_mini", "thumbnail"])
+    # 共享运行时只在web_source变化后构建一次, 数字人目录只保存配置、数据和媒体文件
+    graph.add("runtime", build_runtime)
+    graph.add("site", create_avatar_site, args=(website, avatar_config), inputs=["runtime"])
+    graph.add("publish", publish_assets, deps=["prep_web"], inputs=["site", "thumbnail"])
+    graph.run()
+    print("各阶段耗时: {}".format(graph.report()))
+    register_avatar(prepared_key, pp)
 
     shutil.rmtree(video_dir_path)
 
-    run_js_file(website+"/test.js")
     return (
         gr.Button("处理完成", variant="primary"),
         f"<h3 id='result'>生成成功，数字人链接："
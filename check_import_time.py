@@ -0,0 +1,49 @@
+'''
+api_server 导入耗时检查, 启动变慢时返回非0退出码, 可放在CI或镜像构建中执行
+
+1. 导入api_server后不能出现重量级模块(torch/mediapipe/OpenGL/glfw/sklearn/cv2), 它们应由load_engine按需加载
+2. 在新进程中导入api_server的耗时不能超过预算(秒)
+
+Usage: python check_import_time.py [<budget_seconds>]
+'''
+import os
+import sys
+import json
+import subprocess
+
+DEFAULT_BUDGET = 2.0
+HEAVY_MODULES = ["torch", "mediapipe", "OpenGL", "glfw", "sklearn", "cv2"]
+
+_PROBE = '''
+import sys, time, json
+start_time = time.perf_counter()
+import api_server
+elapsed = time.perf_counter() - start_time
+print(json.dumps({"seconds": elapsed, "heavy": [m for m in %r if m in sys.modules]}))
+''' % HEAVY_MODULES
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET
+    # 跑两次取较小值, 排除第一次冷磁盘缓存和生成.pyc的影响
+    results = []
+    for _ in range(2):
+        out = subprocess.run([sys.executable, "-c", _PROBE], check=True, stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(out.stdout.decode().strip().splitlines()[-1]))
+    seconds = min(i["seconds"] for i in results)
+    heavy = results[-1]["heavy"]
+
+    print("import api_server: {:.3f}s (预算 {:.3f}s)".format(seconds, budget))
+    failed = False
+    if heavy:
+        print("导入时加载了重量级模块: {}".format(", ".join(heavy)))
+        failed = True
+    if seconds > budget:
+        print("导入耗时超出预算")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,8 @@ import cv2
 import sys
 import os
 import math
-import pickle
 import mediapipe as mp
+from talkingface.keypoint_store import save_keypoints
 mp_face_mesh = mp.solutions.face_mesh
 mp_face_detection = mp.solutions.face_detection
 
@@ -166,9 +166,8 @@ def CirculateVideo(video_in_path, video_out_path, export_imgs = False):
     if type(pts_3d) is np.ndarray and len(pts_3d) == frames:
         print("关键点已提取")
     pts_3d = np.concatenate([pts_3d, pts_3d[::-1]], axis=0)
-    Path_output_pkl = "{}/keypoint_rotate.pkl".format(os.path.dirname(video_out_path))
-    with open(Path_output_pkl, "wb") as f:
-        pickle.dump(pts_3d, f)
+    save_keypoints("{}/keypoint_rotate.kps".format(os.path.dirname(video_out_path)), pts_3d,
+                   {"width": int(vid_width), "height": int(vid_height), "frame_count": len(pts_3d)})
 
     if export_imgs:
         # 计算整个视频中人脸的范围
@@ -5,9 +5,16 @@ import cv2
 import sys
 import os
 import math
-import pickle
+import itertools
+import tempfile
 import mediapipe as mp
 import shutil
+from talkingface.keypoint_store import save_keypoints, keypoint_path, load_keypoint_meta
+from talkingface.stage_cache import run_stage, stage_key, file_digest, code_version, env_values, \
+    PREP_MINI_SOURCES, PREP_MINI_ENV
+from talkingface.utils import main_keypoints_index
+from talkingface.batch_utils import crop_mouth_rects
+from talkingface import loop_segment
 
 # 自定义异常类
 class VideoProcessingError(Exception):
@@ -34,9 +41,21 @@ class EnvironmentError(VideoProcessingError):
     """环境配置错误"""
     pass
 
+class ChunkConsistencyError(VideoProcessingError):
+    """多进程分段提取结果不一致"""
+    pass
+
+class VideoValidationError(VideoProcessingError):
+    """上传视频预检查不通过"""
+    pass
+
 mp_face_mesh = mp.solutions.face_mesh
 mp_face_detection = mp.solutions.face_detection
 
+# 面部网格检测输入的最大边长, 裁剪区域更大时先缩小再检测, 关键点按原分辨率输出; 0表示不缩放
+# FaceMesh内部会把人脸缩放到192x192, 缩小输入对精度影响很小, 检测耗时不再随上传视频分辨率增长
+DETECT_MAX_SIDE = int(os.getenv("DH_DETECT_MAX_SIDE", 512))
+
 
 def detect_face(frame: np.ndarray, min_detection_confidence: float = 0.5) -> list:
     """人脸检测并验证有效性"""
@@ -96,6 +115,25 @@ def calc_face_interact(face0, face1):
     return min(tmp0, tmp1)
 
 
+def _landmarks_to_pts(results, image_width: int, image_height: int) -> np.ndarray:
+    """mediapipe结果转为像素坐标 [478, 3]"""
+    if not results.multi_face_landmarks:
+        raise FaceMeshDetectionError("未检测到面部网格")
+    landmarks = np.array([[i.x, i.y, i.z] for i in results.multi_face_landmarks[0].landmark])
+    pts_3d = np.floor(landmarks * [image_width, image_height, image_width])
+    return np.minimum(pts_3d, [image_width - 1, image_height - 1, image_width - 1])
+
+
+def _to_detect_rgb(frame: np.ndarray, max_side: int = DETECT_MAX_SIDE) -> np.ndarray:
+    """BGR转RGB, 最大边超过max_side时缩小(代理图像), 坐标换算由_landmarks_to_pts按原图尺寸完成"""
+    image_height, image_width = frame.shape[:2]
+    if max_side and max(image_height, image_width) > max_side:
+        scale = max_side / max(image_height, image_width)
+        frame = cv2.resize(frame, (max(1, round(image_width * scale)), max(1, round(image_height * scale))),
+                           interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
 def detect_face_mesh(frame: np.ndarray) -> np.ndarray:
     """面部网格检测"""
     with mp_face_mesh.FaceMesh(
@@ -105,118 +143,660 @@ def detect_face_mesh(frame: np.ndarray) -> np.ndarray:
             min_detection_confidence=0.5
     ) as face_mesh:
 
-        results = face_mesh.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        pts_3d = np.zeros((478, 3))
+        results = face_mesh.process(_to_detect_rgb(frame))
+        image_height, image_width = frame.shape[:2]
+        return _landmarks_to_pts(results, image_width, image_height)
+
+
+class FaceMeshTracker:
+    """
+    视频模式的面部网格跟踪器, 整个视频复用同一个FaceMesh
+
+    - 跟踪模式下mediapipe只在跟踪置信度低于min_tracking_confidence时重新检测
+    - 跟踪丢失时用单帧检测器重新检测, 并重建跟踪器
+    - 每隔parity_interval帧用单帧检测结果校验跟踪误差, 平均误差超过parity_tolerance(相对裁剪尺寸)时以检测结果为准并重建跟踪器
+    - 输入在最大边超过DETECT_MAX_SIDE时缩小后检测, 返回的坐标仍对应输入图像尺寸
+    """
+    def __init__(self, parity_interval: int = 50, parity_tolerance: float = 0.01):
+        self.parity_interval = parity_interval
+        self.parity_tolerance = parity_tolerance
+        self.static_mesh = mp_face_mesh.FaceMesh(
+            static_image_mode=True,
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=0.5
+        )
+        self.video_mesh = None
+        self.frame_count = 0
+        self.redetect_count = 0
+        self.parity_errors = []
+
+    def _reset_tracking(self):
+        if self.video_mesh is not None:
+            self.video_mesh.close()
+        self.video_mesh = mp_face_mesh.FaceMesh(
+            static_image_mode=False,
+            max_num_faces=1,
+            refine_landmarks=True,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
 
-        if not results.multi_face_landmarks:
-            raise FaceMeshDetectionError("未检测到面部网格")
+    def _detect(self, rgb: np.ndarray, image_width: int, image_height: int) -> np.ndarray:
+        return _landmarks_to_pts(self.static_mesh.process(rgb), image_width, image_height)
 
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        """输入BGR图像, 返回[478, 3]像素坐标, 检测失败时抛出FaceMeshDetectionError"""
+        rgb = _to_detect_rgb(frame)
         image_height, image_width = frame.shape[:2]
-        for idx, landmark in enumerate(results.multi_face_landmarks[0].landmark):
-            pts_3d[idx] = [
-                min(math.floor(landmark.x * image_width), image_width - 1),
-                min(math.floor(landmark.y * image_height), image_height - 1),
-                min(math.floor(landmark.z * image_width), image_width - 1)
-            ]
+        if self.video_mesh is None:
+            self._reset_tracking()
+        self.frame_count += 1
+        try:
+            pts_3d = _landmarks_to_pts(self.video_mesh.process(rgb), image_width, image_height)
+        except FaceMeshDetectionError:
+            # 跟踪丢失, 重新检测
+            self.redetect_count += 1
+            self._reset_tracking()
+            return self._detect(rgb, image_width, image_height)
+
+        if self.parity_interval and self.frame_count % self.parity_interval == 0:
+            detected = self._detect(rgb, image_width, image_height)
+            error = np.linalg.norm(pts_3d[:, :2] - detected[:, :2], axis=1).mean() / max(image_width, image_height)
+            self.parity_errors.append(error)
+            if error > self.parity_tolerance:
+                self.redetect_count += 1
+                self._reset_tracking()
+                return detected
         return pts_3d
 
+    def detect(self, frame: np.ndarray) -> np.ndarray:
+        """单帧检测(不经过跟踪器), 输入BGR图像"""
+        image_height, image_width = frame.shape[:2]
+        return self._detect(_to_detect_rgb(frame), image_width, image_height)
+
+    def close(self):
+        self.static_mesh.close()
+        if self.video_mesh is not None:
+            self.video_mesh.close()
+
+
+class SparseFaceMeshTracker:
+    """
+    稀疏关键帧检测: 每keyframe_interval帧运行一次FaceMesh, 中间帧用金字塔LK光流传播478个关键点
+
+    - 中间帧光流跟丢的点超过10%或运动幅度超过motion_threshold(相对裁剪尺寸)时, 当前帧立即作为关键帧
+    - 到达关键帧时, 用检测结果与光流预测的差值对中间帧做线性漂移校正
+    - 关键帧误差超过max_error(相对裁剪尺寸)时, 中间帧改为逐帧检测并缩短关键帧间隔; 误差较小时逐步恢复间隔
+    process返回已确定结果的帧(按顺序), 视频结束后调用flush取回剩余帧
+    光流在缩放到flow_size的灰度图上计算, 478个点的LK在原始裁剪分辨率上比FaceMesh跟踪还慢
+    """
+    flow_size = 192
+    flow_criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 10, 0.03)
+
+    def __init__(self, keyframe_interval: int = 5, max_error: float = 0.005, motion_threshold: float = 0.02):
+        self.tracker = FaceMeshTracker()
+        self.max_interval = keyframe_interval
+        self.interval = keyframe_interval
+        self.max_error = max_error
+        self.motion_threshold = motion_threshold
+        self.pending = []
+        self.prev_gray = None
+        self.prev_pts = None
+        self.frame_count = 0
+        self.keyframe_count = 0
+        self.dense_count = 0
+        self.keyframe_errors = []
+        self.redetect_count = 0
+        self.parity_errors = []
+
+    def _keyframe(self, frame: np.ndarray, gray: np.ndarray) -> np.ndarray:
+        self.keyframe_count += 1
+        pts_3d = self.tracker.process(frame)
+        self.prev_gray, self.prev_pts = gray, pts_3d
+        return pts_3d
 
-def extract_from_video(
-        video_path: str,
-        output_pkl_path: str
-) -> None:
-    """从视频提取关键点"""
+    def process(self, frame: np.ndarray) -> list:
+        self.frame_count += 1
+        scale = self.flow_size / max(frame.shape[:2])
+        gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if self.prev_pts is None:
+            return [self._keyframe(frame, gray)]
+
+        prev_xy = (self.prev_pts[:, :2] * scale).astype(np.float32)
+        next_xy, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, prev_xy, None,
+                                                       winSize=(9, 9), maxLevel=1, criteria=self.flow_criteria)
+        valid = status.ravel() == 1
+        pts_3d = self.prev_pts.copy()
+        pts_3d[valid, :2] = next_xy[valid] / scale
+        motion = np.median(np.linalg.norm(next_xy[valid] - prev_xy[valid], axis=1)) / self.flow_size if valid.any() else np.inf
+        self.prev_gray, self.prev_pts = gray, pts_3d
+        self.pending.append((frame, pts_3d))
+        if len(self.pending) < self.interval and valid.mean() > 0.9 and motion < self.motion_threshold:
+            return []
+        return self._close_segment()
+
+    def _close_segment(self) -> list:
+        # 最后一帧作为关键帧, 校正之前的中间帧
+        frame, flow_pts = self.pending[-1]
+        detected = self._keyframe(frame, self.prev_gray)
+        residual = detected - flow_pts
+        error = np.linalg.norm(residual[:, :2], axis=1).mean() / max(frame.shape[:2])
+        self.keyframe_errors.append(error)
+        n = len(self.pending)
+        if error > self.max_error:
+            self.dense_count += n - 1
+            out = [self.tracker.detect(i) for i, _ in self.pending[:-1]]
+            self.interval = max(1, self.interval // 2)
+        else:
+            out = [pts_3d + residual * (i + 1) / n for i, (_, pts_3d) in enumerate(self.pending[:-1])]
+            if error < self.max_error / 2:
+                self.interval = min(self.max_interval, self.interval + 1)
+        out.append(detected)
+        self.pending = []
+        return out
+
+    def flush(self) -> list:
+        return self._close_segment() if self.pending else []
+
+    def close(self):
+        self.tracker.close()
+
+
+def calc_face_rect(frame: np.ndarray, vid_width: float, vid_height: float) -> tuple:
+    """首帧人脸检测, 返回整段视频使用的人脸裁剪框 (x_min, y_min, x_max, y_max)"""
+    try:
+        rect = detect_face(frame, 0.25)
+        x_min = int(rect[0] * vid_width)
+        y_min = int(rect[2] * vid_height)
+        x_max = int(rect[1] * vid_width)
+        y_max = int(rect[3] * vid_height)
+    except FaceDetectionError:
+        # 尝试裁剪后检测
+        cropped = frame[
+                  int(0.1 * vid_height):int(0.9 * vid_height),
+                  int(0.1 * vid_width):int(0.9 * vid_width)
+                  ]
+        try:
+            rect = detect_face(cropped, 0.25)
+        except FaceDetectionError as e:
+            raise FirstFrameFaceDetectionError("首帧人脸检测失败") from e
+
+        # 转换坐标到原图
+        x_min = int(rect[0] * vid_width + 0.1 * vid_width)
+        y_min = int(rect[2] * vid_height + 0.1 * vid_height)
+        x_max = int(rect[1] * vid_width + 0.1 * vid_width)
+        y_max = int(rect[3] * vid_height + 0.1 * vid_height)
+
+    y_mid = (y_min + y_max) / 2.
+    x_mid = (x_min + x_max) / 2.
+    len_ = max(x_max - x_min, y_max - y_min)
+    face_rect = [x_mid - len_, y_mid - len_, x_mid + len_, y_mid + len_]
+    x_min, y_min, x_max, y_max = face_rect
+    seq_w, seq_h = x_max - x_min, y_max - y_min
+    x_mid, y_mid = (x_min + x_max) / 2, (y_min + y_max) / 2
+    crop_size = int(max(seq_w * 1.35, seq_h * 1.35))
+    x_min = int(max(0, x_mid - crop_size * 0.5))
+    y_min = int(max(0, y_mid - crop_size * 0.45))
+    x_max = int(min(vid_width, x_min + crop_size))
+    y_max = int(min(vid_height, y_min + crop_size))
+    return (x_min, y_min, x_max, y_max)
+
+
+# 上传视频预检查: 抽样检测的帧数, 时长(秒)和分辨率范围
+VALIDATE_SAMPLES = int(os.getenv("DH_VALIDATE_SAMPLES", 5))
+MIN_VIDEO_SECONDS = float(os.getenv("DH_MIN_VIDEO_SECONDS", 2))
+MAX_VIDEO_SECONDS = float(os.getenv("DH_MAX_VIDEO_SECONDS", 60))
+MIN_VIDEO_SIDE = 200
+MAX_VIDEO_SIDE = int(os.getenv("DH_MAX_VIDEO_SIDE", 4096))
+
+
+def validate_video(video_path: str, num_samples: int = None) -> dict:
+    """
+    完整预处理前的快速检查(1~2秒), 不合格的视频在这里失败, 不再等到提取完全部关键点:
+    - 视频可读, 时长在[DH_MIN_VIDEO_SECONDS, DH_MAX_VIDEO_SECONDS]秒, 短边不低于MIN_VIDEO_SIDE, 长边不超过DH_MAX_VIDEO_SIDE
+    - 首帧人脸检测(与extract_from_video相同的calc_face_rect)
+    - 在整段视频中均匀抽取num_samples帧, 在首帧裁剪框内做面部网格检测,
+      并按data_preparation_web.step1_crop_mouth的规则检查人脸范围是否超出视频
+    抽样帧由ffmpeg解码, 跳过不被参考的帧(-skip_frame noref), 解码耗时约为完整解码的一半
+    抽样帧通过只说明大概率可以处理, 完整流程中仍可能在其他帧失败
+    ffmpeg未安装时抛出EnvironmentError, 视频不合格时抛出VideoValidationError等VideoProcessingError
+    Returns:
+        {"width", "height", "fps", "frame_count", "duration", "face_rect", "samples"(实际检测的帧数)}
+    """
+    # 缺少ffmpeg是环境问题, 抛出EnvironmentError, 不作为视频不合格处理
+    check_ffmpeg()
+    num_samples = num_samples or VALIDATE_SAMPLES
+    # 时长从容器信息读取, 不需要解码
     cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise VideoProcessingError("无法打开视频文件")
+    opened = cap.isOpened()
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if not opened:
+        raise VideoValidationError("无法读取视频文件, 请上传mp4等常见格式的视频")
+    # 部分容器(例如webm)读不到帧数, 此时不检查时长, 只检测首帧
+    duration = frame_count / fps if fps > 0 and frame_count > 0 else None
+    if duration is not None and duration < MIN_VIDEO_SECONDS:
+        raise VideoValidationError(f"视频时长过短({duration:.1f}秒), 不能低于{MIN_VIDEO_SECONDS:g}秒")
+    if duration is not None and duration > MAX_VIDEO_SECONDS:
+        raise VideoValidationError(f"视频时长过长({duration:.1f}秒), 不能超过{MAX_VIDEO_SECONDS:g}秒")
+
+    sample_filter = "crop=trunc(iw/2)*2:trunc(ih/2)*2"
+    step = None
+    if duration is not None and num_samples > 1:
+        # 选出的相邻两帧至少间隔step秒, 略小于duration/(num_samples-1), 保证最后一段也能选到
+        step = duration / (num_samples - 1) * 0.95
+        sample_filter = f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{step:.3f})',{sample_filter}"
+    try:
+        # select只输出抽样帧, -vsync 0避免yuv4mpegpipe按帧率重复输出
+        pipe = FramePipe(video_path, sample_filter, input_options=["-skip_frame", "noref"],
+                         output_options=["-vsync", "0"])
+    except FFmpegError as e:
+        raise VideoValidationError("无法读取视频文件, 请上传mp4等常见格式的视频") from e
+    try:
+        vid_width, vid_height = pipe.width, pipe.height
+        if min(vid_width, vid_height) < MIN_VIDEO_SIDE:
+            raise VideoValidationError(f"视频分辨率过低({vid_width}x{vid_height}), 宽高不能低于{MIN_VIDEO_SIDE}像素")
+        if max(vid_width, vid_height) > MAX_VIDEO_SIDE:
+            raise VideoValidationError(f"视频分辨率过高({vid_width}x{vid_height}), 宽高不能超过{MAX_VIDEO_SIDE}像素")
+
+        frame = pipe.read()
+        if frame is None:
+            raise VideoValidationError("无法读取视频首帧")
+        face_rect = calc_face_rect(frame, vid_width, vid_height)
+        x0, y0, x1, y1 = face_rect
+        pts_3d = []
+        for index in range(num_samples):
+            if index > 0:
+                frame = pipe.read()
+                if frame is None:
+                    break
+            try:
+                pts_3d.append(detect_face_mesh(frame[y0:y1, x0:x1]) + [x0, y0, 0])
+            except FaceMeshDetectionError as e:
+                raise VideoValidationError("约第{:.1f}秒的画面面部网格检测失败, 请保证整段视频中人脸完整且正对镜头".format(
+                    index * (step or 0))) from e
+    finally:
+        pipe.close(check=False)
+
+    # 与step1_crop_mouth相同的人脸范围检查(抽样帧, 不做平滑)
+    pts_3d = np.array(pts_3d)
+    rects = crop_mouth_rects(pts_3d[:, main_keypoints_index], vid_width, vid_height)
+    face_size = (rects[:, 2] - rects[:, 0]).mean() / 2.0 + (rects[:, 3] - rects[:, 1]).mean() / 2.0
+    face_size = int(face_size) // 2 * 2
+    face_mid = (rects[:, 2:] + rects[:, 0:2]) / 2.
+    if face_mid[:, 0].max() + face_size / 2 > vid_width or face_mid[:, 1].max() + face_size / 2 > vid_height:
+        raise VideoValidationError("人脸范围超出了视频，请保证视频合格后再重试")
+    return {
+        "width": vid_width,
+        "height": vid_height,
+        "fps": fps,
+        "frame_count": frame_count,
+        "duration": duration,
+        "face_rect": [int(i) for i in face_rect],
+        "samples": len(pts_3d),
+    }
+
+
+# 多进程提取: 每段至少的帧数, 以及相邻两段的重叠帧数(后一段的跟踪器先在重叠帧上预热, 并与前一段结果比对)
+MIN_CHUNK_FRAMES = 50
+CHUNK_OVERLAP = 8
+# 重叠帧上两段结果的平均误差上限(相对裁剪尺寸), 超过说明视频定位不准, 回退到单进程
+CHUNK_OVERLAP_TOLERANCE = 0.01
+# 稀疏关键帧模式下关键帧处光流预测与检测结果的平均误差上限(相对裁剪尺寸), 超过时中间帧逐帧检测
+SPARSE_MAX_ERROR = float(os.getenv("DH_KEYFRAME_MAX_ERROR", 0.005))
+# 多进程提取时解码后的人脸裁剪区域先放入共享内存, 超过该大小(MB)时改为单进程边解码边提取
+FRAME_BUFFER_MB = int(os.getenv("DH_FRAME_BUFFER_MB", 2048))
+# 移动端示例视频(example.webm)的宽度和VP9编码参数
+WEBM_WIDTH = 360
+WEBM_CRF = 45
+WEBM_BITRATE = "300k"
+
+
+class FramePipe:
+    """
+    ffmpeg解码视频, 以yuv4mpeg格式通过管道逐帧读出并转换为BGR, 不经过中间编码文件
+    video_filter: ffmpeg滤镜(例如video_filter()的返回值), 输出宽高必须为偶数
+    input_options: 放在-i之前的解码参数, 例如["-skip_frame", "noref"]
+    output_options: 输出参数, 例如["-vsync", "0"](不按帧率补帧)
+    outputs: 用同一次解码的帧编码的其他输出(见web_outputs), [(滤镜或None, 输出参数), ...]
+             读出的yuv4mpeg帧原样转发给单独的编码进程, 解码管道结束(close)后编码进程继续收尾, 用wait_outputs等待
+    """
+    def __init__(self, input_path: str, video_filter: str = None, input_options: list = None,
+                 output_options: list = None, outputs: list = None):
+        cmd = ["ffmpeg", "-loglevel", "error"] + list(input_options or []) + ["-i", input_path]
+        if video_filter:
+            cmd += ["-vf", video_filter]
+        cmd += list(output_options or [])
+        cmd += ["-an", "-f", "yuv4mpegpipe", "-pix_fmt", "yuv420p", "-"]
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.encoder = None
+        header = self.proc.stdout.readline()
+        if not header.startswith(b"YUV4MPEG2"):
+            self.close(check=False)
+            raise FFmpegError(f"FFmpeg解码失败: {self._error()}")
+        params = {i[:1]: i[1:] for i in header.split()[1:]}
+        self.width, self.height = int(params[b"W"]), int(params[b"H"])
+        num, den = params[b"F"].split(b":")
+        self.fps = int(num) / int(den)
+        if self.width % 2 or self.height % 2:
+            self.close(check=False)
+            raise FFmpegError(f"解码输出的宽高必须为偶数: {self.width}x{self.height}")
+        self.frame_size = self.width * self.height * 3 // 2
+        self.frame_count = 0
+        if outputs:
+            self._start_encoder(outputs, header)
+
+    def _start_encoder(self, outputs, header):
+        graph = "[0:v]split={}{}".format(len(outputs), "".join("[o{}]".format(i) for i in range(len(outputs))))
+        cmd = ["ffmpeg", "-loglevel", "error", "-f", "yuv4mpegpipe", "-i", "-"]
+        maps = []
+        for i, (branch_filter, _) in enumerate(outputs):
+            if branch_filter:
+                graph += ";[o{}]{}[v{}]".format(i, branch_filter, i)
+            maps.append("[v{}]".format(i) if branch_filter else "[o{}]".format(i))
+        cmd += ["-filter_complex", graph]
+        for label, (_, args) in zip(maps, outputs):
+            cmd += ["-map", label] + list(args)
+        self.encoder_stderr = tempfile.TemporaryFile()
+        self.encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=self.encoder_stderr)
+        self._forward(header)
+
+    def _forward(self, data):
+        try:
+            self.encoder.stdin.write(data)
+        except OSError:
+            self.close(check=False)
+            raise FFmpegError(f"FFmpeg编码失败: {self._encoder_error()}")
+
+    def _error(self):
+        self.stderr.seek(0)
+        return self.stderr.read().decode(errors="ignore")
+
+    def _encoder_error(self):
+        self.encoder_stderr.seek(0)
+        return self.encoder_stderr.read().decode(errors="ignore")
+
+    def read(self):
+        """返回下一帧BGR图像, 结束时返回None"""
+        line = self.proc.stdout.readline()
+        if not line:
+            return None
+        data = self.proc.stdout.read(self.frame_size)
+        if len(data) < self.frame_size:
+            return None
+        if self.encoder:
+            self._forward(line + data)
+        self.frame_count += 1
+        yuv = np.frombuffer(data, dtype=np.uint8).reshape(self.height * 3 // 2, self.width)
+        return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self, check: bool = True):
+        """
+        结束解码, check=True时ffmpeg异常退出抛出FFmpegError
+        编码进程的输入随之结束, check=False时编码进程直接终止(不保留不完整的输出)
+        """
+        if self.proc.poll() is None and not check:
+            self.proc.kill()
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        error = self._error()
+        self.stderr.close()
+        if self.encoder and not self.encoder.stdin.closed:
+            if not check:
+                self.encoder.kill()
+            try:
+                self.encoder.stdin.close()
+            except OSError:
+                pass
+        if check and returncode != 0:
+            raise FFmpegError(f"FFmpeg解码失败: {error}")
+
+    def wait_outputs(self):
+        """等待outputs编码完成, 失败时抛出FFmpegError"""
+        if not self.encoder:
+            return
+        returncode = self.encoder.wait()
+        error = self._encoder_error()
+        self.encoder_stderr.close()
+        if returncode != 0:
+            raise FFmpegError(f"FFmpeg编码失败: {error}")
+
+
+def _extract_range(face_regions, face_rect, start, end, overlap_start, tracking, out, show_progress = False,
+                   keyframe_interval = 1):
+    """
+    提取[start, end)帧的关键点写入out, face_regions为从overlap_start帧开始的人脸裁剪区域, [overlap_start, start)只用于跟踪器预热
+    end为None时处理到face_regions结束, 关键点依次追加到列表out
+    keyframe_interval > 1 时使用SparseFaceMeshTracker
+    Returns:
+        (重叠帧的关键点, 实际处理到的帧号)
+    """
+    sparse = keyframe_interval > 1
+    if sparse:
+        tracker = SparseFaceMeshTracker(keyframe_interval, SPARSE_MAX_ERROR)
+    else:
+        tracker = FaceMeshTracker() if tracking else None
+    x0, y0, x1, y1 = face_rect
+    overlap_pts = np.zeros((start - overlap_start, 478, 3))
+    frame_index = overlap_start
+    write_index = overlap_start
+
+    def store(frame_kps):
+        nonlocal write_index
+        if write_index < start:
+            overlap_pts[write_index - overlap_start] = frame_kps + [x0, y0, 0]
+        elif end is None:
+            out.append(frame_kps + [x0, y0, 0])
+        else:
+            out[write_index - start] = frame_kps + [x0, y0, 0]
+        write_index += 1
 
     try:
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        vid_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-        vid_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-
-        pts_3d = np.zeros((total_frames, 478, 3))
-        face_rect = None
-        for frame_index in tqdm.tqdm(range(total_frames)):
-            ret, frame = cap.read()  # 按帧读取视频
-            # #到视频结尾时终止
-            if ret is False:
-                break
-
-            if frame_index == 0:
-                try:
-                    rect = detect_face(frame, 0.25)
-                    x_min = int(rect[0] * vid_width)
-                    y_min = int(rect[2] * vid_height)
-                    x_max = int(rect[1] * vid_width)
-                    y_max = int(rect[3] * vid_height)
-                except FaceDetectionError:
-                    # 尝试裁剪后检测
-                    cropped = frame[
-                              int(0.1 * vid_height):int(0.9 * vid_height),
-                              int(0.1 * vid_width):int(0.9 * vid_width)
-                              ]
-                    try:
-                        rect = detect_face(cropped, 0.25)
-                    except FaceDetectionError as e:
-                        raise FirstFrameFaceDetectionError("首帧人脸检测失败") from e
-
-                    # 转换坐标到原图
-                    x_min = int(rect[0] * vid_width + 0.1 * vid_width)
-                    y_min = int(rect[2] * vid_height + 0.1 * vid_height)
-                    x_max = int(rect[1] * vid_width + 0.1 * vid_width)
-                    y_max = int(rect[3] * vid_height + 0.1 * vid_height)
-
-                y_mid = (y_min + y_max) / 2.
-                x_mid = (x_min + x_max) / 2.
-                len_ = max(x_max - x_min, y_max - y_min)
-                face_rect = [x_mid - len_, y_mid - len_, x_mid + len_, y_mid + len_]
-                x_min, y_min, x_max, y_max = face_rect
-                seq_w, seq_h = x_max - x_min, y_max - y_min
-                x_mid, y_mid = (x_min + x_max) / 2, (y_min + y_max) / 2
-                crop_size = int(max(seq_w * 1.35, seq_h * 1.35))
-                x_min = int(max(0, x_mid - crop_size * 0.5))
-                y_min = int(max(0, y_mid - crop_size * 0.45))
-                x_max = int(min(vid_width, x_min + crop_size))
-                y_max = int(min(vid_height, y_min + crop_size))
-                face_rect = (x_min, y_min, x_max, y_max)
-
-            # 裁剪人脸区域
-            x0, y0, x1, y1 = face_rect
-            face_region = frame[y0:y1, x0:x1]
-            # print(y_min, y_max, x_min, x_max)
-            # cv2.imshow("s", frame_face)
-            # cv2.waitKey(10)
+        if end is not None:
+            face_regions = itertools.islice(face_regions, end - overlap_start)
+        for face_region in (tqdm.tqdm(face_regions) if show_progress else face_regions):
             try:
-                frame_kps = detect_face_mesh(face_region)
+                if sparse:
+                    for frame_kps in tracker.process(face_region):
+                        store(frame_kps)
+                else:
+                    store(tracker.process(face_region) if tracker else detect_face_mesh(face_region))
             except FaceMeshDetectionError as e:
                 raise VideoProcessingError(f"第{frame_index}帧面部网格检测失败") from e
-            pts_3d[frame_index] = frame_kps + [x0, y0, 0]
-
+            frame_index += 1
+        if sparse:
+            try:
+                for frame_kps in tracker.flush():
+                    store(frame_kps)
+            except FaceMeshDetectionError as e:
+                raise VideoProcessingError(f"第{frame_index - 1}帧面部网格检测失败") from e
+    finally:
+        if sparse:
+            if tracker.keyframe_errors:
+                print("稀疏关键帧[{}, {}): 关键帧{}/{}帧, 逐帧回退{}帧, 关键帧平均误差{:.4f}".format(
+                    start, frame_index, tracker.keyframe_count, tracker.frame_count, tracker.dense_count, np.mean(tracker.keyframe_errors)))
+            tracker.close()
+        elif tracker:
+            if tracker.parity_errors:
+                print("关键点跟踪[{}, {}): 重新检测{}次, 抽检平均误差{:.4f}".format(
+                    start, frame_index, tracker.redetect_count, np.mean(tracker.parity_errors)))
+            tracker.close()
+    return overlap_pts, frame_index
+
+
+def _extract_chunk_worker(frames_shm_name, frames_shape, face_rect, start, end, overlap_start, tracking, shm_name,
+                          keyframe_interval):
+    # 子进程: 从共享内存读取本段的人脸裁剪区域, 结果直接写入共享内存中属于本段的区域
+    from multiprocessing import shared_memory
+    frames_shm = shared_memory.SharedMemory(name=frames_shm_name)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(frames_shape, dtype=np.uint8, buffer=frames_shm.buf)
+    pts_3d = np.ndarray((frames_shape[0], 478, 3), dtype=np.float64, buffer=shm.buf)
+    try:
+        return _extract_range(iter(frames[overlap_start:end]), face_rect, start, end, overlap_start, tracking,
+                              pts_3d[start:end], keyframe_interval=keyframe_interval)
+    finally:
+        # 先释放对共享内存的引用才能close
+        del frames, pts_3d
+        frames_shm.close()
+        shm.close()
+
+
+def _extract_chunks(frames_shm, frames_shape, face_rect, tracking, num_workers, keyframe_interval):
+    """多进程分段提取, 重叠帧结果不一致或分段读取不完整时抛出ChunkConsistencyError"""
+    from multiprocessing import shared_memory, get_context
+    from concurrent.futures import ProcessPoolExecutor
+    total_frames = frames_shape[0]
+    bounds = np.linspace(0, total_frames, num_workers + 1).astype(int)
+    chunk_scale = max(face_rect[2] - face_rect[0], face_rect[3] - face_rect[1])
+    shm = shared_memory.SharedMemory(create=True, size=total_frames * 478 * 3 * 8)
+    pts_3d = np.ndarray((total_frames, 478, 3), dtype=np.float64, buffer=shm.buf)
+    try:
+        pts_3d[:] = 0
+        # mediapipe不支持fork后继续使用, 用spawn启动子进程
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context("spawn")) as executor:
+            futures = [executor.submit(_extract_chunk_worker, frames_shm.name, frames_shape, face_rect, bounds[i],
+                                       bounds[i + 1], max(0, bounds[i] - CHUNK_OVERLAP), tracking, shm.name,
+                                       keyframe_interval)
+                       for i in range(num_workers)]
+            results = [f.result() for f in tqdm.tqdm(futures)]
+        for i in range(1, num_workers):
+            overlap_pts, _ = results[i]
+            if results[i - 1][1] < bounds[i]:
+                raise ChunkConsistencyError(f"第{results[i - 1][1]}帧读取失败")
+            error = np.linalg.norm(overlap_pts[:, :, :2] - pts_3d[bounds[i] - len(overlap_pts):bounds[i], :, :2], axis=2).mean()
+            if error / chunk_scale > CHUNK_OVERLAP_TOLERANCE:
+                raise ChunkConsistencyError(f"第{bounds[i]}帧附近分段结果不一致(误差{error:.1f}像素)")
+        return pts_3d.copy()
+    finally:
+        del pts_3d
+        shm.close()
+        shm.unlink()
+
+
+def _buffer_frames(face_regions, max_bytes):
+    """
+    读取全部人脸裁剪区域, 超过max_bytes时停止
+    Returns:
+        (列表, None) 全部读完; (None, 剩余帧的迭代器(含已读取部分)) 超过大小
+    """
+    buffered, size = [], 0
+    for face_region in face_regions:
+        buffered.append(np.ascontiguousarray(face_region))
+        size += face_region.nbytes
+        if size > max_bytes:
+            return None, itertools.chain(buffered, face_regions)
+    return buffered, None
 
 
-            # point_size = 1
-            # point_color = (0, 0, 255)  # BGR
-            # thickness = 4  # 0 、4、8
-            # for coor in pts_3d[frame_index]:
-            #     # coor = (coor +1 )/2.
-            #     cv2.circle(frame, (int(coor[0]), int(coor[1])), point_size, point_color, thickness)
-            # cv2.imshow("a", frame)
-            # cv2.waitKey(30)
-        # 保存关键点
-        with open(output_pkl_path, "wb") as f:
-            pickle.dump(pts_3d, f)
+def extract_from_video(
+        video_path: str,
+        output_path: str,
+        tracking: bool = True,
+        num_workers: int = None,
+        keyframe_interval: int = None,
+        video_filter: str = None,
+        ref_frame_path: str = None,
+        outputs: list = None
+) -> None:
+    """
+    从视频提取关键点保存为关键点文件(见talkingface/keypoint_store.py), tracking=False时每帧单独检测(旧行为)
+    视频只经ffmpeg管道解码一次(见FramePipe), video_filter为解码时使用的ffmpeg滤镜, 例如video_filter()的返回值
+    num_workers: 进程数, 默认取环境变量DH_PREP_WORKERS或CPU核数, 每段不少于MIN_CHUNK_FRAMES帧
+                 多进程时先把人脸裁剪区域解码到共享内存, 超过DH_FRAME_BUFFER_MB时改为单进程边解码边提取
+    keyframe_interval: 大于1时每隔若干帧检测一次, 中间帧用光流传播(见SparseFaceMeshTracker),
+                       默认取环境变量DH_KEYFRAME_INTERVAL, 未设置时逐帧检测
+    ref_frame_path: 首帧无损保存为PNG, 作为参考图(data_preparation_web)
+    outputs: 与关键点提取共用同一次解码的编码输出, 见FramePipe / web_outputs, 函数返回时已编码完成
+    """
+    from multiprocessing import shared_memory
+    pipe = FramePipe(video_path, video_filter, outputs=outputs)
+    try:
+        frame = pipe.read()
+        if frame is None:
+            raise VideoProcessingError("无法读取视频首帧")
+        vid_width, vid_height = pipe.width, pipe.height
+        face_rect = calc_face_rect(frame, vid_width, vid_height)
+        if ref_frame_path:
+            cv2.imwrite(ref_frame_path, frame)
+        x0, y0, x1, y1 = face_rect
+        face_regions = itertools.chain([frame[y0:y1, x0:x1]], (i[y0:y1, x0:x1] for i in pipe))
+
+        if keyframe_interval is None:
+            keyframe_interval = int(os.getenv("DH_KEYFRAME_INTERVAL", 1))
+        if num_workers is None:
+            num_workers = int(os.getenv("DH_PREP_WORKERS", os.cpu_count() or 1))
+
+        pts_3d = None
+        buffered = None
+        if num_workers > 1:
+            buffered, face_regions = _buffer_frames(face_regions, FRAME_BUFFER_MB * 1024 * 1024)
+        if buffered is not None:
+            pipe.close()
+            frames_shape = (len(buffered),) + buffered[0].shape
+            frames_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(frames_shape)))
+            frames = np.ndarray(frames_shape, dtype=np.uint8, buffer=frames_shm.buf)
+            try:
+                for i in range(len(buffered)):
+                    frames[i] = buffered[i]
+                    buffered[i] = None
+                num_workers = max(1, min(num_workers, len(frames) // MIN_CHUNK_FRAMES))
+                if num_workers > 1:
+                    try:
+                        pts_3d = _extract_chunks(frames_shm, frames_shape, face_rect, tracking, num_workers,
+                                                 keyframe_interval)
+                    except ChunkConsistencyError as e:
+                        print(f"多进程提取结果校验失败, 回退到单进程: {e}")
+                if pts_3d is None:
+                    pts_3d = np.zeros((len(frames), 478, 3))
+                    _extract_range(iter(frames), face_rect, 0, len(frames), 0, tracking, pts_3d, show_progress=True,
+                                   keyframe_interval=keyframe_interval)
+            finally:
+                del frames
+                frames_shm.close()
+                frames_shm.unlink()
+        else:
+            out = []
+            _extract_range(face_regions, face_rect, 0, None, 0, tracking, out, show_progress=True,
+                           keyframe_interval=keyframe_interval)
+            pipe.close()
+            pts_3d = np.array(out).reshape(-1, 478, 3)
+        pipe.wait_outputs()
     finally:
-        cap.release()  # 释放视频对象
+        if pipe.proc.returncode is None:
+            pipe.close(check=False)
+        if pipe.encoder and pipe.encoder.returncode is None:
+            pipe.encoder.kill()
+            pipe.encoder.wait()
+
+    # 保存关键点
+    save_keypoints(output_path, pts_3d, {
+        "fps": pipe.fps,
+        "width": int(vid_width),
+        "height": int(vid_height),
+        "frame_count": len(pts_3d),
+        "face_rect": [int(i) for i in face_rect],
+    })
     return pts_3d
 
 
-def prepare_video(
-        input_path: str,
-        output_path: str,
-        resize_option: bool = False
-) -> int:
-    # 1 视频转换为25FPS
+def video_filter(input_path: str, resize_option: bool = False) -> str:
+    """
+    预处理使用的ffmpeg滤镜: 转换为25FPS, resize_option时缩放到720x1280以内, 宽高取偶数
+    关键点提取(FramePipe)与网页视频编码使用同一滤镜, 保证两者逐帧对应
+    """
+    filters = ["fps=25"]
     if resize_option:
         cap = cv2.VideoCapture(input_path)
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -228,51 +808,133 @@ def prepare_video(
         new_width = new_width //2*2
         new_height = new_height //2*2
         cap.release()
-        vf_arg = f"scale={new_width}:{new_height}"
-        cmd = [
-            "ffmpeg", "-i", input_path,
-            "-vf", vf_arg,
-            "-r", "25", "-an", "-y", output_path
-        ]
-    else:
-        cmd = [
-            "ffmpeg", "-i", input_path,
-            "-r", "25", "-an", "-y", output_path
-        ]
-    try:
-        result = subprocess.run(
-            cmd,
-            check=True,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            text=True
-        )
-        return 0
-    except subprocess.CalledProcessError as e:
-        raise FFmpegError(f"FFmpeg处理失败: {e.stderr}") from e
+        filters.append(f"scale={new_width}:{new_height}")
+    filters.append("crop=trunc(iw/2)*2:trunc(ih/2)*2")
+    return ",".join(filters)
+
+
+def trim_to_loop(input_path: str, vf: str, output_video: str, output_keypoints: str, pts_3d: np.ndarray):
+    """
+    在关键点轨迹中选取适合往返循环播放的片段(见talkingface/loop_segment.py), 满足条件时视频和关键点只保留该片段
+    视频从上传视频按同一滤镜重新编码该片段, 帧号与关键点一一对应, 不经过二次有损压缩
+    Returns:
+        选取的片段, 不裁剪时为None
+    """
+    meta = load_keypoint_meta(output_keypoints)
+    segment = loop_segment.select_loop_segment(pts_3d, meta["fps"])
+    if segment is None:
+        print("没有满足条件的循环片段, 使用完整视频({}帧)".format(len(pts_3d)))
+        return None
+    start, end = segment["start"], segment["end"]
+    tmp_video = os.path.splitext(output_video)[0] + ".loop.mp4"
+    wait_encode(start_encode(input_path, tmp_video, f"{vf},trim=start_frame={start}:end_frame={end},setpts=PTS-STARTPTS"))
+    os.replace(tmp_video, output_video)
+    meta["frame_count"] = end - start
+    meta["loop"] = dict(segment, source_frames=len(pts_3d))
+    save_keypoints(output_keypoints, pts_3d[start:end], meta)
+    print("循环片段: [{}, {}) {}/{}帧, 首尾速度{:.4f}, 姿态变化{:.4f}".format(
+        start, end, end - start, len(pts_3d), segment["seam_speed"], segment["pose_std"]))
+    return segment
+
+
+_encoders = {}
+
+
+def has_encoder(name: str) -> bool:
+    """ffmpeg是否支持该编码器(例如libvpx-vp9), 进程内只查询一次"""
+    if name not in _encoders:
+        try:
+            encoders = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL, text=True).stdout
+        except OSError:
+            encoders = ""
+        _encoders[name] = any(len(i.split()) > 1 and i.split()[1] == name for i in encoders.splitlines())
+    return _encoders[name]
+
+
+def web_outputs(output_video: str, output_webm: str = None) -> list:
+    """
+    用关键点提取解码出的帧编码的输出(FramePipe的outputs):
+    - output_video: 网页播放的视频(01.mp4), 与关键点逐帧对应
+    - output_webm: 移动端自动播放的示例视频(正放+倒放, VP9), 为None时不生成
+    """
+    outputs = [(None, ["-an", "-y", output_video])]
+    if output_webm:
+        outputs.append((
+            f"scale={WEBM_WIDTH}:-2:flags=lanczos,split[w0][w1];[w0]reverse[wr];[w1][wr]concat",
+            ["-c:v", "libvpx-vp9", "-crf", str(WEBM_CRF), "-b:v", WEBM_BITRATE, "-row-mt", "1",
+             "-quality", "good", "-cpu-used", "4", "-an", "-loop", "0", "-y", output_webm]))
+    return outputs
+
+
+def start_encode(input_path: str, output_path: str, vf: str) -> subprocess.Popen:
+    """后台单独解码并编码视频(循环片段裁剪、prepare_video), 用wait_encode等待结束"""
+    cmd = [
+        "ffmpeg", "-loglevel", "error", "-i", input_path,
+        "-vf", vf,
+        "-an", "-y", output_path
+    ]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+def wait_encode(proc: subprocess.Popen) -> int:
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise FFmpegError(f"FFmpeg处理失败: {stderr}")
+    return 0
+
 
+def prepare_video(
+        input_path: str,
+        output_path: str,
+        resize_option: bool = False
+) -> int:
+    # 1 视频转换为25FPS
+    return wait_encode(start_encode(input_path, output_path, video_filter(input_path, resize_option)))
 
 
-def data_preparation_mini(input_video, video_dir_path, resize_option = False):
+def check_ffmpeg():
     # 检测系统环境是否有ffmpeg
     if not shutil.which("ffmpeg"):
         raise EnvironmentError("FFmpeg未安装或不在PATH中，请安装ffmpeg并设置为环境变量")
 
+
+def data_preparation_mini(input_video, video_dir_path, resize_option = False):
+    check_ffmpeg()
+
     # 创建输出目录
     data_dir = os.path.join(video_dir_path, "data")
     os.makedirs(data_dir, exist_ok=True)
 
-    # 预处理视频
     output_video = os.path.join(data_dir, "processed.mp4")
-    prepare_video(input_video, output_video, resize_option = resize_option)
-
-    # 提取关键点
-    output_pkl = output_video.replace(".mp4", ".pkl")
-    extract_from_video(output_video, output_pkl)
+    output_keypoints = keypoint_path(output_video)
+    ref_frame = os.path.join(data_dir, "ref_frame.png")
+    # 参考图(首帧)的关键点单独保存, 视频裁剪为循环片段后processed.kps不再包含首帧
+    ref_keypoints = keypoint_path(ref_frame)
+    # 示例视频需要ffmpeg支持VP9编码, 不支持时跳过(非关键输出)
+    output_webm = os.path.join(data_dir, "example.webm") if has_encoder("libvpx-vp9") else None
+    vf = video_filter(input_video, resize_option)
+
+    def run():
+        # 上传视频只解码一次: 解码出的帧同时用于关键点提取和01.mp4、example.webm的编码
+        pts_3d = extract_from_video(input_video, output_keypoints, video_filter=vf, ref_frame_path=ref_frame,
+                                    outputs=web_outputs(output_video, output_webm))
+        save_keypoints(ref_keypoints, pts_3d[:1], load_keypoint_meta(output_keypoints))
+        if loop_segment.LOOP_SELECT:
+            trim_to_loop(input_video, vf, output_video, output_keypoints, pts_3d)
+
+    # 同一视频、同样参数重新训练时直接使用检查点中的视频和关键点(见talkingface/stage_cache.py)
+    key = stage_key("prep_mini", file_digest(input_video), vf, output_webm is not None,
+                    code_version(*PREP_MINI_SOURCES), env_values(PREP_MINI_ENV))
+    outputs = [output_video, output_keypoints, ref_frame, ref_keypoints] + ([output_webm] if output_webm else [])
+    run_stage("prep_mini", key, data_dir, [os.path.basename(i) for i in outputs], run)
     result = {
         "status": "success",
         "output_video": output_video,
-        "output_pkl": output_pkl
+        "output_keypoints": output_keypoints,
+        "ref_frame": ref_frame,
+        "ref_keypoints": ref_keypoints,
+        "output_webm": output_webm
     }
     return result
 
@@ -286,6 +948,7 @@ def main():
     video = sys.argv[1]
     video_dir_path = sys.argv[2]
     print(f"Video dir path is set to: {video_dir_path}")
+    validate_video(video)
     data_preparation_mini(video, video_dir_path)
     print("Done!")
 
@@ -4,42 +4,47 @@ import numpy as np
 import cv2
 import sys
 import os
-import gzip
 from talkingface.data.few_shot_dataset import get_image
 import shutil
 from talkingface.utils import crop_mouth, main_keypoints_index, smooth_array,normalizeLips
-import json
+from talkingface.batch_utils import crop_mouth_rects, project_keypoints
 from mini_live.obj.wrap_utils import index_wrap, index_edge_wrap
-import pickle
+from talkingface.keypoint_store import load_keypoints, load_keypoint_meta, keypoint_path
+from talkingface.avatar_data import write_avatar_data
+from talkingface.stage_cache import run_stage, stage_key, file_digest, code_version, PREP_WEB_SOURCES
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
 
 
 def step0_keypoints(video_path, out_path):
-    Path_output_pkl = video_path + "/processed.pkl"
-    with open(Path_output_pkl, "rb") as f:
-        pts_3d = pickle.load(f)
+    pts_3d = load_keypoints(video_path + "/processed.kps")
 
     pts_3d = pts_3d.reshape(len(pts_3d), -1)
     smooth_array_ = smooth_array(pts_3d, weight=[0.02, 0.09, 0.78, 0.09, 0.02])
     pts_3d = smooth_array_.reshape(len(pts_3d), 478, 3)
 
+    # 视频宽高记录在关键点文件中, 不需要再打开视频
+    meta = load_keypoint_meta(video_path + "/processed.kps")
+    vid_width = float(meta["width"])  # 宽度
+    vid_height = float(meta["height"])  # 高度
+    return pts_3d,vid_width,vid_height
+
+def move_video(video_path, out_path):
+    # 示例视频(example.webm)与01.mp4在data_preparation_mini中同一次解码生成, 没有生成时跳过
+    webm_path = os.path.join(video_path, "example.webm")
+    if os.path.isfile(webm_path):
+        shutil.move(webm_path, os.path.join(out_path, "example.webm"))
     video_path = os.path.join(video_path, "processed.mp4")
-    cap = cv2.VideoCapture(video_path)
-    vid_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)  # 宽度
-    vid_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)  # 高度
-    cap.release()
     out_path = os.path.join(out_path, "01.mp4")
     try:
-        # 复制文件
-        shutil.copy(video_path, out_path)
-        print(f"视频已成功复制到 {out_path}")
+        # data目录处理完后会删除, 直接移动文件
+        shutil.move(video_path, out_path)
+        print(f"视频已成功移动到 {out_path}")
     except Exception as e:
-        print(f"复制文件时出错: {e}")
-    return pts_3d,vid_width,vid_height
+        print(f"移动文件时出错: {e}")
 
 def step1_crop_mouth(pts_3d, vid_width, vid_height):
-    list_source_crop_rect = [crop_mouth(source_pts[main_keypoints_index], vid_width, vid_height) for source_pts in
-                             pts_3d]
-    list_source_crop_rect = np.array(list_source_crop_rect).reshape(len(pts_3d), -1)
+    list_source_crop_rect = crop_mouth_rects(pts_3d[:, main_keypoints_index], vid_width, vid_height)
     face_size = (list_source_crop_rect[:,2] - list_source_crop_rect[:,0]).mean()/2.0 + (list_source_crop_rect[:,3] - list_source_crop_rect[:,1]).mean()/2.0
     face_size = int(face_size)//2 * 2
     face_mid = (list_source_crop_rect[:,2:] + list_source_crop_rect[:,0:2])/2.
@@ -56,60 +61,46 @@ def step1_crop_mouth(pts_3d, vid_width, vid_height):
     # pd.DataFrame(list_source_crop_rect).to_csv("sss.csv")
 
     standard_size = 128
-    list_standard_v = []
-    for frame_index in range(len(list_source_crop_rect)):
-        source_pts = pts_3d[frame_index]
-        source_crop_rect = list_source_crop_rect[frame_index]
-        print(source_crop_rect)
-        standard_v = get_image(source_pts, source_crop_rect, input_type="mediapipe", resize=standard_size)
-
-        list_standard_v.append(standard_v)
+    list_standard_v = project_keypoints(pts_3d, list_source_crop_rect, resize=standard_size)
 
     return list_source_crop_rect, list_standard_v
 
 def generate_combined_data(list_source_crop_rect, list_standard_v, video_path, out_path):
-    from mini_live.obj.obj_utils import generateRenderInfo, generateWrapModel
+    from talkingface.asset_bundle import get_asset
     from talkingface.run_utils import calc_face_mat
     from mini_live.obj.wrap_utils import newWrapModel
-    from talkingface.render_model_mini import RenderModel_Mini
+    from talkingface.ref_encoder import get_ref_encoder
 
     # Step 2: Generate face3D.obj data
-    render_verts, render_face = generateRenderInfo()
+    render_verts = get_asset("render_verts")
     face_pts_mean = render_verts[:478, :3].copy()
 
-    wrapModel_verts, wrapModel_face = generateWrapModel()
+    wrapModel_verts, wrapModel_face = get_asset("wrap_verts").copy(), get_asset("wrap_face").tolist()
     mat_list, _, face_pts_mean_personal_primer = calc_face_mat(np.array(list_standard_v), face_pts_mean)
 
     # face_pts_mean_personal_primer[INDEX_MP_LIPS] = face_pts_mean[INDEX_MP_LIPS] * 0.33 + face_pts_mean_personal_primer[INDEX_MP_LIPS] * 0.66
     face_pts_mean_personal_primer = normalizeLips(face_pts_mean_personal_primer, face_pts_mean)
     face_wrap_entity = newWrapModel(wrapModel_verts, face_pts_mean_personal_primer)
 
-    face3D_data = []
-    for i in face_wrap_entity:
-        face3D_data.append("v {:.3f} {:.3f} {:.3f} {:.02f} {:.0f}\n".format(i[0], i[1], i[2], i[3], i[4]))
-    for i in range(len(wrapModel_face) // 3):
-        face3D_data.append("f {0} {1} {2}\n".format(wrapModel_face[3 * i] + 1, wrapModel_face[3 * i + 1] + 1,
-                                                   wrapModel_face[3 * i + 2] + 1))
-
     # Step 3: Generate ref_data.txt data
-    renderModel_mini = RenderModel_Mini()
-    renderModel_mini.loadModel("checkpoint/DINet_mini/epoch_40.pth")
-
-    Path_output_pkl = "{}/processed.pkl".format(video_path)
-    with open(Path_output_pkl, "rb") as f:
-        ref_images_info = pickle.load(f)
-
-    video_path = "{}/processed.mp4".format(video_path)
-    cap = cv2.VideoCapture(video_path)
-    vid_frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    assert vid_frame_count > 0, "处理后的视频无有效帧"
-    vid_width_ref = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    vid_height_ref = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    meta = load_keypoint_meta("{}/processed.kps".format(video_path))
+    assert meta["frame_count"] > 0, "处理后的视频无有效帧"
+    vid_width_ref = int(meta["width"])
+    vid_height_ref = int(meta["height"])
 
     standard_size = 128
     frame_index = 0
-    ret, frame = cap.read()
-    cap.release()
+    # 参考图取data_preparation_mini解码时无损保存的首帧, 旧数据没有时从视频(step0已移动到01.mp4)读取
+    # 视频可能已裁剪为循环片段(processed.kps不含原视频首帧), 首帧关键点单独保存在ref_frame.kps
+    frame = cv2.imread("{}/ref_frame.png".format(video_path))
+    ref_keypoints = "{}/ref_frame.kps".format(video_path)
+    if frame is None or not os.path.isfile(ref_keypoints):
+        if frame is None:
+            cap = cv2.VideoCapture(os.path.join(out_path, "01.mp4"))
+            ret, frame = cap.read()
+            cap.release()
+        ref_keypoints = "{}/processed.kps".format(video_path)
+    ref_images_info = load_keypoints(ref_keypoints)
     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
     source_pts = ref_images_info[frame_index]
     source_crop_rect = crop_mouth(source_pts[main_keypoints_index], vid_width_ref, vid_height_ref)
@@ -117,48 +108,38 @@ def generate_combined_data(list_source_crop_rect, list_standard_v, video_path, o
     standard_img = get_image(frame, source_crop_rect, input_type="image", resize=standard_size)
     standard_v = get_image(source_pts, source_crop_rect, input_type="mediapipe", resize=standard_size)
 
+    # 参考图编码器进程内常驻, 同时预处理的多个数字人合并为一个batch(见talkingface/ref_encoder.py)
+    ref_in_feature = get_ref_encoder().encode(standard_img, standard_v[main_keypoints_index], standard_size=standard_size)
 
-    renderModel_mini.reset_charactor(standard_img, standard_v[main_keypoints_index], standard_size=standard_size)
-
-    ref_in_feature = renderModel_mini.net.infer_model.ref_in_feature
-    ref_in_feature = ref_in_feature.detach().squeeze(0).cpu().float().numpy().flatten()
-    # cv2.imwrite(os.path.join(out_path, 'ref.png'), renderModel_mini.ref_img_save)
-    rounded_array = np.round(ref_in_feature, 6)
-
-    # Combine all data into a single JSON object
-    combined_data = {
-        "uid": "matesx_" + str(uuid.uuid4()),
-        "frame_num": len(list_standard_v),
-        "face3D_obj": face3D_data,
-        "ref_data": rounded_array.tolist(),
-        "json_data": [],
-        "authorized": False,
-    }
-
-    for frame_index in range(len(list_source_crop_rect)):
-        source_crop_rect = list_source_crop_rect[frame_index]
-        standard_v = list_standard_v[frame_index]
-
-        standard_v = standard_v[index_wrap, :2].flatten().tolist()
-        mat = mat_list[frame_index].T.flatten().tolist()
-        standard_v_rounded = [round(i, 5) for i in mat] + [round(i, 1) for i in standard_v]
-        combined_data["json_data"].append({"rect": source_crop_rect.tolist(), "points": standard_v_rounded})
-
-    # with open(os.path.join(out_path, "combined_data.json"), "w") as f:
-    #     json.dump(combined_data, f)
+    # Step 4: 保存为二进制数据文件(格式见talkingface/avatar_data.py)
+    mats = np.array([mat.T.flatten() for mat in mat_list])
+    points = np.asarray(list_standard_v)[:, index_wrap, :2].reshape(len(list_standard_v), -1)
+    write_avatar_data(os.path.join(out_path, "data"), "matesx_" + str(uuid.uuid4()), face_wrap_entity,
+                      np.array(wrapModel_face).reshape(-1, 3), ref_in_feature, mats, points, list_source_crop_rect)
 
-    # Save as Gzip compressed JSON
-    output_file = os.path.join(out_path, "data")
-    with gzip.open(output_file, 'wt', encoding='UTF-8') as f:
-        json.dump(combined_data, f)
+def warmup():
+    # 加载常驻的参考图编码器, api_server后台预热preparation时调用
+    from talkingface.ref_encoder import get_ref_encoder
+    get_ref_encoder()
 
 def data_preparation_web(path):
     video_path = os.path.join(path, "data")
     out_path = os.path.join(path, "assets")
     os.makedirs(out_path, exist_ok=True)
-    pts_3d, vid_width,vid_height = step0_keypoints(video_path, out_path)
-    list_source_crop_rect, list_standard_v = step1_crop_mouth(pts_3d, vid_width, vid_height)
-    generate_combined_data(list_source_crop_rect, list_standard_v, video_path, out_path)
+    move_video(video_path, out_path)
+
+    def run():
+        pts_3d, vid_width,vid_height = step0_keypoints(video_path, out_path)
+        list_source_crop_rect, list_standard_v = step1_crop_mouth(pts_3d, vid_width, vid_height)
+        generate_combined_data(list_source_crop_rect, list_standard_v, video_path, out_path)
+
+    # 数据文件只由关键点和参考图决定, 两者不变时直接使用检查点(见talkingface/stage_cache.py)
+    ref_frame = os.path.join(video_path, "ref_frame.png")
+    key = stage_key("prep_web", file_digest(os.path.join(video_path, "processed.kps")),
+                    [file_digest(i) for i in [ref_frame, keypoint_path(ref_frame)] if os.path.isfile(i)]
+                    if os.path.isfile(ref_frame) else file_digest(os.path.join(out_path, "01.mp4")),
+                    code_version(*PREP_WEB_SOURCES))
+    run_stage("prep_web", key, out_path, ["data"], run)
     shutil.rmtree(video_path)
 
 def main():
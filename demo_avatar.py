@@ -13,7 +13,7 @@ audioModel.loadModel("checkpoint/audio.pkl")
 renderModel = RenderModel()
 renderModel.loadModel("checkpoint/render.pth")
 test_video = "test"
-pkl_path = "video_data/{}/keypoint_rotate.pkl".format(test_video)
+pkl_path = "video_data/{}/keypoint_rotate.kps".format(test_video)
 video_path = "video_data/{}/circle.mp4".format(test_video)
 renderModel.reset_charactor(video_path, pkl_path)
 
@@ -30,9 +30,8 @@ with sd.InputStream(
     while True:
         samples, _ = s.read(samples_per_read)  # a blocking read
         pcm_data = samples.reshape(-1)
-        print(pcm_data.shape)
         mouth_frame = audioModel.interface_frame(pcm_data)
         frame = renderModel.interface(mouth_frame)
         cv2.imshow("s", frame)
-        cv2.waitKey(10)
+        cv2.waitKey(1)
         index_ += 1
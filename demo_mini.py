@@ -1,7 +1,5 @@
 import os
 import uuid
-import gzip
-import json
 import cv2
 import numpy as np
 import sys
@@ -11,6 +9,7 @@ from talkingface.data.few_shot_dataset import get_image
 from mini_live.render import create_render_model
 from talkingface.models.DINet_mini import input_height,input_width
 from talkingface.model_utils import device
+from talkingface.avatar_data import load_avatar_data
 def interface_mini(path, wav_path, output_video_path):
     # 加载音频模型
     Audio2FeatureModel = LoadAudioModel(r'checkpoint/lstm/lstm_model_epoch_325.pkl')
@@ -28,15 +27,9 @@ def interface_mini(path, wav_path, output_video_path):
     out_size = (out_w, out_h)
     renderModel_gl = create_render_model((out_w, out_h), floor=20)
 
-    # 读取 Gzip 压缩的 JSON 文件
-    combined_data_path = os.path.join(path, "combined_data.json.gz")
-    with gzip.open(combined_data_path, 'rt', encoding='UTF-8') as f:
-        combined_data = json.load(f)
-
-    # 从 combined_data 中提取数据
-    face3D_obj = combined_data["face3D_obj"]
-    json_data = combined_data["json_data"]
-    ref_data = np.array(combined_data["ref_data"], dtype=np.float32).reshape([1, 20, input_height//4, input_width//4])
+    # 读取数字人数据(assets/data, 兼容旧的combined_data.json.gz)
+    avatar_data = load_avatar_data(path)
+    ref_data = avatar_data["ref_data"].reshape([1, 20, input_height//4, input_width//4])
 
     # 设置 ref_data 到渲染模型
     renderModel_mini.net.infer_model.ref_in_feature = torch.from_numpy(ref_data).float().to(device)
@@ -55,11 +48,11 @@ def interface_mini(path, wav_path, output_video_path):
     list_standard_v = []
 
     # 处理每一帧
-    for frame_index in range(min(vid_frame_count, len(json_data))):
+    for frame_index in range(min(vid_frame_count, avatar_data["frame_num"])):
         ret, frame = cap.read()
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
-        standard_v = json_data[frame_index]["points"][16:]
-        source_crop_rect = json_data[frame_index]["rect"]
+        standard_v = avatar_data["points"][frame_index]
+        source_crop_rect = avatar_data["rects"][frame_index]
 
         standard_img = get_image(frame, source_crop_rect, input_type="image", resize=standard_size)
 
@@ -70,7 +63,7 @@ def interface_mini(path, wav_path, output_video_path):
     cap.release()
 
     # 生成矩阵列表
-    mat_list = [np.array(i["points"][:16]).reshape(4, 4) * 2 for i in json_data]
+    mat_list = [i.reshape(4, 4) * 2 for i in avatar_data["mats"]]
 
     # 反转列表中的数据
     list_video_img_reversed = list_video_img[::-1]
@@ -86,17 +79,7 @@ def interface_mini(path, wav_path, output_video_path):
     list_standard_v = list_standard_v + list_standard_v_reversed
     mat_list = mat_list + mat_list_reversed
 
-    # 解析 face3D.obj 数据
-    v_ = []
-    for line in face3D_obj:
-        if line.startswith("v "):
-            v0, v1, v2, v3, v4 = line[2:].split()
-            v_.append(float(v0))
-            v_.append(float(v1))
-            v_.append(float(v2))
-            v_.append(float(v3))
-            v_.append(float(v4))
-    face_wrap_entity = np.array(v_).reshape(-1, 5)
+    face_wrap_entity = avatar_data["face_verts"]
 
     # 生成 VBO
     renderModel_gl.GenVBO(face_wrap_entity)
@@ -129,7 +129,6 @@ def crop_mouth(mouth_pts, mat_list__):
     center_y = (y_min + y_max) /2.
     x_min, y_min, x_max, y_max = int(center_x - border_width_half), int(center_y - border_width_half*0.75), int(
         center_x + border_width_half), int(center_y + border_width_half*0.75)
-    print([x_min, y_min, x_max, y_max])
 
     # pts = np.array([
     #     [x_min, y_min],
@@ -19,7 +19,6 @@ class RenderModel_gl:
         if not glfw.init():
             raise Exception("glfw can not be initialized!")
         glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
-        print(window_size[0], window_size[1])
         self.window = glfw.create_window(window_size[0], window_size[1], "Face Render window", None, None)
         if not self.window:
             glfw.terminate()
@@ -149,12 +148,13 @@ class RenderModel_gl:
 def create_render_model(out_size = (384, 384), floor = 5):
     renderModel_gl = RenderModel_gl(out_size)
 
-    image2 = cv2.imread(os.path.join(current_dir, "bs_texture_halfFace.png"))
-    image2 = cv2.cvtColor(image2, cv2.COLOR_BGR2RGBA)
+    # 网格和贴图从静态资源包读取, 见talkingface/asset_bundle.py
+    from talkingface.asset_bundle import get_asset
+    image2 = np.ascontiguousarray(get_asset("bs_texture"))
     renderModel_gl.GenTexture(image2, GL_TEXTURE0)
 
-    render_verts, render_face = generateRenderInfo()
-    wrapModel_verts,wrapModel_face = generateWrapModel()
+    render_verts, render_face = get_asset("render_verts").copy(), get_asset("render_face").tolist()
+    wrapModel_verts,wrapModel_face = get_asset("wrap_verts").copy(), get_asset("wrap_face").tolist()
 
     renderModel_gl.setContent(wrapModel_verts, wrapModel_face)
     renderModel_gl.render_verts = render_verts
@@ -164,7 +164,6 @@ def create_render_model(out_size = (384, 384), floor = 5):
 
 # 示例使用
 if __name__ == "__main__":
-    import pickle
     import cv2
     import time
     import numpy as np
@@ -197,9 +196,8 @@ if __name__ == "__main__":
     video_list = os.listdir(r"{}".format(path))
     print(video_list)
     for test_video in video_list[:10]:
-        Path_output_pkl = "{}/{}/keypoint_rotate.pkl".format(path, test_video)
-        with open(Path_output_pkl, "rb") as f:
-            images_info = pickle.load(f)
+        from talkingface.keypoint_store import load_keypoints
+        images_info = load_keypoints("{}/{}/keypoint_rotate.kps".format(path, test_video))
 
         images_info = np.concatenate([images_info, images_info[::-1]], axis=0)
 
@@ -0,0 +1,176 @@
+'''
+静态资源打包
+
+启动时用到的静态资源(OBJ网格、融合mask、bs贴图、pca.pkl、牙齿参考图)编译成一个二进制文件,
+加载时按mmap方式读取, 不再解析OBJ文本、读PNG或反序列化sklearn对象。
+
+文件格式: b"DHAB" + uint32版本号 + uint32 header长度 + JSON header + 64字节对齐的原始数组数据
+header记录每个数组的dtype/shape/offset以及编译时各源文件的大小/修改时间/sha1, 源文件变化后自动回退到现场编译
+
+Usage: python -m talkingface.asset_bundle [<bundle_path>]
+'''
+import os
+import sys
+import json
+import struct
+import glob
+import hashlib
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+
+BUNDLE_MAGIC = b"DHAB"
+BUNDLE_VERSION = 1
+BUNDLE_PATH = os.path.join(root_dir, "data", "static_assets.bin")
+_ALIGN = 64
+
+_OBJ_DIR = os.path.join(root_dir, "mini_live", "obj", "obj_mediapipe")
+_TEETH_REF_DIR = os.path.join(root_dir, "video_data", "teeth_ref")
+
+
+def _source_files():
+    return [
+        os.path.join(_OBJ_DIR, "face3D.obj"),
+        os.path.join(_OBJ_DIR, "modified_teeth_upper.obj"),
+        os.path.join(_OBJ_DIR, "modified_teeth_lower.obj"),
+        os.path.join(_OBJ_DIR, "face_wrap_entity.obj"),
+        os.path.join(root_dir, "mini_live", "face_fusion_mask.png"),
+        os.path.join(root_dir, "mini_live", "mouth_fusion_mask.png"),
+        os.path.join(root_dir, "mini_live", "bs_texture_halfFace.png"),
+        os.path.join(root_dir, "data", "pca.pkl"),
+    ] + sorted(glob.glob(os.path.join(_TEETH_REF_DIR, "*.png")))
+
+
+def _source_stats():
+    stats = {}
+    for path in _source_files():
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        stats[os.path.relpath(path, root_dir).replace("\\", "/")] = [st.st_size, st.st_mtime_ns, digest]
+    return stats
+
+
+def _sources_changed(sources):
+    # 先比较大小和修改时间, 只有修改时间变了(例如重新checkout)才计算sha1; 源文件缺失时抛出FileNotFoundError
+    for key, (size, mtime_ns, digest) in sources.items():
+        path = os.path.join(root_dir, key)
+        st = os.stat(path)
+        if st.st_size != size:
+            return True
+        if st.st_mtime_ns != mtime_ns:
+            with open(path, "rb") as f:
+                if hashlib.sha1(f.read()).hexdigest() != digest:
+                    return True
+    # 新增了牙齿参考图
+    return len(_source_files()) != len(sources)
+
+
+def compile_assets():
+    '''
+    从源文件编译所有静态资源
+    Returns:
+        dict: name -> np.ndarray
+    '''
+    import cv2
+    import pickle
+    from mini_live.obj.obj_utils import generateRenderInfo, generateWrapModel
+
+    render_verts, render_face = generateRenderInfo()
+    wrap_verts, wrap_face = generateWrapModel()
+    with open(os.path.join(root_dir, "data", "pca.pkl"), "rb") as f:
+        pca = pickle.load(f)
+    teeth_ref_paths = sorted(glob.glob(os.path.join(_TEETH_REF_DIR, "*.png")))
+    return {
+        "render_verts": render_verts,
+        "render_face": np.array(render_face, dtype=np.int32),
+        "wrap_verts": wrap_verts,
+        "wrap_face": np.array(wrap_face, dtype=np.int32),
+        "face_fusion_mask": cv2.imread(os.path.join(root_dir, "mini_live", "face_fusion_mask.png"))[:, :, 0],
+        "mouth_fusion_mask": cv2.imread(os.path.join(root_dir, "mini_live", "mouth_fusion_mask.png"))[:, :, 0],
+        "bs_texture": cv2.cvtColor(cv2.imread(os.path.join(root_dir, "mini_live", "bs_texture_halfFace.png")), cv2.COLOR_BGR2RGBA),
+        "pca_mean": np.asarray(pca.mean_),
+        "pca_components": np.asarray(pca.components_),
+        "teeth_ref": np.stack([cv2.imread(i, cv2.IMREAD_UNCHANGED) for i in teeth_ref_paths]),
+    }
+
+
+def build_asset_bundle(bundle_path = BUNDLE_PATH):
+    assets = compile_assets()
+    arrays = {}
+    offset = 0
+    for name, array in assets.items():
+        array = np.ascontiguousarray(array)
+        assets[name] = array
+        arrays[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += (array.nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+    header = json.dumps({"version": BUNDLE_VERSION, "sources": _source_stats(), "arrays": arrays}).encode("utf-8")
+    data_start = (12 + len(header) + _ALIGN - 1) // _ALIGN * _ALIGN
+    header = header + b" " * (data_start - 12 - len(header))
+
+    tmp_path = bundle_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(BUNDLE_MAGIC + struct.pack("<II", BUNDLE_VERSION, len(header)) + header)
+        for name, array in assets.items():
+            f.seek(data_start + arrays[name]["offset"])
+            f.write(array.tobytes())
+    os.replace(tmp_path, bundle_path)
+    return bundle_path
+
+
+def load_asset_bundle(bundle_path = BUNDLE_PATH, check_sources = True):
+    '''
+    读取资源包, 数组为只读memmap; 文件不存在、版本不符或源文件已修改时返回None
+    '''
+    if not os.path.isfile(bundle_path):
+        return None
+    with open(bundle_path, "rb") as f:
+        magic = f.read(4)
+        version, header_len = struct.unpack("<II", f.read(8))
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            return None
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    if check_sources:
+        try:
+            if _sources_changed(header["sources"]):
+                return None
+        except FileNotFoundError:
+            # 部署时可以只带资源包, 不带源文件
+            pass
+    data_start = 12 + header_len
+    mm = np.memmap(bundle_path, dtype=np.uint8, mode="r")
+    assets = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        start = data_start + info["offset"]
+        assets[name] = mm[start:start + count * dtype.itemsize].view(dtype).reshape(info["shape"])
+    return assets
+
+
+_assets = None
+
+
+def get_asset(name):
+    '''
+    读取单个静态资源, 返回只读数组(需要修改时调用方自行copy)
+    资源包不可用时现场编译一次并缓存在进程内
+    '''
+    global _assets
+    if _assets is None:
+        _assets = load_asset_bundle()
+        if _assets is None:
+            print("静态资源包不存在或已过期, 从源文件编译, 可运行 python -m talkingface.asset_bundle 生成")
+            _assets = compile_assets()
+    return _assets[name]
+
+
+def main():
+    bundle_path = sys.argv[1] if len(sys.argv) > 1 else BUNDLE_PATH
+    build_asset_bundle(bundle_path)
+    print("已生成: {} ({:.2f} MB)".format(bundle_path, os.path.getsize(bundle_path) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ import kaldi_native_fbank as knf
 from scipy.io import wavfile
 import torch
 import pickle
-from model_utils import device
+from talkingface.model_utils import device
 import pickle
 import os
 def pca_process(x):
@@ -21,18 +21,16 @@ class AudioModel:
         self.__fbank_processed_index = 0
         self.frame_index = 0
 
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        Path_output_pkl = os.path.join(current_dir, "../data/pca.pkl")
-        with open(Path_output_pkl, "rb") as f:
-            pca = pickle.load(f)
-        self.pca_mean_ = pca_process(pca.mean_)
-        self.pca_components_ = np.zeros_like(pca.components_)
-        self.pca_components_[0] = pca_process(pca.components_[0])
-        self.pca_components_[1] = pca_process(pca.components_[1])
-        self.pca_components_[2] = pca_process(pca.components_[2])
-        self.pca_components_[3] = pca_process(pca.components_[3])
-        self.pca_components_[4] = pca_process(pca.components_[4])
-        self.pca_components_[5] = pca_process(pca.components_[5])
+        # pca.pkl已编译进静态资源包, 无需sklearn反序列化
+        from talkingface.asset_bundle import get_asset
+        pca_components = get_asset("pca_components")
+        self.pca_mean_ = pca_process(np.array(get_asset("pca_mean")))
+        self.pca_components_ = np.zeros_like(pca_components)
+        for i in range(6):
+            self.pca_components_[i] = pca_process(np.array(pca_components[i]))
+        # 推理时只用到前6个主成分，提前转成float32连续内存
+        self.pca_components_6 = np.ascontiguousarray(self.pca_components_[:6], dtype=np.float32)
+        self.pca_mean_32 = self.pca_mean_.astype(np.float32)
 
         self.reset()
 
@@ -74,12 +72,13 @@ class AudioModel:
         orig_mel[1] = self.__fbank.get_frame(self.__fbank_processed_index + 1)
 
         input = torch.from_numpy(orig_mel).unsqueeze(0).float().to(device)
-        bs_array, self.h0, self.c0 = self.__net(input, self.h0, self.c0)
-        bs_array = bs_array[0].detach().cpu().float().numpy()
+        with torch.no_grad():
+            bs_array, self.h0, self.c0 = self.__net(input, self.h0, self.c0)
+        bs_array = bs_array[0].cpu().float().numpy()
         bs_real = bs_array[0]
         # print(self.__fbank_processed_index, self.__fbank.num_frames_ready, bs_real)
 
-        frame = np.dot(bs_real[:6], self.pca_components_[:6]) + self.pca_mean_
+        frame = np.dot(bs_real[:6], self.pca_components_6) + self.pca_mean_32
         # print(frame_index, frame.shape)
         frame = frame.reshape(15, 30, 3).clip(0, 255).astype(np.uint8)
         self.__fbank_processed_index += 2
@@ -101,29 +100,20 @@ class AudioModel:
         fbank = knf.OnlineFbank(opts)
         fbank.accept_waveform(16000, augmented_samples2.tolist())
         seq_len = fbank.num_frames_ready // 2
-        A2Lsamples = np.zeros([2 * seq_len, 80])
-        for i in range(2 * seq_len):
-            f2 = fbank.get_frame(i)
-            A2Lsamples[i] = f2
+        A2Lsamples = np.array([fbank.get_frame(i) for i in range(2 * seq_len)], dtype=np.float32).reshape(-1, 80)
 
         orig_mel = A2Lsamples
         # print(orig_mel.shape)
-        input = torch.from_numpy(orig_mel).unsqueeze(0).float().to(device)
+        input = torch.from_numpy(orig_mel).unsqueeze(0).to(device)
         # print(input.shape)
         h0 = torch.zeros(2, 1, 192).to(device)
         c0 = torch.zeros(2, 1, 192).to(device)
-        bs_array, hn, cn = self.__net(input, h0, c0)
-        bs_array = bs_array[0].detach().cpu().float().numpy()
+        with torch.no_grad():
+            bs_array, hn, cn = self.__net(input, h0, c0)
+        bs_array = bs_array[0].cpu().float().numpy()
         bs_array = bs_array[4:]
 
-        frame_num = len(bs_array)
-        output = np.zeros([frame_num, 15, 30, 3], dtype = np.uint8)
-        for frame_index in range(frame_num):
-            bs_real = bs_array[frame_index]
-            # bs_real[1:4] = - bs_real[1:4]
-            frame = np.dot(bs_real[:6], self.pca_components_[:6]) + self.pca_mean_
-            # print(frame_index, frame.shape)
-            frame = frame.reshape(15, 30, 3).clip(0, 255).astype(np.uint8)
-            output[frame_index] = frame
-
+        # 所有帧的PCA反投影一次矩阵乘法完成
+        output = bs_array[:, :6].dot(self.pca_components_6) + self.pca_mean_32
+        output = output.reshape(-1, 15, 30, 3).clip(0, 255).astype(np.uint8)
         return output
\ No newline at end of file
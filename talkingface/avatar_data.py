@@ -0,0 +1,195 @@
+'''
+数字人web资源数据(assets/data)的二进制格式, 替代gzip压缩的combined_data JSON
+
+文件格式: b"DHAV" + uint32版本号 + uint32 header长度 + JSON header + zlib压缩的数据段
+header: uid / frame_num / authorized, 以及每个数据段的dtype/shape/offset(相对解压后的数据, 8字节对齐)
+数据段:
+    face_verts  float32 [n_verts, 5]   face3D.obj的顶点(x, y, z, u, v), 按原OBJ文本的小数位数取整
+    face_faces  uint16  [n_faces, 3]   三角面, 从0开始
+    ref_data    float16 [n]            参考图特征(ref_in_feature), 可选float32
+    mats        float32 [n_frames, 16] 每帧变换矩阵(与原json_data.points[:16]相同)
+    points      int16   [n_frames, n]  每帧顶点坐标(原json_data.points[16:]), 以0.1为单位, 按帧差分存储
+    rects       int16   [n_frames, 4]  每帧裁剪框
+JS解码见web_source/js_source/avatarData.js
+
+网页中数据文件按内容哈希命名为assets/data.<hash>.bin(可长期缓存), 由assets/manifest.json指向, 见publish_avatar_data
+
+旧格式文件转换(原地覆盖, 并打印大小/读取耗时/差异):
+Usage: python -m talkingface.avatar_data <assets/data> [<out_path>]
+'''
+import os
+import sys
+import time
+import json
+import gzip
+import zlib
+import shutil
+import struct
+import hashlib
+import numpy as np
+
+AVATAR_MAGIC = b"DHAV"
+AVATAR_VERSION = 1
+POINTS_SCALE = 0.1
+AVATAR_MANIFEST = "manifest.json"
+_ALIGN = 8
+# face3D.obj顶点各列保留的小数位数, 与原文本格式"v {:.3f} {:.3f} {:.3f} {:.02f} {:.0f}"一致
+_VERT_DECIMALS = [3, 3, 3, 2, 0]
+
+
+def write_avatar_data(out_path, uid, face_verts, face_faces, ref_data, mats, points, rects, authorized = False,
+                      ref_dtype = "float16"):
+    '''
+    Args:
+        face_verts: [n_verts, 5]
+        face_faces: [n_faces, 3], 从0开始
+        ref_data: 参考图特征, 展平后保存
+        mats: [n_frames, 16]
+        points: [n_frames, n], 量化到0.1
+        rects: [n_frames, 4]
+    '''
+    face_verts = np.asarray(face_verts, dtype=np.float64)
+    face_verts = np.stack([np.round(face_verts[:, i], d) for i, d in enumerate(_VERT_DECIMALS)], axis=1)
+    points = np.round(np.asarray(points, dtype=np.float64) / POINTS_SCALE).astype(np.int32)
+    # 相邻帧的顶点变化很小, 差分后压缩率更高
+    points[1:] = points[1:] - points[:-1]
+    sections = {
+        "face_verts": face_verts.astype("<f4"),
+        "face_faces": np.asarray(face_faces).astype("<u2"),
+        "ref_data": np.asarray(ref_data, dtype=np.float32).ravel().astype("<f2" if ref_dtype == "float16" else "<f4"),
+        "mats": np.asarray(mats, dtype=np.float64).astype("<f4"),
+        "points": points.astype("<i2"),
+        "rects": np.asarray(rects).astype("<i2"),
+    }
+    header = {"version": AVATAR_VERSION, "uid": uid, "frame_num": len(mats), "authorized": authorized,
+              "compression": "zlib", "sections": {}}
+    body = bytearray()
+    for name, array in sections.items():
+        body += b"\0" * (-len(body) % _ALIGN)
+        header["sections"][name] = {"dtype": array.dtype.name, "shape": list(array.shape), "offset": len(body)}
+        body += array.tobytes()
+    header["sections"]["points"]["scale"] = POINTS_SCALE
+    header["sections"]["points"]["delta"] = True
+
+    header = json.dumps(header).encode("utf-8")
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(AVATAR_MAGIC + struct.pack("<II", AVATAR_VERSION, len(header)) + header)
+        f.write(zlib.compress(bytes(body), 9))
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _load_legacy(data):
+    # 旧的gzip JSON格式
+    combined_data = json.loads(gzip.decompress(data).decode("utf-8"))
+    verts, faces = [], []
+    for line in combined_data["face3D_obj"]:
+        if line.startswith("v "):
+            verts.append([float(i) for i in line[2:].split()])
+        elif line.startswith("f "):
+            faces.append([int(i) - 1 for i in line[2:].split()])
+    points = np.array([i["points"] for i in combined_data["json_data"]], dtype=np.float64)
+    return {
+        "uid": combined_data["uid"],
+        "frame_num": combined_data["frame_num"],
+        "authorized": combined_data["authorized"],
+        "face_verts": np.array(verts),
+        "face_faces": np.array(faces, dtype=np.int64),
+        "ref_data": np.array(combined_data["ref_data"], dtype=np.float32),
+        "mats": points[:, :16],
+        "points": points[:, 16:],
+        "rects": np.array([i["rect"] for i in combined_data["json_data"]], dtype=np.int64),
+    }
+
+
+def load_avatar_data(path):
+    '''
+    读取assets/data, 兼容旧的gzip JSON格式
+    Args:
+        path: 数据文件, 或包含data / manifest.json(发布后的网页资源目录) / combined_data.json.gz的目录
+    Returns:
+        dict: uid, frame_num, authorized, face_verts, face_faces, ref_data(float32), mats, points, rects
+    '''
+    if os.path.isdir(path):
+        manifest_path = os.path.join(path, AVATAR_MANIFEST)
+        if os.path.isfile(os.path.join(path, "data")):
+            path = os.path.join(path, "data")
+        elif os.path.isfile(manifest_path):
+            # manifest中为相对网站目录的路径(assets/data.<hash>.bin), 文件与manifest.json在同一目录
+            with open(manifest_path, encoding="utf-8") as f:
+                path = os.path.join(path, os.path.basename(json.load(f)["data"]))
+        else:
+            path = os.path.join(path, "combined_data.json.gz")
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != AVATAR_MAGIC:
+        return _load_legacy(data)
+    version, header_len = struct.unpack("<II", data[4:12])
+    if version != AVATAR_VERSION:
+        raise ValueError("不支持的数据文件版本: {}".format(version))
+    header = json.loads(data[12:12 + header_len].decode("utf-8"))
+    body = zlib.decompress(data[12 + header_len:]) if header["compression"] == "zlib" else data[12 + header_len:]
+    result = {"uid": header["uid"], "frame_num": header["frame_num"], "authorized": header["authorized"]}
+    for name, info in header["sections"].items():
+        dtype = np.dtype(info["dtype"]).newbyteorder("<")
+        array = np.frombuffer(body, dtype=dtype, count=int(np.prod(info["shape"])), offset=info["offset"])
+        array = array.reshape(info["shape"])
+        if info.get("delta"):
+            array = np.cumsum(array, axis=0, dtype=np.int64)
+        if "scale" in info:
+            array = array * info["scale"]
+        result[name] = array.astype(np.float32) if name == "ref_data" else array
+    return result
+
+
+def publish_avatar_data(data_path, assets_dir):
+    '''
+    把数据文件按内容哈希复制到网页资源目录, 并写入manifest.json, 网页运行时(logic.js)据此加载
+    Returns:
+        数据文件名, 例如data.1a2b3c4d5e6f7a8b.bin
+    '''
+    sha256 = hashlib.sha256()
+    with open(data_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    file_name = "data.{}.bin".format(sha256.hexdigest()[:16])
+    shutil.copy(data_path, os.path.join(assets_dir, file_name))
+    with open(os.path.join(assets_dir, AVATAR_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"data": "assets/" + file_name, "sha256": sha256.hexdigest()}, f)
+    return file_name
+
+
+def convert_legacy(path, out_path = None):
+    '''
+    旧的gzip JSON数据文件转换为二进制格式, 默认原地覆盖
+    '''
+    data = load_avatar_data(path)
+    return write_avatar_data(out_path or path, data["uid"], data["face_verts"], data["face_faces"], data["ref_data"],
+                             data["mats"], data["points"], data["rects"], data["authorized"])
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python -m talkingface.avatar_data <assets/data> [<out_path>]")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    path = sys.argv[1]
+    out_path = sys.argv[2] if len(sys.argv) == 3 else path
+    size = os.path.getsize(path)
+    start_time = time.perf_counter()
+    legacy = load_avatar_data(path)
+    t0 = time.perf_counter() - start_time
+    convert_legacy(path, out_path)
+    start_time = time.perf_counter()
+    new = load_avatar_data(out_path)
+    t1 = time.perf_counter() - start_time
+    print("已转换: {} ({:.1f} KB -> {:.1f} KB, 读取 {:.2f}ms -> {:.2f}ms)".format(
+        out_path, size / 1e3, os.path.getsize(out_path) / 1e3, t0 * 1000, t1 * 1000))
+    for name in ["face_verts", "ref_data", "mats", "points", "rects"]:
+        print("  {:<10} 最大差异 {:.2e}".format(name, np.abs(np.asarray(legacy[name]) - new[name]).max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+'''
+按(帧 x 关键点)批量计算的工具函数, 替代逐帧Python循环
+
+- smooth_frames: 沿帧方向的FIR平滑(talkingface.utils.smooth_array / talkingface.util.smooth.smooth_array的实现)
+- crop_mouth_rects: 批量计算crop_mouth裁剪框
+- project_keypoints: 批量把关键点投影到裁剪框坐标系(get_image的mediapipe分支)
+- transform_points: 批量对关键点做4x4齐次变换
+
+Usage: python -m talkingface.batch_utils [<n_frames>]
+与逐帧实现对比耗时和结果, 默认3000帧
+'''
+import sys
+import time
+import numpy as np
+from scipy.ndimage import correlate1d
+from talkingface.utils import INDEX_LIPS_OUTER, INDEX_FACE_OVAL
+
+
+def smooth_frames(array, weight = [0.1, 0.8, 0.1], edge = "keep"):
+    '''
+    Args:
+        array: [n_frames, ...], 沿第0维平滑
+        weight: 一维卷积核权重, 个数必须为奇数
+        edge: keep: 首尾len(weight)//2帧保持原值(smooth_array numpy模式的行为), 输出dtype与输入相同
+              replicate: 首尾复制填充后卷积(smooth_array torch模式的行为), 与原Conv1d相同输出float32
+    Returns:
+        array: [n_frames, ...]
+    '''
+    array = np.asarray(array)
+    smooth_length = len(weight)
+    assert smooth_length % 2 == 1, "卷积核权重个数必须使用奇数"
+    pad = smooth_length // 2
+    if edge == "replicate":
+        # mode="nearest"即首尾复制填充, 一次C循环完成, 不产生中间数组
+        return correlate1d(array.astype(np.float64), weight, axis=0, mode="nearest").astype(np.float32)
+    out = correlate1d(array, weight, axis=0, mode="nearest")
+    out[:pad] = array[:pad]
+    out[len(array) - pad:] = array[len(array) - pad:]
+    return out
+
+
+def crop_mouth_rects(pts_array, img_w, img_h):
+    '''
+    crop_mouth的批量版本(不含训练时的随机偏移)
+    Args:
+        pts_array: [n_frames, len(main_keypoints_index), 2或3], 已按main_keypoints_index取出的关键点
+    Returns:
+        [n_frames, 4] int64, 每行(x_min, y_min, x_max, y_max)
+    '''
+    pts_array = np.asarray(pts_array)
+    center = pts_array[:, INDEX_LIPS_OUTER, :2].mean(axis=1)
+    oval = pts_array[:, INDEX_FACE_OVAL[2:-2], :2]
+    pts_min = np.maximum(oval.min(axis=1), 0)
+    pts_max = np.minimum(oval.max(axis=1), [img_w, img_h])
+    new_size = (pts_max - pts_min).max(axis=1) * 0.46
+    rects = np.stack([
+        center[:, 0] - new_size,
+        center[:, 1] - new_size * 0.89,
+        center[:, 0] + new_size,
+        center[:, 1] + new_size * 1.11,
+    ], axis=1)
+    # int()向0取整
+    rects = np.trunc(rects).astype(np.int64)
+    rects[:, :2] = np.maximum(rects[:, :2], 0)
+    rects[:, 2] = np.minimum(rects[:, 2], int(img_w))
+    rects[:, 3] = np.minimum(rects[:, 3], int(img_h))
+    return rects
+
+
+def project_keypoints(pts_array, crop_rects, resize = 256):
+    '''
+    get_image(input_type="mediapipe")的批量版本, 不修改输入
+    Args:
+        pts_array: [n_frames, n_pts, 2或3]
+        crop_rects: [n_frames, 4]
+    Returns:
+        [n_frames, n_pts, 2或3], 3维时z减去每帧最大值后按裁剪框宽度缩放
+    '''
+    pts_array = np.asarray(pts_array, dtype=np.float64)
+    crop_rects = np.asarray(crop_rects)
+    if pts_array.shape[2] == 2:
+        size = (crop_rects[:, 2:] - crop_rects[:, :2])[:, np.newaxis, :]
+        return (pts_array - crop_rects[:, np.newaxis, :2]) * resize / size
+    shift = np.zeros((len(pts_array), 1, 3))
+    shift[:, 0, :2] = crop_rects[:, :2]
+    shift[:, 0, 2] = pts_array[:, :, 2].max(axis=1)
+    scale = resize / (crop_rects[:, 2] - crop_rects[:, 0]).astype(np.float64)
+    return (pts_array - shift) * scale[:, np.newaxis, np.newaxis]
+
+
+def transform_points(mats, pts_array):
+    '''
+    Args:
+        mats: [4, 4] 或 [n_frames, 4, 4]
+        pts_array: [n_pts, 3] 或 [n_frames, n_pts, 3]
+    Returns:
+        [n_frames, n_pts, 3], 每帧的mat.dot([pts, 1])
+    '''
+    pts_array = np.asarray(pts_array, dtype=np.float64)
+    mats = np.asarray(mats)
+    return pts_array @ np.swapaxes(mats[..., :3, :3], -1, -2) + mats[..., np.newaxis, :3, 3]
+
+
+def _benchmark(n_frames):
+    from talkingface.utils import crop_mouth, main_keypoints_index
+    from talkingface.data.few_shot_dataset import get_image
+
+    def smooth_loop(x0, weight):
+        # 原逐帧实现
+        pad = len(weight) // 2
+        fliter = np.repeat(np.array([weight]).T, x0.shape[1], axis=1)
+        out0 = np.zeros_like(x0)
+        for i in range(len(x0)):
+            if i < pad or i >= len(x0) - pad:
+                out0[i] = x0[i]
+            else:
+                out0[i] = np.sum(x0[i - pad:i + pad + 1] * fliter, axis=0)
+        return out0
+
+    rng = np.random.RandomState(0)
+    vid_width, vid_height = 720., 1280.
+    # 随机游走模拟人脸在画面中的运动
+    base = rng.uniform([200, 400, -30], [500, 800, 30], (478, 3))
+    pts_3d = base + np.cumsum(rng.normal(0, 0.5, (n_frames, 1, 3)), axis=0) + rng.normal(0, 0.3, (n_frames, 478, 3))
+    weight = [0.02, 0.09, 0.78, 0.09, 0.02]
+    main_pts = pts_3d[:, main_keypoints_index]
+
+    results = []
+    # 关键点(step0_keypoints), 变换矩阵(calc_face_mat), 裁剪框中心(step1_crop_mouth)
+    for name, array in [("smooth_array[n,1434]", pts_3d.reshape(n_frames, -1)),
+                        ("smooth_array[n,16]", rng.normal(0, 1, (n_frames, 16))),
+                        ("smooth_array[n,2]", rng.normal(0, 1, (n_frames, 2)))]:
+        start_time = time.perf_counter()
+        ref = smooth_loop(array, weight)
+        t0 = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        new = smooth_frames(array, weight)
+        results.append((name, t0, time.perf_counter() - start_time, np.abs(ref - new).max()))
+
+    start_time = time.perf_counter()
+    ref = np.array([crop_mouth(i, vid_width, vid_height) for i in main_pts])
+    t0 = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    rects = crop_mouth_rects(main_pts, vid_width, vid_height)
+    results.append(("crop_mouth", t0, time.perf_counter() - start_time, np.abs(ref - rects).max()))
+
+    start_time = time.perf_counter()
+    ref = np.array([get_image(pts_3d[i].copy(), rects[i], input_type="mediapipe", resize=128) for i in range(n_frames)])
+    t0 = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    new = project_keypoints(pts_3d, rects, resize=128)
+    results.append(("get_image(mediapipe)", t0, time.perf_counter() - start_time, np.abs(ref - new).max()))
+
+    mats = np.tile(np.eye(4), (n_frames, 1, 1))
+    mats[:, :3, :3] += rng.normal(0, 0.05, (n_frames, 3, 3))
+    mats[:, :3, 3] = rng.normal(0, 10, (n_frames, 3))
+    # 标准空间的面部mask关键点按每帧变换矩阵投影(video_pts_process)
+    face_mask_pts = base[INDEX_FACE_OVAL]
+    start_time = time.perf_counter()
+    ref = []
+    for i in range(n_frames):
+        keypoints = np.ones([4, len(face_mask_pts)])
+        keypoints[:3, :] = face_mask_pts.T
+        ref.append(mats[i].dot(keypoints).T[:, :3])
+    t0 = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    new = transform_points(mats, face_mask_pts)
+    results.append(("mat.dot(keypoints)", t0, time.perf_counter() - start_time, np.abs(np.array(ref) - new).max()))
+
+    print("{}帧:".format(n_frames))
+    for name, t0, t1, diff in results:
+        print("  {:<22} 逐帧 {:8.2f}ms  批量 {:7.2f}ms  {:6.1f}x  最大差异 {:.2e}".format(name, t0 * 1000, t1 * 1000, t0 / t1, diff))
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    _benchmark(n_frames)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+'''
+推理用精简checkpoint
+
+训练checkpoint(mini_live/train.py等保存)包含net_g/net_d和两份优化器状态, 推理只需要net_g。
+export_inference_checkpoint只保留net_g(可选fp16), load_render_state_dict以mmap方式读取,
+worker启动时只读取实际用到的权重, 多个进程共享同一份page cache。
+
+Usage: python -m talkingface.checkpoint_utils <checkpoint> [fp16] [safetensors]
+输出<checkpoint>_infer.pth(或.safetensors), 放在原checkpoint旁边即可被自动使用
+'''
+import os
+import sys
+import torch
+
+INFER_SUFFIX = "_infer"
+
+
+def inference_checkpoint_path(ckpt_path, fmt = "pth"):
+    return os.path.splitext(ckpt_path)[0] + INFER_SUFFIX + "." + fmt
+
+
+def _load_file(path):
+    if path.endswith(".safetensors"):
+        # safetensors本身就是mmap读取
+        from safetensors.torch import load_file
+        return load_file(path, device="cpu")
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def load_render_state_dict(ckpt_path):
+    '''
+    读取渲染模型生成器(net_g)权重, 优先使用旁边的精简checkpoint(<ckpt>_infer.safetensors / <ckpt>_infer.pth)
+    精简checkpoint比原checkpoint旧时(原checkpoint重新训练后没有重新导出)忽略, 仍读取原checkpoint
+    fp16保存的权重在这里转回float32, 由load_state_dict拷贝到目标设备
+    '''
+    path = ckpt_path
+    for fmt in ["safetensors", "pth"]:
+        infer_path = inference_checkpoint_path(ckpt_path, fmt)
+        if not os.path.isfile(infer_path):
+            continue
+        if os.path.isfile(ckpt_path) and os.path.getmtime(infer_path) < os.path.getmtime(ckpt_path):
+            print("忽略比 {} 旧的精简checkpoint: {}".format(ckpt_path, infer_path))
+            continue
+        path = infer_path
+        break
+    checkpoint = _load_file(path)
+    if "state_dict" in checkpoint:
+        checkpoint = checkpoint["state_dict"]["net_g"]
+    return {k: v.float() if v.is_floating_point() else v for k, v in checkpoint.items()}
+
+
+def export_inference_checkpoint(ckpt_path, out_path = None, half = False):
+    '''
+    Args:
+        ckpt_path: 训练checkpoint, 包含state_dict.net_g
+        out_path: 输出路径, 后缀为.safetensors时用safetensors格式保存
+        half: 是否以fp16保存权重, BatchNorm的running_mean/var保持float32
+    '''
+    out_path = out_path or inference_checkpoint_path(ckpt_path)
+    checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+    state_dict = {}
+    for k, v in checkpoint["state_dict"]["net_g"].items():
+        if half and v.is_floating_point() and "running_" not in k:
+            v = v.half()
+        state_dict[k] = v.contiguous()
+    if out_path.endswith(".safetensors"):
+        from safetensors.torch import save_file
+        save_file(state_dict, out_path)
+    else:
+        torch.save(state_dict, out_path)
+    return out_path
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) < 2:
+        print("Usage: python -m talkingface.checkpoint_utils <checkpoint> [fp16] [safetensors]")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    ckpt_path = sys.argv[1]
+    half = "fp16" in sys.argv[2:]
+    fmt = "safetensors" if "safetensors" in sys.argv[2:] else "pth"
+    out_path = export_inference_checkpoint(ckpt_path, inference_checkpoint_path(ckpt_path, fmt), half)
+    print("已导出: {} ({:.2f} MB -> {:.2f} MB)".format(out_path, os.path.getsize(ckpt_path) / 1e6, os.path.getsize(out_path) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
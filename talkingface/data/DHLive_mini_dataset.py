@@ -4,7 +4,7 @@ import tqdm
 import copy
 from talkingface.utils import *
 import glob
-import pickle
+from talkingface.keypoint_store import load_keypoints
 import torch
 import torch.utils.data as data
 from talkingface.models.DINet_mini import input_height,input_width
@@ -219,9 +219,7 @@ def data_preparation(train_video_list):
         img_teeth_filelist.sort()
 
         teeth_rect_array = np.loadtxt("{}/teeth_seg/all.txt".format(model_name))
-        Path_output_pkl = "{}/keypoint_rotate.pkl".format(model_name)
-        with open(Path_output_pkl, "rb") as f:
-            images_info = pickle.load(f)
+        images_info = load_keypoints("{}/keypoint_rotate.kps".format(model_name), mmap=True)
 
         # print(len(img_filelist), len(images_info), len(img_teeth_filelist), len(teeth_rect_array))
         # exit(1)
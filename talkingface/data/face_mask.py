@@ -6,6 +6,7 @@ import numpy as np
 import os
 import glob
 from talkingface.util.smooth import smooth_array
+from talkingface.keypoint_store import load_keypoints
 from talkingface.run_utils import calc_face_mat
 import tqdm
 from talkingface.utils import *
@@ -32,10 +33,7 @@ for path_ in tqdm.tqdm(video_list):
         continue
     img_all.append(img_filelist)
 
-    Path_output_pkl = "{}/keypoint_rotate.pkl".format(path_)
-
-    with open(Path_output_pkl, "rb") as f:
-        images_info = pickle.load(f)[:, main_keypoints_index, :]
+    images_info = load_keypoints("{}/keypoint_rotate.kps".format(path_), mmap=True)[:, main_keypoints_index, :]
     pts_driven = images_info.reshape(len(images_info), -1)
     pts_driven = smooth_array(pts_driven).reshape(len(pts_driven), -1, 3)
 
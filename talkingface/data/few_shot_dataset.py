@@ -5,6 +5,7 @@ import copy
 from talkingface.utils import *
 import glob
 import pickle
+from talkingface.keypoint_store import load_keypoints
 import torch
 import torch.utils.data as data
 def get_image(A_path, crop_coords, input_type, resize= 256):
@@ -197,9 +198,7 @@ def data_preparation(train_video_list):
             continue
         img_all.append(img_filelist)
 
-        Path_output_pkl = "{}/keypoint_rotate.pkl".format(model_name)
-        with open(Path_output_pkl, "rb") as f:
-            images_info = pickle.load(f)
+        images_info = load_keypoints("{}/keypoint_rotate.kps".format(model_name), mmap=True)
         keypoints_all.append(images_info[:, main_keypoints_index, :2])
 
         Path_output_pkl = "{}/face_mat_mask.pkl".format(model_name)
@@ -237,46 +236,32 @@ def data_preparation(train_video_list):
     return dict_info
 
 
-def generate_input_pixels(img, keypoints, rotationMatrix, pixels_mouth, mask_keypoints, coords_array):
+def prepare_input_pixels(img, keypoints, rotationMatrix, mask_keypoints, coords_array):
+    """
+    预计算generate_input_pixels中与音频无关的部分（每帧只需计算一次）:
+    裁剪区域、裁剪后的目标图、抠掉嘴部的source图、鼻子眼睛线条、嘴部像素在裁剪图中的坐标
+    """
     # 根据关键点决定正方形裁剪区域
     crop_coords = crop_face(keypoints, size=img.shape[:2], is_train=False)
+    x_min, y_min, x_max, y_max = crop_coords
     target_keypoints = get_image(keypoints[:, :2], crop_coords, input_type='mediapipe')
 
-    # 画出嘴部像素图
+    # 嘴部像素图坐标，直接换算到裁剪区域内，超出裁剪区域的像素丢弃
     pixels_mouth_coords = rotationMatrix.dot(coords_array).T
     pixels_mouth_coords = pixels_mouth_coords[:, :2].astype(int)
-    pixels_mouth_coords = (pixels_mouth_coords[:, 1], pixels_mouth_coords[:, 0])
-
-    source_face_egde = np.zeros_like(img, dtype=np.uint8)
-    # out_frame = img.copy()
-    frame = pixels_mouth.reshape(15, 30, 3).clip(0, 255).astype(np.uint8)
-
-    frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (150, 100))
-    sharpen_image = frame.astype(np.float32)
-    mean_ = int(np.mean(sharpen_image))
-    max_, min_ = mean_ + 60, mean_ - 60
-    sharpen_image = (sharpen_image - min_) / (max_ - min_) * 255.
-    sharpen_image = sharpen_image.clip(0, 255).astype(np.uint8)
-
-    sharpen_image = np.concatenate(
-        [sharpen_image[:, :, np.newaxis], sharpen_image[:, :, np.newaxis], sharpen_image[:, :, np.newaxis]], axis=2)
-    # sharpen_image = cv2.resize(sharpen_image, (150, 100))
-    source_face_egde[pixels_mouth_coords] = sharpen_image.reshape(-1, 3)
-    # cv2.imshow("sharpen_image", source_face_egde)
-    # cv2.waitKey(40)
-
-    source_face_egde = get_image(source_face_egde, crop_coords, input_type='image')
-    source_face_egde = draw_face_feature_maps(target_keypoints, mode = ["nose", "eye"], im_edges=source_face_egde)
-    # cv2.imshow("sharpen_image", source_face_egde)
-    # cv2.waitKey(40)
+    cols = pixels_mouth_coords[:, 0] - x_min
+    rows = pixels_mouth_coords[:, 1] - y_min
+    valid = (cols >= 0) & (cols < x_max - x_min) & (rows >= 0) & (rows < y_max - y_min)
 
+    # 鼻子、眼睛线条与嘴部像素无关，单独画出后用mask叠加
+    edge_lines = draw_face_feature_maps(target_keypoints, mode=["nose", "eye"])
+    edge_lines_mask = np.any(edge_lines > 0, axis=2)
 
     target_img = get_image(img, crop_coords, input_type='img')
     target_mask_keypoints = get_image(mask_keypoints[:, :2], crop_coords, input_type='mediapipe')
     # source_img信息：扣出嘴部区域
     source_img = copy.deepcopy(target_img)
-    source_keypoints = target_keypoints
-    pts = source_keypoints.copy()
+    pts = target_keypoints.copy()
     face_edge_start_index = 3
     pts[INDEX_FACE_OVAL[face_edge_start_index:-face_edge_start_index], 1] = target_mask_keypoints[
                                                                             face_edge_start_index:-face_edge_start_index,
@@ -284,5 +269,42 @@ def generate_input_pixels(img, keypoints, rotationMatrix, pixels_mouth, mask_key
     pts = pts[INDEX_FACE_OVAL[face_edge_start_index:-face_edge_start_index] + INDEX_NOSE_EDGE[::-1], :2]
     pts = pts.reshape((-1, 1, 2)).astype(np.int32)
     cv2.fillPoly(source_img, [pts], color=(0, 0, 0))
-    source_img = np.concatenate([source_img, source_face_egde], axis=2)
-    return source_img, target_img, crop_coords
\ No newline at end of file
+    return {
+        "crop_coords": crop_coords,
+        "target_img": target_img,
+        "source_img": source_img,
+        "edge_lines": edge_lines,
+        "edge_lines_mask": edge_lines_mask,
+        "mouth_rows": rows[valid],
+        "mouth_cols": cols[valid],
+        "mouth_valid": valid,
+    }
+
+def generate_input_pixels_cached(frame_cache, pixels_mouth):
+    """
+    使用prepare_input_pixels的预计算结果，只处理随音频变化的嘴部像素
+    """
+    x_min, y_min, x_max, y_max = frame_cache["crop_coords"]
+
+    # 画出嘴部像素图
+    frame = pixels_mouth.reshape(15, 30, 3).clip(0, 255).astype(np.uint8)
+    frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (150, 100))
+    sharpen_image = frame.astype(np.float32)
+    mean_ = int(np.mean(sharpen_image))
+    max_, min_ = mean_ + 60, mean_ - 60
+    sharpen_image = (sharpen_image - min_) / (max_ - min_) * 255.
+    sharpen_image = sharpen_image.clip(0, 255).astype(np.uint8)
+
+    source_face_egde = np.zeros([y_max - y_min, x_max - x_min], dtype=np.uint8)
+    source_face_egde[frame_cache["mouth_rows"], frame_cache["mouth_cols"]] = sharpen_image.reshape(-1)[frame_cache["mouth_valid"]]
+    source_face_egde = cv2.resize(source_face_egde, (256, 256))
+    source_face_egde = np.repeat(source_face_egde[:, :, np.newaxis], 3, axis=2)
+    edge_lines_mask = frame_cache["edge_lines_mask"]
+    source_face_egde[edge_lines_mask] = frame_cache["edge_lines"][edge_lines_mask]
+
+    source_img = np.concatenate([frame_cache["source_img"], source_face_egde], axis=2)
+    return source_img, frame_cache["target_img"], frame_cache["crop_coords"]
+
+def generate_input_pixels(img, keypoints, rotationMatrix, pixels_mouth, mask_keypoints, coords_array):
+    frame_cache = prepare_input_pixels(img, keypoints, rotationMatrix, mask_keypoints, coords_array)
+    return generate_input_pixels_cached(frame_cache, pixels_mouth)
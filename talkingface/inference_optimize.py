@@ -0,0 +1,184 @@
+import copy
+import contextlib
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+from talkingface.models.DINet_mini import input_height, input_width, DINet_mini_pipeline, SameBlock2d, DownBlock2d, UpBlock2d, DownBlock, UpBlock, ResBlock, ResBlock2d
+from talkingface.onnx_utils import DINetMiniOnnxWrapper, Audio2FeatureStepWrapper
+
+# 推理优化模式: fold(BN折叠) | jit(再做TorchScript trace+freeze) | compile(再做torch.compile)
+OPTIMIZE_MODES = ["fold", "jit", "compile"]
+# 推理精度: fp32 | bf16(CPU autocast, conv/linear/matmul以bfloat16计算, 输出转回float32)
+# int8走onnxruntime量化模型, 见talkingface/quantize_utils.py
+PRECISIONS = ["fp32", "bf16"]
+# bf16只有8位尾数, 与fp32的误差在1e-2量级
+BF16_ATOL = 5e-2
+
+
+def fold_batchnorm(model):
+    '''
+    将eval模式下的BatchNorm折叠进前一层conv/linear, 被折叠的BN替换为Identity
+    ResBlock2d的norm1在conv之前(pre-activation), 无法折叠, 保持不变
+    '''
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, (SameBlock2d, DownBlock2d, UpBlock2d, DownBlock, UpBlock)):
+            if isinstance(module.norm, nn.BatchNorm2d):
+                module.conv = fuse_conv_bn_eval(module.conv, module.norm)
+                module.norm = nn.Identity()
+        elif isinstance(module, ResBlock2d):
+            if isinstance(module.norm2, nn.BatchNorm2d):
+                module.conv1 = fuse_conv_bn_eval(module.conv1, module.norm2)
+                module.norm2 = nn.Identity()
+        elif isinstance(module, ResBlock):
+            if isinstance(module.norm, nn.BatchNorm2d):
+                module.conv1 = fuse_conv_bn_eval(module.conv1, module.norm)
+                module.norm = nn.Identity()
+        elif isinstance(module, nn.Sequential):
+            # Audio2Feature: Linear -> BatchNorm1d -> LeakyReLU
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Linear) and isinstance(module[i + 1], nn.BatchNorm1d):
+                    module[i] = fuse_linear_bn_eval(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+    return model
+
+
+class OptimizedRenderNet:
+    '''
+    优化后的DINet_mini_pipeline, 接口与原模型一致(ref_input/interface/infer_model.ref_in_feature)
+    '''
+    def __init__(self, pipeline, mode = "fold", channels_last = False, precision = "fp32"):
+        self.pipeline = pipeline
+        self.infer_model = pipeline.infer_model
+        self.channels_last = channels_last
+        self.precision = precision
+        wrapper = DINetMiniOnnxWrapper(pipeline).eval()
+        if mode == "jit":
+            source_tensor, gl_tensor, ref_in_feature = _example_render_inputs(pipeline)
+            with torch.no_grad(), _autocast(precision):
+                wrapper = torch.jit.freeze(torch.jit.trace(wrapper, (source_tensor, gl_tensor, ref_in_feature), check_trace=False))
+        elif mode == "compile":
+            wrapper = torch.compile(wrapper)
+        self.wrapper = wrapper
+
+    def _format(self, tensor):
+        if self.channels_last:
+            return tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
+
+    def ref_input(self, ref_tensor):
+        self.pipeline.ref_input(self._format(ref_tensor))
+
+    def interface(self, source_tensor, gl_tensor):
+        with _autocast(self.precision):
+            out = self.wrapper(self._format(source_tensor), self._format(gl_tensor), self.infer_model.ref_in_feature)
+        return out.float()
+
+    def __call__(self, source_tensor, gl_tensor, ref_tensor):
+        self.ref_input(ref_tensor)
+        return self.interface(source_tensor, gl_tensor)
+
+    def eval(self):
+        return self
+
+    def state_dict(self):
+        return self.pipeline.state_dict()
+
+
+class OptimizedAudio2Feature:
+    '''
+    优化后的Audio2Feature, 调用方式不变: pred, hn, cn = model(input, h0, c0)
+    '''
+    def __init__(self, net, mode = "fold", precision = "fp32"):
+        self.net = net
+        self.precision = precision
+        wrapper = Audio2FeatureStepWrapper(net).eval()
+        if mode == "jit":
+            device = next(net.parameters()).device
+            example = (torch.rand([1, 2, 80]).to(device), torch.zeros(2, 1, 192).to(device), torch.zeros(2, 1, 192).to(device))
+            with torch.no_grad(), _autocast(precision):
+                wrapper = torch.jit.freeze(torch.jit.trace(wrapper, example, check_trace=False))
+        elif mode == "compile":
+            wrapper = torch.compile(wrapper)
+        self.wrapper = wrapper
+
+    def __call__(self, audio_features, h0, c0):
+        with _autocast(self.precision):
+            pred, hn, cn = self.wrapper(audio_features, h0, c0)
+        return pred.float(), hn.float(), cn.float()
+
+    def eval(self):
+        return self
+
+    def state_dict(self):
+        return self.net.state_dict()
+
+
+def _autocast(precision):
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def _example_render_inputs(pipeline):
+    device = next(pipeline.parameters()).device
+    source_tensor = torch.rand([1, 4, 128, 128]).to(device)
+    gl_tensor = torch.rand([1, 4, 128, 128]).to(device)
+    with torch.no_grad():
+        ref_in_feature = pipeline.infer_model.ref_in_conv(torch.rand([1, 12, input_height, input_width]).to(device))
+    return source_tensor, gl_tensor, ref_in_feature
+
+
+def optimize_for_inference(model, mode = "fold", channels_last = False, verify = True, atol = 1e-4, precision = "fp32"):
+    '''
+    对DINet_mini_pipeline或Audio2Feature做推理优化, 并与原模型比对输出
+
+    Args:
+        model: DINet_mini_pipeline 或 Audio2Feature (eval模式)
+        mode: fold | jit | compile
+        channels_last: 渲染模型是否转为channels_last内存布局(CPU上72x72的小特征图收益不明显, 默认关闭)
+        verify: 是否用随机输入校验优化前后的数值一致性, 误差超过atol时抛出异常
+        precision: fp32 | bf16, bf16时atol至少放宽到BF16_ATOL
+    Returns:
+        接口与原模型一致的优化后模型
+    '''
+    assert mode in OPTIMIZE_MODES, "不支持的优化模式: {}".format(mode)
+    assert precision in PRECISIONS, "不支持的推理精度: {}".format(precision)
+    if precision == "bf16":
+        atol = max(atol, BF16_ATOL)
+    model.eval()
+    reference = copy.deepcopy(model) if verify else None
+    model = fold_batchnorm(model)
+
+    if isinstance(model, DINet_mini_pipeline):
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        optimized = OptimizedRenderNet(model, mode, channels_last, precision)
+        if verify:
+            source_tensor, gl_tensor, _ = _example_render_inputs(model)
+            ref_tensor = torch.rand([1, 12, input_height, input_width]).to(source_tensor.device)
+            with torch.no_grad():
+                reference.ref_input(ref_tensor)
+                expected = reference.interface(source_tensor, gl_tensor)
+                optimized.ref_input(ref_tensor)
+                actual = optimized.interface(source_tensor, gl_tensor)
+            _check_parity("DINet_mini", expected, actual, atol)
+    else:
+        optimized = OptimizedAudio2Feature(model, mode, precision)
+        if verify:
+            device = next(model.parameters()).device
+            mel = torch.rand([1, 2 * 25, 80]).to(device)
+            h0 = torch.zeros(2, 1, 192).to(device)
+            c0 = torch.zeros(2, 1, 192).to(device)
+            with torch.no_grad():
+                expected = reference(mel, h0, c0)[0]
+                actual = optimized(mel, h0, c0)[0]
+            _check_parity("Audio2Feature", expected, actual, atol)
+    return optimized
+
+
+def _check_parity(name, expected, actual, atol):
+    max_diff = (expected.float() - actual.float()).abs().max().item()
+    if max_diff > atol:
+        raise RuntimeError("{} 推理优化后输出误差过大: {:.6f} > {}".format(name, max_diff, atol))
+    print("{} 推理优化完成, 最大误差 {:.2e}".format(name, max_diff))
@@ -0,0 +1,168 @@
+'''
+关键点存储格式, 替代float64的processed.pkl / keypoint_rotate.pkl
+
+文件格式: b"DHKP" + uint32版本号 + uint32 header长度 + JSON header + 64字节对齐的关键点数据
+- dtype: float32, 或int16(按坐标轴线性量化, header记录offset/scale, 误差不超过scale/2)
+- compression: none(可mmap直接读取) 或 zstd(需要安装zstandard)
+- meta: 视频信息(帧率/宽高/帧数/人脸裁剪框等), 读取时不需要再打开视频
+
+读取不经过pickle, 旧的.pkl需要用下面的命令转换一次(只转换自己生成的可信文件)
+Usage: python -m talkingface.keypoint_store <keypoints.pkl>... [int16] [zstd]
+'''
+import os
+import sys
+import json
+import struct
+import numpy as np
+
+KEYPOINT_MAGIC = b"DHKP"
+KEYPOINT_VERSION = 1
+KEYPOINT_EXT = ".kps"
+_ALIGN = 64
+# 保存格式: float32 | int16, 压缩: 空 | zstd
+KEYPOINT_DTYPE = os.getenv("DH_KEYPOINT_DTYPE", "float32")
+KEYPOINT_COMPRESSION = os.getenv("DH_KEYPOINT_COMPRESSION", "")
+
+
+class KeypointStoreError(Exception):
+    """关键点文件不存在、格式或版本不符"""
+    pass
+
+
+def keypoint_path(path):
+    '''
+    把旧的.pkl路径换成关键点文件路径, 例如data/processed.pkl -> data/processed.kps
+    '''
+    return os.path.splitext(path)[0] + KEYPOINT_EXT
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise KeypointStoreError("zstd压缩需要安装zstandard: pip install zstandard") from e
+    return zstandard
+
+
+def save_keypoints(path, pts, meta = None, dtype = None, compression = None):
+    '''
+    Args:
+        path: 输出路径(.kps)
+        pts: [n_frames, n_pts, 3]
+        meta: 视频信息, 需可JSON序列化
+        dtype: float32 | int16, 默认取环境变量DH_KEYPOINT_DTYPE
+        compression: 空 | zstd, 默认取环境变量DH_KEYPOINT_COMPRESSION
+    '''
+    dtype = dtype or KEYPOINT_DTYPE
+    compression = KEYPOINT_COMPRESSION if compression is None else compression
+    pts = np.asarray(pts, dtype=np.float64)
+    header = {"version": KEYPOINT_VERSION, "shape": list(pts.shape), "dtype": dtype,
+              "compression": compression or "none", "meta": meta or {}}
+    if dtype == "int16":
+        axes = tuple(range(pts.ndim - 1))
+        offset = (pts.min(axis=axes) + pts.max(axis=axes)) / 2 if pts.size else np.zeros(pts.shape[-1])
+        scale = np.maximum((pts.max(axis=axes) - pts.min(axis=axes)) / 65534, 1e-6) if pts.size else np.ones(pts.shape[-1])
+        data = np.round((pts - offset) / scale).astype("<i2")
+        header["offset"] = offset.tolist()
+        header["scale"] = scale.tolist()
+    elif dtype == "float32":
+        data = pts.astype("<f4")
+    else:
+        raise KeypointStoreError("不支持的关键点格式: {}".format(dtype))
+    payload = data.tobytes()
+    if compression == "zstd":
+        payload = _zstd().ZstdCompressor(level=10).compress(payload)
+    elif compression:
+        raise KeypointStoreError("不支持的压缩方式: {}".format(compression))
+
+    header = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = (12 + len(header) + _ALIGN - 1) // _ALIGN * _ALIGN
+    header = header + b" " * (data_start - 12 - len(header))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(KEYPOINT_MAGIC + struct.pack("<II", KEYPOINT_VERSION, len(header)) + header)
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _read_header(path):
+    if not os.path.isfile(path):
+        if os.path.isfile(os.path.splitext(path)[0] + ".pkl"):
+            raise KeypointStoreError("{} 不存在, 旧格式请先运行 python -m talkingface.keypoint_store {}".format(
+                path, os.path.splitext(path)[0] + ".pkl"))
+        raise KeypointStoreError("{} 不存在".format(path))
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        if magic != KEYPOINT_MAGIC:
+            raise KeypointStoreError("{} 不是关键点文件".format(path))
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version != KEYPOINT_VERSION:
+            raise KeypointStoreError("{} 版本{}不受支持".format(path, version))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    return header, 12 + header_len
+
+
+def load_keypoint_meta(path):
+    '''
+    只读取header中的视频信息
+    '''
+    return _read_header(path)[0]["meta"]
+
+
+def load_keypoints(path, mmap = False):
+    '''
+    Args:
+        mmap: True时未压缩的float32文件直接返回只读memmap(多个训练worker共享page cache), 其余情况解码到内存
+    Returns:
+        [n_frames, n_pts, 3], mmap=False时为可写的float64数组(与原pickle内容一致)
+    '''
+    header, data_start = _read_header(path)
+    shape = header["shape"]
+    dtype = np.dtype("<i2" if header["dtype"] == "int16" else "<f4")
+    count = int(np.prod(shape))
+    if header["compression"] == "zstd":
+        with open(path, "rb") as f:
+            f.seek(data_start)
+            data = np.frombuffer(_zstd().ZstdDecompressor().decompress(f.read(), max_output_size=count * dtype.itemsize),
+                                 dtype=dtype)
+    elif mmap and header["dtype"] == "float32":
+        return np.memmap(path, dtype=dtype, mode="r", offset=data_start, shape=tuple(shape))
+    else:
+        data = np.fromfile(path, dtype=dtype, count=count, offset=data_start)
+    if header["dtype"] != "int16":
+        return data.reshape(shape).astype(np.float64)
+    # 按行广播(每行n_pts*3个值), 最后一维只有3时逐元素广播很慢
+    pts = data.reshape(shape[0], -1).astype(np.float64)
+    pts *= np.tile(header["scale"], pts.shape[1] // 3)
+    pts += np.tile(header["offset"], pts.shape[1] // 3)
+    return pts.reshape(shape)
+
+
+def convert_pickle(pkl_path, dtype = None, compression = None):
+    '''
+    旧的float64 pickle转换为关键点文件, 只用于自己生成的可信文件
+    '''
+    import pickle
+    with open(pkl_path, "rb") as f:
+        pts = pickle.load(f)
+    return save_keypoints(keypoint_path(pkl_path), np.asarray(pts), {"source": os.path.basename(pkl_path)},
+                          dtype, compression)
+
+
+def main():
+    # 检查命令行参数的数量
+    paths = [i for i in sys.argv[1:] if i not in ["int16", "zstd"]]
+    if len(paths) == 0:
+        print("Usage: python -m talkingface.keypoint_store <keypoints.pkl>... [int16] [zstd]")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    dtype = "int16" if "int16" in sys.argv[1:] else "float32"
+    compression = "zstd" if "zstd" in sys.argv[1:] else ""
+    for pkl_path in paths:
+        out_path = convert_pickle(pkl_path, dtype, compression)
+        print("已转换: {} ({:.2f} MB -> {:.2f} MB)".format(out_path, os.path.getsize(pkl_path) / 1e6, os.path.getsize(out_path) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
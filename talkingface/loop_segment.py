@@ -0,0 +1,108 @@
+'''
+自动选取适合往返循环播放的视频片段
+
+网页(logic.js)和interface_mini都把01.mp4按 正放->倒放->正放 循环播放, 掉头处画面连续, 只有运动方向突变,
+掉头前后运动越慢越自然。在关键点轨迹上搜索满足以下条件的最短片段:
+    - 时长不少于DH_LOOP_MIN_SECONDS秒
+    - 首尾两处(各前后LOOP_SEAM_FRAMES帧)的平均运动速度不超过DH_LOOP_MAX_SEAM_SPEED(相对人脸宽度/帧)
+    - 片段内关键点的平均标准差(姿态变化)不超过DH_LOOP_MAX_POSE_STD(相对人脸宽度)
+长度相同的候选取首尾速度与姿态变化加权和最小的; 没有满足条件的片段, 或片段比原视频短不到10%时不裁剪。
+裁剪后01.mp4、每帧关键点/变换矩阵都只保留该片段, 数据文件、视频解码耗时和内存随之减少。
+
+Usage: python -m talkingface.loop_segment <processed.kps>...
+打印选取结果, 不修改文件
+'''
+import os
+import sys
+import numpy as np
+
+from talkingface.utils import main_keypoints_index, smooth_array
+
+LOOP_SELECT = os.getenv("DH_LOOP_SELECT", "1") == "1"
+LOOP_MIN_SECONDS = float(os.getenv("DH_LOOP_MIN_SECONDS", 4))
+LOOP_MAX_SEAM_SPEED = float(os.getenv("DH_LOOP_MAX_SEAM_SPEED", 0.0015))
+LOOP_MAX_POSE_STD = float(os.getenv("DH_LOOP_MAX_POSE_STD", 0.02))
+LOOP_SEAM_FRAMES = 2
+# 裁剪后至少要比原视频短这么多才值得裁剪
+LOOP_MIN_SAVING = 0.1
+# 选择候选时姿态变化相对首尾速度的权重(两者量级相差约10倍)
+_POSE_WEIGHT = 0.1
+
+
+def _trajectory(pts_3d):
+    # 主要关键点的xy坐标, 按人脸宽度归一化, 与step0_keypoints相同的平滑
+    pts = np.asarray(pts_3d)[:, main_keypoints_index, :2].astype(np.float64)
+    n = len(pts)
+    face_width = np.median(pts[:, :, 0].max(axis=1) - pts[:, :, 0].min(axis=1))
+    pts = smooth_array(pts.reshape(n, -1), weight=[0.02, 0.09, 0.78, 0.09, 0.02])
+    return pts.reshape(n, -1, 2) / max(face_width, 1.)
+
+
+def select_loop_segment(pts_3d, fps, min_seconds = None, max_seam_speed = None, max_pose_std = None):
+    '''
+    Args:
+        pts_3d: [n_frames, 478, 3] 关键点
+    Returns:
+        None(不裁剪) 或 {"start", "end"(不含), "seam_speed", "pose_std"}
+    '''
+    min_seconds = LOOP_MIN_SECONDS if min_seconds is None else min_seconds
+    max_seam_speed = LOOP_MAX_SEAM_SPEED if max_seam_speed is None else max_seam_speed
+    max_pose_std = LOOP_MAX_POSE_STD if max_pose_std is None else max_pose_std
+    n = len(pts_3d)
+    min_len = max(int(round(min_seconds * fps)), 2 * LOOP_SEAM_FRAMES + 1)
+    max_len = int(n * (1 - LOOP_MIN_SAVING))
+    if min_len > max_len:
+        return None
+
+    traj = _trajectory(pts_3d)
+    # 每帧的运动速度, 以及每帧前后LOOP_SEAM_FRAMES帧的平均速度(掉头处的运动)
+    speed = np.linalg.norm(np.diff(traj, axis=0), axis=2).mean(axis=1)
+    speed = np.concatenate([speed[:1], (speed[1:] + speed[:-1]) / 2, speed[-1:]])
+    kernel = np.ones(2 * LOOP_SEAM_FRAMES + 1) / (2 * LOOP_SEAM_FRAMES + 1)
+    seam = np.convolve(np.pad(speed, LOOP_SEAM_FRAMES, mode="edge"), kernel, mode="valid")
+
+    # 前缀和, O(1)计算任意片段内关键点的标准差
+    flat = traj.reshape(n, -1)
+    cum = np.concatenate([np.zeros((1, flat.shape[1])), np.cumsum(flat, axis=0)])
+    cum2 = np.concatenate([np.zeros((1, flat.shape[1])), np.cumsum(flat ** 2, axis=0)])
+    seam_ok = seam <= max_seam_speed
+    for length in range(min_len, max_len + 1):
+        # 只计算首尾速度满足条件的候选
+        start = np.flatnonzero(seam_ok[:n - length + 1] & seam_ok[length - 1:])
+        if len(start) == 0:
+            continue
+        end = start + length
+        mean = (cum[end] - cum[start]) / length
+        var = np.maximum((cum2[end] - cum2[start]) / length - mean ** 2, 0)
+        # 每个关键点(x, y)两个方向的标准差合成, 再对关键点取平均
+        pose_std = np.sqrt(var.reshape(len(start), -1, 2).sum(axis=2)).mean(axis=1)
+        ok = pose_std <= max_pose_std
+        if ok.any():
+            score = np.where(ok, seam[start] + seam[end - 1] + _POSE_WEIGHT * pose_std, np.inf)
+            best = int(np.argmin(score))
+            return {"start": int(start[best]), "end": int(end[best]),
+                    "seam_speed": float(max(seam[start[best]], seam[end[best] - 1])), "pose_std": float(pose_std[best])}
+    return None
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) < 2:
+        print("Usage: python -m talkingface.loop_segment <processed.kps>...")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    from talkingface.keypoint_store import load_keypoints, load_keypoint_meta
+    for path in sys.argv[1:]:
+        pts_3d = load_keypoints(path)
+        fps = load_keypoint_meta(path)["fps"]
+        segment = select_loop_segment(pts_3d, fps)
+        if segment is None:
+            print("{}: {}帧, 没有满足条件的循环片段, 不裁剪".format(path, len(pts_3d)))
+            continue
+        print("{}: {}帧 -> [{}, {}) {}帧, 首尾速度{:.4f}, 姿态变化{:.4f}".format(
+            path, len(pts_3d), segment["start"], segment["end"], segment["end"] - segment["start"],
+            segment["seam_speed"], segment["pose_std"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 import sys
 import numpy as np
 import kaldi_native_fbank as knf
@@ -5,8 +6,25 @@ from scipy.io import wavfile
 import torch
 device = "cuda" if torch.cuda.is_available() else "cpu"
 # device = "cpu"
+# 推理引擎: torch | onnx, onnx模型需先运行 python -m talkingface.onnx_utils 导出
+infer_engine = os.getenv("DH_INFER_ENGINE", "torch")
+# torch引擎的推理优化: 空(不优化) | fold | jit | compile, 见talkingface/inference_optimize.py
+infer_optimize = os.getenv("DH_INFER_OPTIMIZE", "")
+# 推理精度: fp32 | int8(onnxruntime量化模型, 见talkingface/quantize_utils.py) | bf16(torch autocast)
+infer_precision = os.getenv("DH_INFER_PRECISION", "fp32")
 pca = None
-def LoadAudioModel(ckpt_path):
+def check_engine_precision(engine, precision):
+    # bf16只在torch引擎中通过autocast实现, onnx模型只有fp32和int8两种
+    if engine == "onnx" and precision == "bf16":
+        raise ValueError("onnx推理引擎不支持bf16精度, 请使用DH_INFER_ENGINE=torch或DH_INFER_PRECISION=fp32/int8")
+
+def LoadAudioModel(ckpt_path, engine = None, optimize = None, precision = None):
+    engine = engine or infer_engine
+    precision = precision or infer_precision
+    check_engine_precision(engine, precision)
+    if engine == "onnx" or precision == "int8":
+        from talkingface.onnx_utils import OnnxAudio2Feature, onnx_model_path
+        return OnnxAudio2Feature(onnx_model_path(ckpt_path, precision))
     # if method == "lstm":
     #     ckpt_path = 'checkpoint/lstm/lstm_model_epoch_560.pth'
     #     Audio2FeatureModel = torch.load(model_path).to(device)
@@ -17,6 +35,10 @@ def LoadAudioModel(ckpt_path):
     Audio2FeatureModel.load_state_dict(checkpoint)
     Audio2FeatureModel = Audio2FeatureModel.to(device)
     Audio2FeatureModel.eval()
+    optimize = optimize if optimize is not None else infer_optimize
+    if optimize or precision == "bf16":
+        from talkingface.inference_optimize import optimize_for_inference
+        Audio2FeatureModel = optimize_for_inference(Audio2FeatureModel, mode=optimize or "fold", precision=precision)
     return Audio2FeatureModel
 
 def LoadRenderModel(ckpt_path, model_name = "one_ref"):
@@ -31,9 +53,8 @@ def LoadRenderModel(ckpt_path, model_name = "one_ref"):
         source_channel = 6
         ref_channel = n_ref * 6
     net_g = DINet(source_channel, ref_channel).to(device)
-    checkpoint = torch.load(ckpt_path)
-    net_g_static = checkpoint['state_dict']['net_g']
-    net_g.load_state_dict(net_g_static)
+    from talkingface.checkpoint_utils import load_render_state_dict
+    net_g.load_state_dict(load_render_state_dict(ckpt_path))
     net_g.eval()
     return net_g
 
@@ -78,7 +99,10 @@ def Audio2mouth(wavpath, Audio2FeatureModel,  method = "lstm"):
 
     return bs_array
 from scipy.signal import resample
-def Audio2bs(wavpath, Audio2FeatureModel):
+def wav2fbank(wavpath):
+    '''
+    Audio2bs使用的8k采样80维fbank特征, 返回[2 * seq_len, 80]
+    '''
     rate, wav = wavfile.read(wavpath, mmap=False)
     wav = resample(wav, len(wav) //2)
     augmented_samples = wav
@@ -103,8 +127,10 @@ def Audio2bs(wavpath, Audio2FeatureModel):
     for i in range(2 * seq_len):
         f2 = fbank.get_frame(i)
         A2Lsamples[i] = f2
+    return A2Lsamples
 
-    orig_mel = A2Lsamples
+def Audio2bs(wavpath, Audio2FeatureModel):
+    orig_mel = wav2fbank(wavpath)
     # print(orig_mel.shape)
     input = torch.from_numpy(orig_mel).unsqueeze(0).float().to(device)
     # print(input.shape)
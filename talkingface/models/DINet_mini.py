@@ -317,11 +317,11 @@ class DINet_mini_pipeline(nn.Module):
 
         self.grid_tensor = F.affine_grid(torch.eye(2, 3).unsqueeze(0).float(), (1, 1, 128, 128), align_corners=False).to("cuda" if cuda else "cpu")
 
-        face_fusion_tensor = cv2.imread(os.path.join(current_dir, "../../mini_live/face_fusion_mask.png"))
-        face_fusion_tensor = torch.from_numpy(face_fusion_tensor[:,:,:1] / 255.).float().permute(2, 0, 1).unsqueeze(0)
-        mouth_fusion_tensor = cv2.imread(os.path.join(current_dir, "../../mini_live/mouth_fusion_mask.png"))
-        mouth_fusion_tensor = cv2.resize(mouth_fusion_tensor, (input_width, input_height))
-        mouth_fusion_tensor = torch.from_numpy(mouth_fusion_tensor[:,:,:1] / 255.).float().permute(2, 0, 1).unsqueeze(0)
+        from talkingface.asset_bundle import get_asset
+        face_fusion_tensor = get_asset("face_fusion_mask")
+        face_fusion_tensor = torch.from_numpy(face_fusion_tensor / 255.).float().unsqueeze(0).unsqueeze(0)
+        mouth_fusion_tensor = cv2.resize(np.asarray(get_asset("mouth_fusion_mask")), (input_width, input_height))
+        mouth_fusion_tensor = torch.from_numpy(mouth_fusion_tensor / 255.).float().unsqueeze(0).unsqueeze(0)
 
         self.face_fusion_tensor = face_fusion_tensor.to("cuda" if cuda else "cpu")
         self.mouth_fusion_tensor = mouth_fusion_tensor.to("cuda" if cuda else "cpu")
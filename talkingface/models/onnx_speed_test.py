@@ -0,0 +1,77 @@
+'''
+torch与onnxruntime推理的一致性和速度对比
+Usage: python -m talkingface.models.onnx_speed_test [<DINet_mini checkpoint> <lstm checkpoint>]
+不传checkpoint时使用随机初始化的权重
+'''
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import torch
+from talkingface.models.DINet_mini import DINet_mini_pipeline, input_height, input_width
+from talkingface.models.audio2bs_lstm import Audio2Feature
+from talkingface.onnx_utils import export_render_model_onnx, export_audio_model_onnx, OnnxRenderNet, OnnxAudio2Feature
+
+device = "cpu"
+
+
+def timeit(func, n = 200):
+    for _ in range(10):
+        func()
+    start_time = time.time()
+    for _ in range(n):
+        func()
+    return (time.time() - start_time) / n * 1000
+
+
+def main():
+    render_net = DINet_mini_pipeline(3, 4 * 3, cuda=False).eval()
+    audio_net = Audio2Feature().eval()
+    if len(sys.argv) == 3:
+        checkpoint = torch.load(sys.argv[1], map_location=device)
+        render_net.infer_model.load_state_dict(checkpoint['state_dict']['net_g'])
+        audio_net.load_state_dict(torch.load(sys.argv[2], map_location=device))
+
+    tmp_dir = tempfile.mkdtemp()
+    render_onnx = os.path.join(tmp_dir, "render.onnx")
+    audio_onnx = os.path.join(tmp_dir, "audio.onnx")
+    export_render_model_onnx(render_net, render_onnx)
+    export_audio_model_onnx(audio_net, audio_onnx)
+    onnx_render_net = OnnxRenderNet(render_onnx)
+    onnx_audio_net = OnnxAudio2Feature(audio_onnx)
+
+    # 渲染模型
+    source_tensor = torch.rand([1, 4, 128, 128])
+    gl_tensor = torch.rand([1, 4, 128, 128])
+    ref_tensor = torch.rand([1, 12, input_height, input_width])
+    with torch.no_grad():
+        render_net.ref_input(ref_tensor)
+        onnx_render_net.ref_input(ref_tensor)
+        out_torch = render_net.interface(source_tensor, gl_tensor)
+        out_onnx = onnx_render_net.interface(source_tensor, gl_tensor)
+        print("render max abs diff: {:.6f}".format((out_torch - out_onnx).abs().max().item()))
+        print("render torch: {:.3f} ms/frame".format(timeit(lambda: render_net.interface(source_tensor, gl_tensor))))
+    print("render onnx:  {:.3f} ms/frame".format(timeit(lambda: onnx_render_net.interface(source_tensor, gl_tensor))))
+
+    # 音频模型: 逐帧流式推理, h/c在帧间传递
+    mel = torch.rand([1, 2 * 250, 80])
+    h0 = torch.zeros(2, 1, 192)
+    c0 = torch.zeros(2, 1, 192)
+    with torch.no_grad():
+        pred_torch, _, _ = audio_net(mel, h0, c0)
+    h, c = h0, c0
+    pred_onnx = []
+    for i in range(0, mel.size(1), 2):
+        pred, h, c = onnx_audio_net(mel[:, i:i + 2], h, c)
+        pred_onnx.append(pred)
+    pred_onnx = torch.cat(pred_onnx, 1)
+    print("audio max abs diff (streaming vs full): {:.6f}".format((pred_torch - pred_onnx).abs().max().item()))
+    step = mel[:, :2]
+    with torch.no_grad():
+        print("audio torch: {:.3f} ms/step".format(timeit(lambda: audio_net(step, h0, c0))))
+    print("audio onnx:  {:.3f} ms/step".format(timeit(lambda: onnx_audio_net(step, h0, c0))))
+
+
+if __name__ == "__main__":
+    main()
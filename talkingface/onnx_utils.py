@@ -0,0 +1,196 @@
+import os
+import sys
+import numpy as np
+import torch
+import torch.nn as nn
+from talkingface.models.DINet_mini import input_height, input_width
+
+# DINet_mini_pipeline中AdaAT使用5维grid_sample，需要opset 20才能导出
+RENDER_OPSET = 20
+AUDIO_OPSET = 17
+
+
+class DINetMiniOnnxWrapper(nn.Module):
+    '''
+    DINet_mini_pipeline.interface的导出包装, ref_in_feature作为显式输入, 换人物时无需重新导出
+    '''
+    def __init__(self, pipeline):
+        super(DINetMiniOnnxWrapper, self).__init__()
+        self.pipeline = pipeline
+
+    def forward(self, source_tensor, gl_tensor, ref_in_feature):
+        self.pipeline.infer_model.ref_in_feature = ref_in_feature
+        return self.pipeline.interface(source_tensor, gl_tensor)
+
+
+class DINetMiniRefOnnxWrapper(nn.Module):
+    '''
+    参考图编码器(ref_in_conv)的导出包装, 只在reset_charactor时调用一次
+    '''
+    def __init__(self, pipeline):
+        super(DINetMiniRefOnnxWrapper, self).__init__()
+        self.ref_in_conv = pipeline.infer_model.ref_in_conv
+
+    def forward(self, ref_tensor):
+        return self.ref_in_conv(ref_tensor)
+
+
+class Audio2FeatureStepWrapper(nn.Module):
+    '''
+    Audio2Feature的导出包装, h/c作为显式输入输出, 序列长度可变(batch固定为1)
+    既可以每次输入2帧fbank做流式推理, 也可以一次输入整段音频
+    '''
+    def __init__(self, net):
+        super(Audio2FeatureStepWrapper, self).__init__()
+        self.net = net
+
+    def forward(self, audio_features, h0, c0):
+        down_audio_feats = self.net.downsample(audio_features.reshape(-1, self.net.ndim * 2))
+        down_audio_feats = down_audio_feats.reshape(1, -1, self.net.ndim)
+        output, (hn, cn) = self.net.LSTM(down_audio_feats, (h0, c0))
+        pred = self.net.fc(output.reshape(-1, 192)).reshape(1, -1, self.net.output_size)
+        return pred, hn, cn
+
+
+def export_render_model_onnx(pipeline, onnx_path):
+    '''
+    导出DINet_mini_pipeline, 生成onnx_path(逐帧推理)和*_ref.onnx(参考图编码)两个文件
+    '''
+    pipeline = pipeline.cpu().eval()
+    source_tensor = torch.rand([1, 4, 128, 128])
+    gl_tensor = torch.rand([1, 4, 128, 128])
+    ref_tensor = torch.rand([1, 12, input_height, input_width])
+    with torch.no_grad():
+        ref_in_feature = pipeline.infer_model.ref_in_conv(ref_tensor)
+        torch.onnx.export(DINetMiniOnnxWrapper(pipeline).eval(), (source_tensor, gl_tensor, ref_in_feature), onnx_path,
+                          input_names=["source_tensor", "gl_tensor", "ref_in_feature"],
+                          output_names=["warped_img"], opset_version=RENDER_OPSET, dynamo=False)
+        torch.onnx.export(DINetMiniRefOnnxWrapper(pipeline).eval(), (ref_tensor,), ref_onnx_path(onnx_path),
+                          input_names=["ref_tensor"], output_names=["ref_in_feature"],
+                          opset_version=RENDER_OPSET, dynamo=False)
+
+
+def export_audio_model_onnx(net, onnx_path):
+    net = net.cpu().eval()
+    audio_features = torch.rand([1, 2, 80])
+    h0 = torch.zeros(2, 1, 192)
+    c0 = torch.zeros(2, 1, 192)
+    with torch.no_grad():
+        torch.onnx.export(Audio2FeatureStepWrapper(net).eval(), (audio_features, h0, c0), onnx_path,
+                          input_names=["audio_features", "h0", "c0"], output_names=["pred", "hn", "cn"],
+                          dynamic_axes={"audio_features": {1: "T"}, "pred": {1: "T_half"}},
+                          opset_version=AUDIO_OPSET, dynamo=False)
+
+
+def onnx_model_path(ckpt_path, precision = "fp32"):
+    '''
+    checkpoint对应的onnx文件: fp32为<ckpt>.onnx, int8为<ckpt>_int8.onnx(由talkingface.quantize_utils生成)
+    '''
+    suffix = "_int8.onnx" if precision == "int8" else ".onnx"
+    return os.path.splitext(ckpt_path)[0] + suffix
+
+
+def ref_onnx_path(onnx_path):
+    return os.path.splitext(onnx_path)[0] + "_ref.onnx"
+
+
+def create_onnx_session(onnx_path, intra_op_num_threads=None):
+    '''
+    创建CPU推理session。两个模型都很小, 线程过多反而增加同步开销, 默认最多4线程,
+    可通过环境变量ORT_INTRA_OP_THREADS覆盖
+    '''
+    import onnxruntime as ort
+    if not os.path.isfile(onnx_path):
+        raise FileNotFoundError("{} 不存在, 请先运行 python -m talkingface.onnx_utils 导出".format(onnx_path))
+    if intra_op_num_threads is None:
+        intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", min(4, os.cpu_count() or 1)))
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+class _RefFeatureHolder:
+    # 与torch版本保持相同的访问方式: net.infer_model.ref_in_feature
+    def __init__(self):
+        self.ref_in_feature = None
+
+
+class OnnxRenderNet:
+    '''
+    onnxruntime版DINet_mini_pipeline, 接口与torch版本一致(ref_input/interface, 输入输出为torch tensor)
+    '''
+    def __init__(self, onnx_path, intra_op_num_threads=None):
+        self.session = create_onnx_session(onnx_path, intra_op_num_threads)
+        self.ref_session = create_onnx_session(ref_onnx_path(onnx_path), intra_op_num_threads)
+        self.infer_model = _RefFeatureHolder()
+
+    def ref_input(self, ref_tensor):
+        ref_in_feature = self.ref_session.run(None, {"ref_tensor": _to_numpy(ref_tensor)})[0]
+        self.infer_model.ref_in_feature = torch.from_numpy(ref_in_feature)
+
+    def interface(self, source_tensor, gl_tensor):
+        out = self.session.run(None, {
+            "source_tensor": _to_numpy(source_tensor),
+            "gl_tensor": _to_numpy(gl_tensor),
+            "ref_in_feature": _to_numpy(self.infer_model.ref_in_feature),
+        })[0]
+        return torch.from_numpy(out)
+
+    def eval(self):
+        return self
+
+
+class OnnxAudio2Feature:
+    '''
+    onnxruntime版Audio2Feature, 调用方式与torch模型一致: pred, hn, cn = model(input, h0, c0)
+    '''
+    def __init__(self, onnx_path, intra_op_num_threads=None):
+        self.session = create_onnx_session(onnx_path, intra_op_num_threads)
+
+    def __call__(self, audio_features, h0, c0):
+        pred, hn, cn = self.session.run(None, {
+            "audio_features": _to_numpy(audio_features),
+            "h0": _to_numpy(h0),
+            "c0": _to_numpy(c0),
+        })
+        return torch.from_numpy(pred), torch.from_numpy(hn), torch.from_numpy(cn)
+
+    def eval(self):
+        return self
+
+
+def _to_numpy(tensor):
+    if isinstance(tensor, torch.Tensor):
+        tensor = tensor.detach().cpu().numpy()
+    return np.ascontiguousarray(tensor, dtype=np.float32)
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) != 3:
+        print("Usage: python -m talkingface.onnx_utils <DINet_mini checkpoint> <lstm checkpoint>")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    from talkingface.model_utils import LoadAudioModel
+    from talkingface.checkpoint_utils import load_render_state_dict
+    from talkingface.models.DINet_mini import DINet_mini_pipeline
+    render_ckpt, audio_ckpt = sys.argv[1], sys.argv[2]
+
+    # 导出统一在CPU上进行(AdaAT的网格在构造时就确定了设备)
+    render_net = DINet_mini_pipeline(3, 4 * 3, cuda=False)
+    render_net.infer_model.load_state_dict(load_render_state_dict(render_ckpt))
+    render_onnx = onnx_model_path(render_ckpt)
+    export_render_model_onnx(render_net, render_onnx)
+    print("已导出: {} {}".format(render_onnx, ref_onnx_path(render_onnx)))
+
+    Audio2FeatureModel = LoadAudioModel(audio_ckpt, engine="torch")
+    audio_onnx = onnx_model_path(audio_ckpt)
+    export_audio_model_onnx(Audio2FeatureModel, audio_onnx)
+    print("已导出: {}".format(audio_onnx))
+
+
+if __name__ == "__main__":
+    main()
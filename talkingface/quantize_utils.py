@@ -0,0 +1,250 @@
+'''
+CPU推理的INT8量化与精度报告
+
+- DINet_mini: onnxruntime静态量化(QDQ, 只量化Conv, 权重per-channel int8), 用准备好的数字人数据做校准
+- Audio2Feature: onnxruntime动态量化(LSTM/MatMul/Gemm权重int8)
+- 同时统计fp32/int8/bf16三种精度相对fp32的画质(PSNR/SSIM)和速度, 写入<DINet_mini checkpoint>_quant_report.json
+
+Usage: python -m talkingface.quantize_utils <DINet_mini checkpoint> <lstm checkpoint> <wav_path> <asset_path> [<asset_path> ...]
+asset_path为data_preparation_web.py生成的assets目录(包含01.mp4和data), 或发布后的website/<id>/assets
+部署时设置环境变量DH_INFER_PRECISION=int8即可加载量化模型
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import numpy as np
+import cv2
+import torch
+from talkingface.models.DINet_mini import input_height, input_width
+from talkingface.onnx_utils import onnx_model_path, ref_onnx_path, OnnxRenderNet, OnnxAudio2Feature
+
+# 每个数字人用于校准和评估的帧数
+CALIBRATION_FRAMES = 32
+EVALUATION_FRAMES = 16
+
+
+def collect_render_samples(asset_path, bs_array, num_frames):
+    '''
+    按demo_mini.py的流程生成DINet_mini的输入, 帧在视频中均匀采样, 嘴型取自bs_array
+    Returns:
+        list of dict: source_tensor [1,4,128,128], gl_tensor [1,4,128,128], ref_in_feature [1,20,h/4,w/4]
+    '''
+    from mini_live.render import create_render_model
+    from talkingface.data.few_shot_dataset import get_image
+    from talkingface.avatar_data import load_avatar_data
+
+    standard_size = 256
+    renderModel_gl = create_render_model((standard_size, standard_size), floor=20)
+    avatar_data = load_avatar_data(asset_path)
+    ref_in_feature = avatar_data["ref_data"].reshape([1, 20, input_height // 4, input_width // 4])
+    renderModel_gl.GenVBO(avatar_data["face_verts"])
+
+    cap = cv2.VideoCapture(os.path.join(asset_path, "01.mp4"))
+    frame_count = min(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), avatar_data["frame_num"])
+    frame_indexes = set(np.linspace(0, frame_count - 1, num_frames).astype(int).tolist())
+    samples = []
+    for frame_index in range(frame_count):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_index not in frame_indexes:
+            continue
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+        standard_img = get_image(frame, avatar_data["rects"][frame_index], input_type="image", resize=standard_size)
+        standard_v = avatar_data["points"][frame_index].reshape(-1, 2) * 2
+        mat_world = avatar_data["mats"][frame_index].reshape(4, 4) * 2
+
+        bs = np.zeros([12], dtype=np.float32)
+        bs[:6] = bs_array[len(samples) % len(bs_array), :6]
+        bs[1] = bs[1] / 2 * 1.6
+        rgba = renderModel_gl.render2cv(standard_v[:, :2] / 256. * 2 - 1, out_size=(standard_size, standard_size),
+                                        mat_world=mat_world, bs_array=bs)
+        rgba = rgba[::2, ::2, :]
+        source_tensor = cv2.resize(standard_img, (128, 128))
+        samples.append({
+            "source_tensor": (source_tensor / 255.).astype(np.float32).transpose(2, 0, 1)[np.newaxis],
+            "gl_tensor": (rgba / 255.).astype(np.float32).transpose(2, 0, 1)[np.newaxis],
+            "ref_in_feature": ref_in_feature,
+        })
+    cap.release()
+    return samples
+
+
+class _SampleReader:
+    # onnxruntime.quantization.CalibrationDataReader接口
+    def __init__(self, samples):
+        self.samples = iter(samples)
+
+    def get_next(self):
+        return next(self.samples, None)
+
+    def rewind(self):
+        pass
+
+
+def quantize_render_model(onnx_path, samples, int8_path):
+    '''
+    静态量化DINet_mini, 参考图编码器(_ref.onnx)每个人物只运行一次, 直接复制fp32版本
+    '''
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    pre_path = os.path.splitext(int8_path)[0] + "_pre.onnx"
+    quant_pre_process(onnx_path, pre_path)
+    quantize_static(pre_path, int8_path, _SampleReader(samples), quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=["Conv"], per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    os.remove(pre_path)
+    shutil.copy(ref_onnx_path(onnx_path), ref_onnx_path(int8_path))
+
+
+def quantize_audio_model(onnx_path, int8_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(onnx_path, int8_path, op_types_to_quantize=["LSTM", "MatMul", "Gemm"], weight_type=QuantType.QInt8)
+
+
+def psnr(img0, img1):
+    mse = np.mean((img0.astype(np.float64) - img1.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def ssim(img0, img1):
+    # 高斯窗口11x11, sigma=1.5, 各通道取平均
+    C1 = (0.01 * 255) ** 2
+    C2 = (0.03 * 255) ** 2
+    img0 = img0.astype(np.float64)
+    img1 = img1.astype(np.float64)
+    mu0 = cv2.GaussianBlur(img0, (11, 11), 1.5)
+    mu1 = cv2.GaussianBlur(img1, (11, 11), 1.5)
+    sigma0 = cv2.GaussianBlur(img0 * img0, (11, 11), 1.5) - mu0 ** 2
+    sigma1 = cv2.GaussianBlur(img1 * img1, (11, 11), 1.5) - mu1 ** 2
+    sigma01 = cv2.GaussianBlur(img0 * img1, (11, 11), 1.5) - mu0 * mu1
+    ssim_map = ((2 * mu0 * mu1 + C1) * (2 * sigma01 + C2)) / ((mu0 ** 2 + mu1 ** 2 + C1) * (sigma0 + sigma1 + C2))
+    return float(ssim_map.mean())
+
+
+def _to_image(tensor):
+    image_numpy = tensor.detach().squeeze(0).cpu().float().numpy()[:3]
+    return (np.transpose(image_numpy, (1, 2, 0)) * 255.0).clip(0, 255).astype(np.uint8)
+
+
+def _render_outputs(render_net, samples):
+    outputs = []
+    times = []
+    with torch.no_grad():
+        for sample in samples:
+            render_net.infer_model.ref_in_feature = torch.from_numpy(sample["ref_in_feature"])
+            source_tensor = torch.from_numpy(sample["source_tensor"])
+            gl_tensor = torch.from_numpy(sample["gl_tensor"])
+            start_time = time.time()
+            out = render_net.interface(source_tensor, gl_tensor)
+            times.append(time.time() - start_time)
+            outputs.append(_to_image(out))
+    # 去掉前几帧的预热耗时
+    return outputs, np.mean(times[min(4, len(times) - 1):]) * 1000
+
+
+def _audio_outputs(audio_net, mel):
+    h = torch.zeros(2, 1, 192)
+    c = torch.zeros(2, 1, 192)
+    preds = []
+    start_time = time.time()
+    with torch.no_grad():
+        for i in range(0, mel.size(1) - 1, 2):
+            pred, h, c = audio_net(mel[:, i:i + 2], h, c)
+            preds.append(pred)
+    return torch.cat(preds, 1).squeeze(0).numpy(), (time.time() - start_time) / len(preds) * 1000
+
+
+def quality_report(render_nets, audio_nets, samples, mel):
+    '''
+    Args:
+        render_nets / audio_nets: {precision: model}, 必须包含fp32作为基准
+    '''
+    report = {"render": {}, "audio": {}}
+    fp32_images, _ = _render_outputs(render_nets["fp32"], samples)
+    for precision, render_net in render_nets.items():
+        images, ms = _render_outputs(render_net, samples)
+        report["render"][precision] = {
+            "psnr": float(np.mean([min(psnr(i, j), 100.) for i, j in zip(fp32_images, images)])),
+            "ssim": float(np.mean([ssim(i, j) for i, j in zip(fp32_images, images)])),
+            "ms_per_frame": float(ms),
+        }
+    fp32_bs, _ = _audio_outputs(audio_nets["fp32"], mel)
+    for precision, audio_net in audio_nets.items():
+        bs, ms = _audio_outputs(audio_net, mel)
+        report["audio"][precision] = {
+            "bs_mean_abs_error": float(np.abs(bs - fp32_bs).mean()),
+            "bs_max_abs_error": float(np.abs(bs - fp32_bs).max()),
+            "ms_per_step": float(ms),
+        }
+    return report
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) < 5:
+        print("Usage: python -m talkingface.quantize_utils <DINet_mini checkpoint> <lstm checkpoint> <wav_path> <asset_path> [<asset_path> ...]")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    import copy
+    from talkingface.model_utils import wav2fbank
+    from talkingface.checkpoint_utils import load_render_state_dict
+    from talkingface.models.DINet_mini import DINet_mini_pipeline
+    from talkingface.models.audio2bs_lstm import Audio2Feature
+    from talkingface.onnx_utils import export_render_model_onnx, export_audio_model_onnx
+    from talkingface.inference_optimize import optimize_for_inference
+    render_ckpt, audio_ckpt, wav_path, asset_paths = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4:]
+
+    # 量化面向CPU部署, fp32基准模型也在CPU上构建
+    render_net = DINet_mini_pipeline(3, 4 * 3, cuda=False)
+    render_net.infer_model.load_state_dict(load_render_state_dict(render_ckpt))
+    render_net.eval()
+    audio_net = Audio2Feature()
+    audio_net.load_state_dict(torch.load(audio_ckpt, map_location="cpu"))
+    audio_net.eval()
+
+    render_onnx = onnx_model_path(render_ckpt)
+    audio_onnx = onnx_model_path(audio_ckpt)
+    if not os.path.isfile(render_onnx) or not os.path.isfile(ref_onnx_path(render_onnx)):
+        export_render_model_onnx(render_net, render_onnx)
+    if not os.path.isfile(audio_onnx):
+        export_audio_model_onnx(audio_net, audio_onnx)
+
+    mel = torch.from_numpy(wav2fbank(wav_path)).unsqueeze(0).float()
+    bs_array, _ = _audio_outputs(audio_net, mel)
+    bs_array = bs_array[5:] * 0.5
+    calibration_samples = []
+    evaluation_samples = []
+    for asset_path in asset_paths:
+        samples = collect_render_samples(asset_path, bs_array, CALIBRATION_FRAMES + EVALUATION_FRAMES)
+        calibration_samples += samples[0::3] + samples[1::3]
+        evaluation_samples += samples[2::3]
+    print("校准样本 {} 帧, 评估样本 {} 帧".format(len(calibration_samples), len(evaluation_samples)))
+
+    render_int8 = onnx_model_path(render_ckpt, "int8")
+    audio_int8 = onnx_model_path(audio_ckpt, "int8")
+    quantize_render_model(render_onnx, calibration_samples, render_int8)
+    quantize_audio_model(audio_onnx, audio_int8)
+    print("已导出: {} {}".format(render_int8, audio_int8))
+
+    render_nets = {
+        "fp32": render_net,
+        "int8": OnnxRenderNet(render_int8),
+        "bf16": optimize_for_inference(copy.deepcopy(render_net), precision="bf16"),
+    }
+    audio_nets = {
+        "fp32": audio_net,
+        "int8": OnnxAudio2Feature(audio_int8),
+        "bf16": optimize_for_inference(copy.deepcopy(audio_net), precision="bf16"),
+    }
+    report = quality_report(render_nets, audio_nets, evaluation_samples, mel)
+    report_path = os.path.splitext(render_ckpt)[0] + "_quant_report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
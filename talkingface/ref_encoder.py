@@ -0,0 +1,106 @@
+'''
+数据预处理使用的常驻参考图编码器
+
+data_preparation_web生成ref_in_feature时只需要DINet_mini的参考图编码(ref_in_conv)。
+每个训练任务不再各自创建RenderModel_Mini、读取checkpoint, 进程内共享一个模型(get_ref_encoder),
+编码在单独的线程中执行: 多个数字人同时预处理时, 排队中的请求(最多DH_REF_MAX_BATCH个,
+第一个请求到达后最多再等待DH_REF_BATCH_WAIT_MS毫秒)合并为一个batch编码。
+onnx引擎导出的参考图编码器batch固定为1, 合并后逐个编码。
+牙齿参考图来自静态资源包(get_asset("teeth_ref")), 进程内只读取一次。
+ref_in_feature写入发布的数字人数据, 与渲染使用的DH_INFER_ENGINE/DH_INFER_OPTIMIZE/DH_INFER_PRECISION无关,
+始终用fp32 torch模型编码。
+'''
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import torch
+
+from talkingface.render_model_mini import RenderModel_Mini, build_ref_image, ref_image_tensor
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+
+REF_CKPT_PATH = os.path.join(root_dir, "checkpoint", "DINet_mini", "epoch_40.pth")
+REF_MAX_BATCH = int(os.getenv("DH_REF_MAX_BATCH", 8))
+REF_BATCH_WAIT_MS = float(os.getenv("DH_REF_BATCH_WAIT_MS", 5))
+
+
+class RefEncoder:
+    def __init__(self, ckpt_path = REF_CKPT_PATH, model = None, max_batch = None, wait_ms = None):
+        '''
+        Args:
+            model: 已加载的RenderModel_Mini, 默认从ckpt_path加载
+        '''
+        if model is None:
+            model = RenderModel_Mini()
+            model.loadModel(ckpt_path, engine="torch", optimize="", precision="fp32")
+        self.model = model
+        self.batched = isinstance(model.net, torch.nn.Module)
+        self.max_batch = max_batch or REF_MAX_BATCH
+        self.wait = (REF_BATCH_WAIT_MS if wait_ms is None else wait_ms) / 1000.
+        self.queue = queue.Queue()
+        # 每个batch的大小, 便于观察合并效果
+        self.batch_sizes = []
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def encode(self, ref_img, ref_keypoints, standard_size = 256):
+        '''
+        参数与RenderModel_Mini.reset_charactor相同, 可在多个线程中同时调用
+        Returns:
+            ref_in_feature展平后的float32数组
+        '''
+        ref_img, _ = build_ref_image(ref_img, ref_keypoints, standard_size)
+        future = Future()
+        self.queue.put((ref_image_tensor(ref_img), future))
+        return future.result()
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(items) < self.max_batch:
+            try:
+                items.append(self.queue.get(timeout=max(0., deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return items
+
+    def _encode(self, tensors):
+        net = self.model.net
+        batches = [torch.cat(tensors)] if self.batched else [[i] for i in tensors]
+        features = []
+        with torch.no_grad():
+            for batch in batches:
+                net.ref_input(batch if self.batched else batch[0])
+                ref_in_feature = net.infer_model.ref_in_feature.detach().cpu().float()
+                features += [i.numpy().flatten() for i in ref_in_feature]
+        return features
+
+    def _loop(self):
+        while True:
+            items = self._collect()
+            self.batch_sizes.append(len(items))
+            try:
+                features = self._encode([tensor for tensor, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), feature in zip(items, features):
+                future.set_result(feature)
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_ref_encoder():
+    '''
+    进程内共享的参考图编码器, 首次调用时加载模型
+    '''
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = RefEncoder()
+    return _encoder
@@ -6,13 +6,27 @@ import time
 from talkingface.run_utils import smooth_array, video_pts_process
 from talkingface.run_utils import mouth_replace, prepare_video_data
 from talkingface.utils import generate_face_mask, INDEX_LIPS_OUTER
-from talkingface.data.few_shot_dataset import select_ref_index,get_ref_images_fromVideo,generate_input, generate_input_pixels
+from talkingface.data.few_shot_dataset import select_ref_index,get_ref_images_fromVideo,generate_input, prepare_input_pixels, generate_input_pixels_cached
 from talkingface.model_utils import device
 import pickle
 import cv2
 
 
-face_mask = generate_face_mask()
+face_mask = generate_face_mask().astype(np.float32)
+face_mask_inv = 1 - face_mask
+
+
+def make_mouth_coords_array(x_min, x_max, y_min, y_max, z_min, z_max, rows = 100, cols = 150):
+    '''
+    生成嘴部像素图(rows*cols)对应的标准化人脸空间坐标, 返回[4, rows*cols]齐次坐标
+    '''
+    jj, ii = np.meshgrid(np.arange(cols), np.arange(rows))
+    coords_array = np.ones([rows, cols, 4])
+    coords_array[:, :, 0] = jj / (cols - 1)
+    coords_array[:, :, 1] = ii / rows
+    coords_array[:, :, 2] = ((jj - cols // 2) / (cols // 2)) ** 2
+    coords_array = coords_array * np.array([x_max - x_min, y_max - y_min, z_max - z_min, 1]) + np.array([x_min, y_min, z_min, 0])
+    return coords_array.reshape(-1, 4).transpose(1, 0)
 
 
 class RenderModel:
@@ -27,6 +41,9 @@ class RenderModel:
         self.__cap_input = None
         self.frame_index = 0
         self.__mouth_coords_array = None
+        # 预解码的视频帧和每帧预计算的裁剪信息
+        self.__frame_buffer = None
+        self.__frame_cache = None
 
     def loadModel(self, ckpt_path):
         from talkingface.models.DINet import DINet_five_Ref as DINet
@@ -58,53 +75,51 @@ class RenderModel:
         y_min, y_max = y_mid - y_len*0.9, y_mid + y_len*0.9
         z_min, z_max = z_mid - z_len*0.9, z_mid + z_len*0.9
 
-        # print(face_personal.shape, x_min, x_max, y_min, y_max, z_min, z_max)
-        coords_array = np.zeros([100, 150, 4])
-        for i in range(100):
-            for j in range(150):
-                coords_array[i, j, 0] = j/149
-                coords_array[i, j, 1] = i/100
-                # coords_array[i, j, 2] = int((-75 + abs(j - 75))*(2./3))
-                coords_array[i, j, 2] = ((j - 75)/ 75) ** 2
-                coords_array[i, j, 3] = 1
-
-        coords_array = coords_array*np.array([x_max - x_min, y_max - y_min, z_max - z_min, 1]) + np.array([x_min, y_min, z_min, 0])
-        self.__mouth_coords_array = coords_array.reshape(-1, 4).transpose(1, 0)
-
+        self.__mouth_coords_array = make_mouth_coords_array(x_min, x_max, y_min, y_max, z_min, z_max)
+
+        # 视频帧一次性解码到内存，之后按索引取帧，不再每帧seek/read
+        self.__cap_input.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.__frame_buffer = []
+        while len(self.__frame_buffer) < len(self.__mat_list):
+            ret, frame = self.__cap_input.read()
+            if not ret:
+                break
+            self.__frame_buffer.append(frame)
+        self.__cap_input.release()
+        self.__cap_input = None
+        assert len(self.__frame_buffer) > 0, "视频无有效帧"
 
+        # 与音频无关的裁剪、抠图、线条绘制每帧只算一次
+        self.__frame_cache = [prepare_input_pixels(frame, self.__pts_driven[index_], self.__mat_list[index_],
+                                                   self.__face_mask_pts[index_], self.__mouth_coords_array)
+                              for index_, frame in enumerate(self.__frame_buffer)]
+        self.frame_index = 0
 
     def interface(self, mouth_frame):
-        vid_frame_count = self.__cap_input.get(cv2.CAP_PROP_FRAME_COUNT)
-        if self.frame_index % vid_frame_count == 0:
-            self.__cap_input.set(cv2.CAP_PROP_POS_FRAMES, 0)  # 设置要获取的帧号
-        ret, frame = self.__cap_input.read()  # 按帧读取视频
-
-        epoch = self.frame_index // len(self.__mat_list)
+        # 正放、倒放循环播放，视频帧与关键点使用相同的索引
+        frame_num = len(self.__frame_buffer)
+        epoch = self.frame_index // frame_num
         if epoch % 2 == 0:
-            new_index = self.frame_index % len(self.__mat_list)
+            new_index = self.frame_index % frame_num
         else:
-            new_index = -1 - self.frame_index % len(self.__mat_list)
+            new_index = -1 - self.frame_index % frame_num
+        frame_cache = self.__frame_cache[new_index]
 
-        # print(self.__face_mask_pts.shape, "ssssssss")
-        source_img, target_img, crop_coords = generate_input_pixels(frame, self.__pts_driven[new_index], self.__mat_list[new_index],
-                                                                    mouth_frame, self.__face_mask_pts[new_index],
-                                                                    self.__mouth_coords_array)
+        source_img, target_img, crop_coords = generate_input_pixels_cached(frame_cache, mouth_frame)
 
         # tensor
-        source_tensor = torch.from_numpy(source_img / 255.).float().permute(2, 0, 1).unsqueeze(0).to(device)
-        target_tensor = torch.from_numpy(target_img / 255.).float().permute(2, 0, 1).unsqueeze(0).to(device)
+        source_tensor = torch.from_numpy(source_img).to(device).permute(2, 0, 1).unsqueeze(0).float().div_(255.)
 
         source_tensor, source_prompt_tensor = source_tensor[:, :3], source_tensor[:, 3:]
-        fake_out = self.__net.interface(source_tensor, source_prompt_tensor)
+        with torch.no_grad():
+            fake_out = self.__net.interface(source_tensor, source_prompt_tensor)
 
-        image_numpy = fake_out.detach().squeeze(0).cpu().float().numpy()
-        image_numpy = np.transpose(image_numpy, (1, 2, 0)) * 255.0
-        image_numpy = image_numpy.clip(0, 255)
-        image_numpy = image_numpy.astype(np.uint8)
+        image_numpy = fake_out.squeeze(0).permute(1, 2, 0).cpu().float().numpy() * 255.0
+        image_numpy = image_numpy.clip(0, 255).astype(np.uint8)
 
-        image_numpy = target_img * face_mask + image_numpy * (1 - face_mask)
+        image_numpy = (target_img * face_mask + image_numpy * face_mask_inv).astype(np.uint8)
 
-        img_bg = frame
+        img_bg = self.__frame_buffer[new_index].copy()
         x_min, y_min, x_max, y_max = crop_coords
 
         img_face = cv2.resize(image_numpy, (x_max - x_min, y_max - y_min))
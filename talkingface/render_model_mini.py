@@ -8,54 +8,83 @@ import cv2
 
 from talkingface.utils import draw_mouth_maps
 from talkingface.models.DINet_mini import input_height,input_width
-from talkingface.model_utils import device
+from talkingface.model_utils import device, infer_engine, infer_optimize, infer_precision, check_engine_precision
+
+
+def build_ref_image(ref_img, ref_keypoints, standard_size = 256):
+    '''
+    参考图: 人物图像+嘴部轮廓图, 拼接两张随机选取的牙齿参考图(静态资源包中, 进程内只读取一次)
+    Returns:
+        ref_img: [input_height, input_width, 12]
+        ref_img_save: 三张参考图横向拼接的RGB图, 用于调试查看
+    '''
+    ref_img_list = []
+    ref_face_edge = draw_mouth_maps(ref_keypoints, size=(standard_size, standard_size))
+    # cv2.imshow("ss", ref_face_edge)
+    # cv2.waitKey(-1)
+    # cv2.imshow("ss", ref_img)
+    # cv2.waitKey(-1)
+    ref_face_edge = cv2.resize(ref_face_edge, (128, 128))
+    ref_img = cv2.resize(ref_img, (128, 128))
+    w_pad = int((128 - input_width) / 2)
+    h_pad = int((128 - input_height) / 2)
+
+    ref_img = np.concatenate(
+        [ref_img[h_pad:-h_pad, w_pad:-w_pad, :3], ref_face_edge[h_pad:-h_pad, w_pad:-w_pad, :1]], axis=2)
+    # cv2.imshow("ss", ref_face_edge[h_pad:-h_pad, w_pad:-w_pad])
+    # cv2.waitKey(-1)
+    ref_img_list.append(ref_img)
+
+    from talkingface.asset_bundle import get_asset
+    teeth_ref = get_asset("teeth_ref")
+    teeth_ref_img = np.array(teeth_ref[random.randrange(len(teeth_ref))])
+    ref_img_list.append(teeth_ref_img)
+    ref_img_list.append(teeth_ref_img)
+
+    ref_img_save = np.concatenate([i[:,:,:3] for i in ref_img_list], axis=1)
+    return np.concatenate(ref_img_list, axis=2), ref_img_save
+
+
+def ref_image_tensor(ref_img):
+    '''
+    build_ref_image的结果转为[1, 12, input_height, input_width]的tensor
+    '''
+    return torch.from_numpy(ref_img / 255.).float().permute(2, 0, 1).unsqueeze(0).to(device)
+
+
 class RenderModel_Mini:
     def __init__(self):
         self.__net = None
 
-    def loadModel(self, ckpt_path):
+    def loadModel(self, ckpt_path, engine = None, optimize = None, precision = None):
+        engine = engine or infer_engine
+        precision = precision or infer_precision
+        check_engine_precision(engine, precision)
+        if engine == "onnx" or precision == "int8":
+            # onnxruntime推理, 仅支持CPU; int8模型只有onnx版本
+            from talkingface.onnx_utils import OnnxRenderNet, onnx_model_path
+            self.net = OnnxRenderNet(onnx_model_path(ckpt_path, precision))
+            return
         from talkingface.models.DINet_mini import DINet_mini_pipeline as DINet
         n_ref = 3
         source_channel = 3
         ref_channel = n_ref * 4
         self.net = DINet(source_channel, ref_channel, device == "cuda").to(device)
-        checkpoint = torch.load(ckpt_path, map_location=device)
-        net_g_static = checkpoint['state_dict']['net_g']
-        self.net.infer_model.load_state_dict(net_g_static)
+        from talkingface.checkpoint_utils import load_render_state_dict
+        self.net.infer_model.load_state_dict(load_render_state_dict(ckpt_path))
         self.net.eval()
+        optimize = optimize if optimize is not None else infer_optimize
+        if optimize or precision == "bf16":
+            from talkingface.inference_optimize import optimize_for_inference
+            self.net = optimize_for_inference(self.net, mode=optimize or "fold", precision=precision)
 
 
     def reset_charactor(self, ref_img, ref_keypoints, standard_size = 256):
-        ref_img_list = []
-        ref_face_edge = draw_mouth_maps(ref_keypoints, size=(standard_size, standard_size))
-        # cv2.imshow("ss", ref_face_edge)
-        # cv2.waitKey(-1)
-        # cv2.imshow("ss", ref_img)
-        # cv2.waitKey(-1)
-        ref_face_edge = cv2.resize(ref_face_edge, (128, 128))
-        ref_img = cv2.resize(ref_img, (128, 128))
-        w_pad = int((128 - input_width) / 2)
-        h_pad = int((128 - input_height) / 2)
-
-        ref_img = np.concatenate(
-            [ref_img[h_pad:-h_pad, w_pad:-w_pad, :3], ref_face_edge[h_pad:-h_pad, w_pad:-w_pad, :1]], axis=2)
-        # cv2.imshow("ss", ref_face_edge[h_pad:-h_pad, w_pad:-w_pad])
-        # cv2.waitKey(-1)
-        ref_img_list.append(ref_img)
-
-        teeth_ref_img = os.path.join(current_dir, r"../video_data/teeth_ref/*.png")
-        teeth_ref_img = random.sample(glob.glob(teeth_ref_img), 1)[0]
-        teeth_ref_img = teeth_ref_img.replace("_2", "")
-        teeth_ref_img = cv2.imread(teeth_ref_img, cv2.IMREAD_UNCHANGED)
-        ref_img_list.append(teeth_ref_img)
-        ref_img_list.append(teeth_ref_img)
-
-        self.ref_img_save = np.concatenate([i[:,:,:3] for i in ref_img_list], axis=1)
-        self.ref_img = np.concatenate(ref_img_list, axis=2)
-
-        ref_tensor = torch.from_numpy(self.ref_img / 255.).float().permute(2, 0, 1).unsqueeze(0).to(device)
-
-        self.net.ref_input(ref_tensor)
+        self.ref_img, self.ref_img_save = build_ref_image(ref_img, ref_keypoints, standard_size)
+        ref_tensor = ref_image_tensor(self.ref_img)
+
+        with torch.no_grad():
+            self.net.ref_input(ref_tensor)
 
 
     def interface(self, source_tensor, gl_tensor):
@@ -68,7 +97,8 @@ class RenderModel_Mini:
         Returns:
             warped_img: [batch, 3, 128, 128]
         '''
-        warped_img = self.net.interface(source_tensor, gl_tensor)
+        with torch.no_grad():
+            warped_img = self.net.interface(source_tensor, gl_tensor)
         return warped_img
 
     def save(self, path):
@@ -1,6 +1,7 @@
 from talkingface.utils import *
+from talkingface.batch_utils import transform_points
+from talkingface.keypoint_store import load_keypoints, keypoint_path
 import os
-import pickle
 import copy
 def Tensor2img(tensor_, channel_index):
     frame = tensor_[channel_index:channel_index + 3, :, :].detach().squeeze(0).cpu().float().numpy()
@@ -11,123 +12,98 @@ def Tensor2img(tensor_, channel_index):
 
 def correct_rotation_matrix(R):
     # Perform SVD on the 3x3 part of the matrix
+    # R可以是[3, 3]或批量[n, 3, 3]
     U, S, VT = np.linalg.svd(R, full_matrices=True)
 
     # Ensure the determinant is 1 to avoid reflection
     det = np.linalg.det(U @ VT)
-    if det < 0:
-        VT[-1, :] *= -1  # or U[:, -1] *= -1
-    scale_matrix = np.diag(S)
+    VT[..., -1, :] *= np.where(det < 0, -1, 1)[..., np.newaxis]  # or U[:, -1] *= -1
     # Combine scaling and rotation
-    scaled_rotation_matrix = U @ scale_matrix @ VT
-    # print("sssssssssssss", det)
+    scaled_rotation_matrix = (U * S[..., np.newaxis, :]) @ VT
     return scaled_rotation_matrix
 def mat_A(pts):
-    A = np.zeros([len(pts) * 3, 12])
-    for i in range(len(pts)):
-        A[3 * i + 0, 0:3] = pts[i]
-        A[3 * i + 0, 3] = 1
-        A[3 * i + 1, 4:7] = pts[i]
-        A[3 * i + 1, 7] = 1
-        A[3 * i + 2, 8:11] = pts[i]
-        A[3 * i + 2, 11] = 1
-    return A
-from sklearn import decomposition
+    # 仿射变换最小二乘的系数矩阵, 第3i+c行在第c块放[pts[i], 1]
+    A = np.zeros([len(pts), 3, 3, 4])
+    A[:, np.arange(3), np.arange(3), :3] = np.asarray(pts)[:, np.newaxis, :]
+    A[:, np.arange(3), np.arange(3), 3] = 1
+    return A.reshape(len(pts) * 3, 12)
+def _homogeneous(pts):
+    # [..., n, 3] -> [..., n, 4]
+    return np.concatenate([pts, np.ones(pts.shape[:-1] + (1,))], axis=-1)
+def _fit_face_mat(src_pinv, src_pts, tgt_pts):
+    '''
+    批量求解src->tgt的仿射变换, 修正旋转部分后按重心重新计算平移
+    mat_A(src)的行按坐标分块, pinv(mat_A(src)).dot(tgt.flatten())等价于pinv([src, 1]).dot(tgt)的转置,
+    因此只需对[n, 4]的齐次坐标求伪逆
+    Args:
+        src_pinv: [4, n] 或 [n_frames, 4, n], 齐次源关键点的伪逆
+        src_pts: [n, 3] 或 [n_frames, n, 3]
+        tgt_pts: [n_frames, n, 3]
+    Returns:
+        [n_frames, 4, 4]
+    '''
+    rotationMatrix = np.zeros([len(tgt_pts), 4, 4])
+    rotationMatrix[:, :3, :] = np.swapaxes(src_pinv @ tgt_pts, -1, -2)
+    rotationMatrix[:, 3, 3] = 1
+    # Correct the rotation part
+    corrected_R = correct_rotation_matrix(rotationMatrix[:, :3, :3])
+    centroid_src = np.mean(src_pts, axis=-2)
+    centroid_tgt = np.mean(tgt_pts, axis=-2)
+    # Step 4: Compute translation vector
+    T = centroid_tgt - (corrected_R @ centroid_src[..., np.newaxis])[..., 0]
+    rotationMatrix[:, :3, :3] = corrected_R
+    rotationMatrix[:, :3, 3] = T
+    return rotationMatrix
+def _normalize_pts(mat_list, pts_array_origin):
+    # 用各帧变换矩阵的逆把关键点变换回标准空间
+    return transform_points(np.linalg.inv(mat_list), pts_array_origin)
+def _pca_reconstruct(x, n_components, n_oversamples = 10, n_iter = 7, seed = 0):
+    '''
+    截断SVD代替sklearn PCA: 返回(x在前n_components个主成分上的重建, 均值)
+    样本较多时用固定种子的随机化SVD(与sklearn的randomized solver相同的幂迭代), 结果可复现
+    '''
+    mean = x.mean(axis=0)
+    xc = x - mean
+    if n_components == 0:
+        return np.repeat(mean[np.newaxis], len(x), axis=0), mean
+    n_random = n_components + n_oversamples
+    if n_random >= min(xc.shape):
+        _, _, VT = np.linalg.svd(xc, full_matrices=False)
+    else:
+        Q = xc @ np.random.RandomState(seed).normal(size=(xc.shape[1], n_random))
+        for _ in range(n_iter):
+            Q, _ = np.linalg.qr(xc @ np.linalg.qr(xc.T @ Q)[0])
+        _, _, VT = np.linalg.svd(Q.T @ xc, full_matrices=False)
+    VT = VT[:n_components]
+    return mean + (xc @ VT.T) @ VT, mean
 def calc_face_mat(pts_array_origin, face_pts_mean):
     '''
 
     :param pts_array_origin: mediapipe检测出的人脸关键点
     :return:
     '''
+    pts_array_origin = np.asarray(pts_array_origin, dtype=np.float64)
+    face_pts_mean = np.asarray(face_pts_mean, dtype=np.float64)
+    # 所有帧共用同一个源关键点, 只需一次伪逆
+    mat_list = _fit_face_mat(np.linalg.pinv(_homogeneous(face_pts_mean)), face_pts_mean, pts_array_origin)
+    pts_normalized_list = _normalize_pts(mat_list, pts_array_origin)
 
-    A = mat_A(face_pts_mean)
-    A_inverse = np.linalg.pinv(A)
-    pts_normalized_list = []
-    mat_list = []
-    for i in pts_array_origin:
-        B = i.flatten()
-        x = A_inverse.dot(B)
-        rotationMatrix = np.zeros([4, 4])
-        rotationMatrix[:3, :] = x.reshape(3, 4)
-        rotationMatrix[3, 3] = 1
-
-        R = rotationMatrix[:3, :3]
-        # Correct the rotation part
-        corrected_R = correct_rotation_matrix(R)
-
-        centroid_src = np.mean(face_pts_mean, axis=0)
-        centroid_tgt = np.mean(i, axis=0)
-
-        # Step 4: Compute translation vector
-        T = centroid_tgt - corrected_R @ centroid_src
-        rotationMatrix[:3, :3] = corrected_R
-        rotationMatrix[:3, 3] = T
-        mat_list.append(rotationMatrix)
-
-    for index_, i in enumerate(pts_array_origin):
-        rotationMatrix = mat_list[index_]
-        keypoints = np.ones([4, len(i)])
-        keypoints[:3, :] = i.T
-        keypoints_normalized = np.linalg.inv(rotationMatrix).dot(keypoints).T
-        pts_normalized_list.append(keypoints_normalized[:, :3])
-
-    x = np.array(pts_normalized_list).reshape(len(pts_normalized_list), -1)
-    # print(x.shape)
+    x = pts_normalized_list.reshape(len(pts_normalized_list), -1)
     n_components = min(25, len(pts_array_origin)//20)
-    pca = decomposition.PCA(n_components=n_components)
-    pca.fit(x)
-    y = pca.transform(x)
-    x_new = pca.inverse_transform(y)
+    x_new, pca_mean = _pca_reconstruct(x, n_components)
     x_new = x_new.reshape(len(x_new), -1, 3)
 
-    pts_normalized_list = []
-    mat_list = []
-    for index, x in enumerate(x_new):
-        A = mat_A(x)
-        A_inverse = np.linalg.pinv(A)
-
-        B = pts_array_origin[index].flatten()
-        x = A_inverse.dot(B)
-        rotationMatrix = np.zeros([4, 4])
-        rotationMatrix[:3, :] = x.reshape(3, 4)
-        rotationMatrix[3, 3] = 1
-        R = rotationMatrix[:3, :3]
-        # Correct the rotation part
-        corrected_R = correct_rotation_matrix(R)
-
-        centroid_src = np.mean(x_new[index], axis=0)
-        centroid_tgt = np.mean(pts_array_origin[index], axis=0)
-
-        # Step 4: Compute translation vector
-        T = centroid_tgt - corrected_R @ centroid_src
-        rotationMatrix[:3, :3] = corrected_R
-        rotationMatrix[:3, 3] = T
-
-        mat_list.append(rotationMatrix)
+    # 每帧以PCA重建的关键点为源, 批量求伪逆
+    mat_list = _fit_face_mat(np.linalg.pinv(_homogeneous(x_new)), x_new, pts_array_origin)
 
-    mat_list = np.array(mat_list)
     # mat_list必须要平滑，注意是针对每个视频分别平滑
-    sub_mat_list = mat_list
-    smooth_array_ = sub_mat_list.reshape(-1, 16)
-    import pandas as pd
-
+    smooth_array_ = mat_list.reshape(-1, 16)
     smooth_array_ = smooth_array(smooth_array_, weight = [0.03, 0.1, 0.74, 0.1, 0.03])
-    # pd.DataFrame(smooth_array_[200:400]).to_csv("sad.csv")
-    # exit(-1)
-    # print(smooth_array_, smooth_array_.shape)
-    smooth_array_ = smooth_array_.reshape(-1, 4, 4)
-    mat_list = smooth_array_
-    mat_list = [hh for hh in mat_list]
-
-    for index_,i in enumerate(pts_array_origin):
-        rotationMatrix = mat_list[index_]
-        keypoints = np.ones([4, len(i)])
-        keypoints[:3, :] = i.T
-        keypoints_normalized = np.linalg.inv(rotationMatrix).dot(keypoints).T
-        pts_normalized_list.append(keypoints_normalized[:,:3])
+    mat_list = smooth_array_.reshape(-1, 4, 4)
+    pts_normalized_list = _normalize_pts(mat_list, pts_array_origin)
 
-    face_pts_mean_personal = pca.mean_.reshape(-1, 3)
-    return mat_list,pts_normalized_list,face_pts_mean_personal
+    face_pts_mean_personal = pca_mean.reshape(-1, 3)
+    return list(mat_list), list(pts_normalized_list), face_pts_mean_personal
 face_pts_mean = None
 def video_pts_process(pts_array_origin):
     global face_pts_mean
@@ -148,14 +124,7 @@ def video_pts_process(pts_array_origin):
                                                               axis=0) + np.arange(0, 10)
     face_mask_pts_normalized[10, 1] = np.max(pts_normalized_list[:, INDEX_FACE_OVAL[10], 1], axis=0) + 25
 
-    face_mask_pts = np.zeros([len(mat_list), len(face_mask_pts_normalized), 2])
-    for index_ in range(len(mat_list)):
-        rotationMatrix = mat_list[index_]
-
-        keypoints = np.ones([4, len(face_mask_pts_normalized)])
-        keypoints[:3, :] = face_mask_pts_normalized.T
-        driving_mask = rotationMatrix.dot(keypoints).T
-        face_mask_pts[index_] = driving_mask[:,:2]
+    face_mask_pts = transform_points(np.array(mat_list), face_mask_pts_normalized)[:, :, :2]
 
     return mat_list, pts_normalized_list, face_pts_mean_personal, face_mask_pts
 
@@ -185,14 +154,7 @@ def mouth_replace(pts_array_origin, frames_num):
     face_pts_mean_personal[INDEX_FACE_OVAL[10], 1] = np.max(pts_normalized_list[:, INDEX_FACE_OVAL[10], 1], axis=0) + 25
 
     face_pts_mean_personal = face_pts_mean_personal[INDEX_FACE_OVAL]
-    face_mask_pts = np.zeros([len(mat_list), len(face_pts_mean_personal), 2])
-    for index_ in range(len(mat_list)):
-        rotationMatrix = mat_list[index_]
-
-        keypoints = np.ones([4, len(face_pts_mean_personal)])
-        keypoints[:3, :] = face_pts_mean_personal.T
-        driving_mask = rotationMatrix.dot(keypoints).T
-        face_mask_pts[index_] = driving_mask[:,:2]
+    face_mask_pts = transform_points(np.array(mat_list), face_pts_mean_personal)[:, :, :2]
 
     iteration = frames_num // len(pts_array_origin) + 1
     if iteration == 1:
@@ -251,8 +213,7 @@ def concat_output_2binfile(mat_list, pts_3d, face_pts_mean_personal, face_mask_p
     return output
 from talkingface.data.few_shot_dataset import select_ref_index,get_ref_images_fromVideo
 def prepare_video_data(video_path, Path_pkl, ref_img_index_list, ref_img = None,save_ref = None):
-    with open(Path_pkl, "rb") as f:
-        images_info = pickle.load(f)[:, main_keypoints_index, :]
+    images_info = load_keypoints(keypoint_path(Path_pkl))[:, main_keypoints_index, :]
 
     pts_driven = images_info.reshape(len(images_info), -1)
     pts_driven = smooth_array(pts_driven).reshape(len(pts_driven), -1, 3)
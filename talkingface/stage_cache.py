@@ -0,0 +1,210 @@
+'''
+训练预处理的阶段检查点
+
+每个阶段(关键点提取、web数据生成、webm预览)完成后把输出文件保存到检查点目录, 按
+(阶段名, 输入文件内容哈希, 阶段代码哈希, 参数)计算key。训练在后面的阶段失败(例如人脸范围超出视频)
+或服务重启后重新训练同一视频时, 已完成的阶段直接从检查点恢复, 不再重新计算。
+
+目录结构: <DH_STAGE_CACHE_DIR>/<key>/
+    stage.json   阶段名、输出文件列表, 最后写入, 存在即表示检查点完整
+    <输出文件>   与工作目录中的输出互为硬链接(不在同一文件系统时复制)
+超过DH_STAGE_CACHE_HOURS未使用的检查点在保存新检查点时清理; DH_STAGE_CACHE_DIR设为空字符串时不使用检查点
+
+Usage: python -m talkingface.stage_cache [<hours>]
+清理超过<hours>小时(默认DH_STAGE_CACHE_HOURS)未使用的检查点
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+
+STAGE_CACHE_DIR = os.getenv("DH_STAGE_CACHE_DIR", os.path.join(root_dir, "video_data", "_stages"))
+STAGE_CACHE_HOURS = float(os.getenv("DH_STAGE_CACHE_HOURS", 72))
+_MARKER = "stage.json"
+
+# 预处理各阶段影响输出的源码(及模型权重)和环境变量, 阶段检查点和上传去重(talkingface/upload_index.py)共用
+PREP_MINI_SOURCES = [os.path.join(root_dir, i) for i in [
+    "data_preparation_mini.py", "talkingface/keypoint_store.py", "talkingface/loop_segment.py"]]
+# DH_PREP_WORKERS/DH_FRAME_BUFFER_MB决定分段多进程还是单进程提取, 分段处跟踪器重新初始化, 关键点不完全相同
+PREP_MINI_ENV = ["DH_KEYFRAME_INTERVAL", "DH_KEYFRAME_MAX_ERROR", "DH_DETECT_MAX_SIDE", "DH_KEYPOINT_DTYPE",
+                 "DH_KEYPOINT_COMPRESSION", "DH_LOOP_SELECT", "DH_LOOP_MIN_SECONDS", "DH_LOOP_MAX_SEAM_SPEED",
+                 "DH_LOOP_MAX_POSE_STD", "DH_PREP_WORKERS", "DH_FRAME_BUFFER_MB"]
+PREP_WEB_SOURCES = [os.path.join(root_dir, i) for i in [
+    "data_preparation_web.py", "talkingface/avatar_data.py", "talkingface/batch_utils.py", "talkingface/utils.py",
+    "talkingface/run_utils.py", "talkingface/render_model_mini.py", "talkingface/ref_encoder.py",
+    "mini_live/obj/wrap_utils.py",
+    "checkpoint/DINet_mini/epoch_40.pth", "checkpoint/DINet_mini/epoch_40_infer.safetensors",
+    "checkpoint/DINet_mini/epoch_40_infer.pth"]]
+
+# 同一个上传视频会被多个阶段哈希, 按(路径, 大小, 修改时间)缓存结果
+_digest_cache = {}
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    st = os.stat(path)
+    cache_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if cache_key in _digest_cache:
+            return _digest_cache[cache_key]
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    with _digest_lock:
+        _digest_cache[cache_key] = sha256.hexdigest()
+    return sha256.hexdigest()
+
+
+def set_file_digest(path, digest):
+    '''
+    记录已知的文件哈希, 例如上传时边接收边计算的哈希, 之后file_digest不再重新读取文件
+    '''
+    st = os.stat(path)
+    with _digest_lock:
+        _digest_cache[(os.path.abspath(path), st.st_size, st.st_mtime_ns)] = digest
+
+
+def code_version(*paths):
+    '''
+    阶段用到的源码(及模型权重)的哈希, 代码修改后旧检查点自动失效
+    .py文件按内容计算, 其余文件(checkpoint等)只取大小和修改时间
+    '''
+    sha256 = hashlib.sha256()
+    for path in paths:
+        if path.endswith(".py"):
+            with open(path, "rb") as f:
+                sha256.update(f.read())
+        elif os.path.exists(path):
+            st = os.stat(path)
+            sha256.update("{}:{}:{}".format(os.path.basename(path), st.st_size, st.st_mtime_ns).encode("utf-8"))
+        sha256.update(b"\0")
+    return sha256.hexdigest()[:16]
+
+
+def env_values(names):
+    return {name: os.getenv(name, "") for name in names}
+
+
+def stage_key(name, *parts):
+    return hashlib.sha256(json.dumps([name] + list(parts), sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def _link(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def restore_stage(key, out_dir, cache_dir = None):
+    '''
+    检查点存在时把输出文件恢复到out_dir
+    Returns:
+        是否命中
+    '''
+    cache_dir = STAGE_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return False
+    stage_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(stage_dir, _MARKER), encoding="utf-8") as f:
+            files = json.load(f)["files"]
+        os.makedirs(out_dir, exist_ok=True)
+        for name in files:
+            _link(os.path.join(stage_dir, name), os.path.join(out_dir, name))
+    except (OSError, ValueError, KeyError):
+        return False
+    # 修改时间作为最近使用时间, 用于清理
+    os.utime(os.path.join(stage_dir, _MARKER))
+    return True
+
+
+def save_stage(key, name, out_dir, files, cache_dir = None):
+    '''
+    把out_dir中的输出文件保存为检查点, 有输出缺失时不保存
+    '''
+    cache_dir = STAGE_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir or not all(os.path.isfile(os.path.join(out_dir, i)) for i in files):
+        return False
+    stage_dir = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(stage_dir, _MARKER)):
+        return True
+    tmp_dir = "{}.tmp-{}-{}".format(stage_dir, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(tmp_dir)
+        for i in files:
+            _link(os.path.join(out_dir, i), os.path.join(tmp_dir, i))
+        with open(os.path.join(tmp_dir, _MARKER), "w", encoding="utf-8") as f:
+            json.dump({"name": name, "files": list(files), "created": time.time()}, f)
+        os.rename(tmp_dir, stage_dir)
+    except OSError as e:
+        # 检查点只用于加速, 保存失败(磁盘满、其他进程已保存)不影响训练
+        print("保存阶段检查点 {} 失败: {}".format(name, e))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    prune_stages(cache_dir=cache_dir)
+    return True
+
+
+def run_stage(name, key, out_dir, files, fn, *args):
+    '''
+    带检查点执行一个阶段: 命中时把输出恢复到out_dir并跳过fn, 否则执行fn后保存out_dir中的输出
+    Args:
+        files: 阶段输出, 相对out_dir的文件名
+    Returns:
+        命中检查点时为None, 否则为fn的返回值
+    '''
+    if restore_stage(key, out_dir):
+        print("阶段 {} 从检查点恢复: {}".format(name, key))
+        return None
+    result = fn(*args)
+    save_stage(key, name, out_dir, files)
+    return result
+
+
+def prune_stages(max_hours = None, cache_dir = None):
+    '''
+    删除超过max_hours未使用的检查点(以及中断遗留的临时目录)
+    Returns:
+        删除的数量
+    '''
+    cache_dir = STAGE_CACHE_DIR if cache_dir is None else cache_dir
+    max_hours = STAGE_CACHE_HOURS if max_hours is None else max_hours
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return 0
+    deadline = time.time() - max_hours * 3600
+    removed = 0
+    for name in os.listdir(cache_dir):
+        stage_dir = os.path.join(cache_dir, name)
+        marker = os.path.join(stage_dir, _MARKER) if ".tmp-" not in name else stage_dir
+        try:
+            if os.path.getmtime(marker) >= deadline:
+                continue
+        except OSError:
+            pass
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def main():
+    # 检查命令行参数的数量
+    if len(sys.argv) not in [1, 2]:
+        print("Usage: python -m talkingface.stage_cache [<hours>]")
+        sys.exit(1)  # 参数数量不正确时退出程序
+
+    max_hours = float(sys.argv[1]) if len(sys.argv) == 2 else STAGE_CACHE_HOURS
+    print("已清理 {} 个阶段检查点: {}".format(prune_stages(max_hours), STAGE_CACHE_DIR))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+'''
+训练流程的任务图: 按依赖关系把互不依赖的阶段(预处理、webm预览、缩略图、网页运行时构建)放到线程池并发执行
+各阶段主要耗时在ffmpeg/node子进程和mediapipe/torch的C++代码中, 线程即可并发
+
+用法:
+    graph = TaskGraph()
+    graph.add("prep_mini", data_preparation_mini, args=(video_path, video_dir_path, False))
+    graph.add("prep_web", data_preparation_web, args=(video_dir_path,), deps=["prep_mini"])
+    results = graph.run()
+deps只约束执行顺序; inputs中任务的返回值按顺序追加在args之后传入(inputs同时也是依赖)
+'''
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+TASK_WORKERS = int(os.getenv("DH_TASK_WORKERS", 4))
+
+
+class TaskGraph:
+    def __init__(self, max_workers = None):
+        self.max_workers = max_workers or TASK_WORKERS
+        self.tasks = {}
+        # 每个任务的(开始时间, 耗时), 相对run开始
+        self.timings = {}
+
+    def add(self, name, fn, args = (), deps = (), inputs = (), optional = False):
+        '''
+        Args:
+            deps: 依赖的任务名, 必须先add
+            inputs: 依赖的任务名, 其返回值追加在args之后传给fn
+            optional: 为True时失败只打印, 不影响其他任务, 返回值为None
+        '''
+        for dep in list(deps) + list(inputs):
+            if dep not in self.tasks:
+                raise ValueError("任务 {} 依赖的 {} 不存在".format(name, dep))
+        self.tasks[name] = {"fn": fn, "args": tuple(args), "deps": list(deps) + list(inputs), "inputs": list(inputs),
+                            "optional": optional}
+        return self
+
+    def _call(self, name, args, start):
+        task = self.tasks[name]
+        task_start = time.perf_counter()
+        try:
+            return task["fn"](*args)
+        except Exception as e:
+            if not task["optional"]:
+                raise
+            print("任务 {} 失败(可选, 忽略): {}".format(name, e))
+            return None
+        finally:
+            self.timings[name] = (task_start - start, time.perf_counter() - task_start)
+
+    def run(self):
+        '''
+        Returns:
+            {任务名: 返回值}; 必需任务失败时等待已开始的任务结束后抛出第一个异常, 未开始的任务不再执行
+        '''
+        start = time.perf_counter()
+        results, running, error = {}, {}, None
+        remaining = dict(self.tasks)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while remaining or running:
+                if error is None:
+                    for name in [i for i in remaining if all(dep in results for dep in remaining[i]["deps"])]:
+                        task = remaining.pop(name)
+                        args = task["args"] + tuple(results[dep] for dep in task["inputs"])
+                        running[executor.submit(self._call, name, args, start)] = name
+                else:
+                    remaining.clear()
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        error = error or e
+        self.timings["total"] = (0., time.perf_counter() - start)
+        if error is not None:
+            raise error
+        return results
+
+    def report(self):
+        '''
+        各阶段耗时, 例如 "prep_mini 0.0s+35.2s, webm 0.1s+12.3s, ... | total 41.0s"
+        '''
+        stages = sorted((i for i in self.timings.items() if i[0] != "total"), key=lambda x: x[1][0])
+        text = ", ".join("{} {:.1f}s+{:.1f}s".format(name, t0, t1) for name, (t0, t1) in stages)
+        if "total" in self.timings:
+            text += " | total {:.1f}s".format(self.timings["total"][1])
+        return text
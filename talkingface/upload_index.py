@@ -0,0 +1,92 @@
+'''
+上传视频去重
+
+同一视频(例如examples/example*.mp4)多次训练时, 预处理结果只与视频内容、预处理参数和预处理代码有关,
+与大模型身份信息、声音、是否开启视觉无关。训练完成后按(视频sha256, 参数, 预处理代码哈希)记录数字人id,
+再次上传相同视频时新建数字人目录(create_avatar_site写入新的config.js), assets和缩略图硬链接已有数字人的文件,
+不再执行预处理。
+
+索引: website/_uploads/<key>.json  {"id": 数字人id}
+已有数字人目录被删除或文件不完整时视为未命中, 重新训练后覆盖索引
+'''
+import os
+import json
+import shutil
+
+from talkingface.avatar_data import AVATAR_MANIFEST
+from talkingface.stage_cache import stage_key, code_version, env_values, \
+    PREP_MINI_SOURCES, PREP_MINI_ENV, PREP_WEB_SOURCES
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+
+WEBSITE_DIR = os.path.join(root_dir, "website")
+UPLOAD_INDEX_DIR = os.path.join(WEBSITE_DIR, "_uploads")
+# 决定预处理结果的源码和环境变量(与prep_mini、prep_web阶段检查点相同), 修改后不再复用旧数字人
+PREP_SOURCES = PREP_MINI_SOURCES + PREP_WEB_SOURCES
+PREP_ENV = PREP_MINI_ENV + ["DH_INFER_ENGINE", "DH_INFER_PRECISION"]
+# 除assets外需要复用的文件(app.py生成的缩略图)
+_SHARED_FILES = ["image/bg.jpg"]
+
+
+def upload_key(video_digest, *params):
+    '''
+    Args:
+        video_digest: 上传视频的sha256
+        params: 影响预处理结果的参数, 例如resize_option
+    '''
+    return stage_key("avatar", video_digest, list(params), code_version(*PREP_SOURCES), env_values(PREP_ENV))
+
+
+def _index_path(key, index_dir):
+    return os.path.join(index_dir, key + ".json")
+
+
+def find_avatar(key, website_dir = WEBSITE_DIR, index_dir = UPLOAD_INDEX_DIR):
+    '''
+    Returns:
+        已有的完整数字人目录, 没有时为None
+    '''
+    try:
+        with open(_index_path(key, index_dir), encoding="utf-8") as f:
+            site_dir = os.path.join(website_dir, json.load(f)["id"])
+        with open(os.path.join(site_dir, "assets", AVATAR_MANIFEST), encoding="utf-8") as f:
+            data_file = json.load(f)["data"]
+    except (OSError, ValueError, KeyError):
+        return None
+    if not os.path.isfile(os.path.join(site_dir, data_file)) or \
+            not os.path.isfile(os.path.join(site_dir, "assets", "01.mp4")):
+        return None
+    return site_dir
+
+
+def register_avatar(key, avatar_id, index_dir = UPLOAD_INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_path = _index_path(key, index_dir) + ".tmp-{}".format(os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"id": str(avatar_id)}, f)
+    os.replace(tmp_path, _index_path(key, index_dir))
+
+
+def _link(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def clone_avatar_assets(src_site_dir, dst_site_dir):
+    '''
+    把已有数字人的assets(视频、数据文件、manifest.json、example.webm)和缩略图链接到新数字人目录
+    dst_site_dir需要已由create_avatar_site创建
+    '''
+    src_assets = os.path.join(src_site_dir, "assets")
+    for name in os.listdir(src_assets):
+        if os.path.isfile(os.path.join(src_assets, name)):
+            _link(os.path.join(src_assets, name), os.path.join(dst_site_dir, "assets", name))
+    for name in _SHARED_FILES:
+        if os.path.isfile(os.path.join(src_site_dir, name)):
+            _link(os.path.join(src_site_dir, name), os.path.join(dst_site_dir, name))
+    return dst_site_dir
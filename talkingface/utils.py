@@ -252,53 +252,17 @@ def smooth_array(array, weight = [0.1,0.8,0.1], mode = "numpy"):
     '''
 
     Args:
-        array: [n_frames, n_values]， 需要转换为[n_values, 1, n_frames]
+        array: [n_frames, n_values]
         weight: Conv1d.weight, 一维卷积核权重
+        mode: numpy: 首尾帧保持原值, dtype与输入相同; torch: 首尾复制填充, 与原Conv1d实现一致返回squeeze后的float32,
+              均由batch_utils.smooth_frames向量化计算
     Returns:
         array: [n_frames, n_values]， 光滑后的array
     '''
+    from talkingface.batch_utils import smooth_frames
     if mode == "torch":
-        import torch
-        import torch.nn as nn
-        import torch.nn.functional as F
-        input = torch.Tensor(np.transpose(array[:, np.newaxis, :], (2, 1, 0)))
-        smooth_length = len(weight)
-        assert smooth_length % 2 == 1, "卷积核权重个数必须使用奇数"
-        pad = (smooth_length // 2, smooth_length // 2)  # 当pad只有两个参数时，仅改变最后一个维度, 左边扩充1列，右边扩充1列
-        input = F.pad(input, pad, "replicate")
-
-        with torch.no_grad():
-            conv1 = nn.Conv1d(in_channels=1, out_channels=1, kernel_size=smooth_length)
-            # 卷积核的元素值初始化
-            weight = torch.tensor(weight).view(1, 1, -1)
-            conv1.weight = torch.nn.Parameter(weight)
-            nn.init.constant_(conv1.bias, 0)  # 偏置值为0
-            # print(conv1.weight)
-            out = conv1(input)
-        return out.permute(2, 1, 0).squeeze().numpy()
-    else:
-        # out = np.zeros([array.shape[0] + 2, array.shape[1]])
-        # input = np.zeros([array.shape[0] + 2, array.shape[1]])
-        # input[0] = array[0]
-        # input[-1] = array[-1]
-        # input[1:-1] = array
-        # for i in range(out.shape[1]):
-        #     out[:, i] = np.convolve(input[:, i], weight, mode="same")
-        # out0 = out[1:-1]
-        smooth_length = len(weight)
-        assert smooth_length % 2 == 1, "卷积核权重个数必须使用奇数"
-        pad = smooth_length // 2
-        fliter = np.array([weight]).T
-        x0 = array
-        fliter = np.repeat(fliter, x0.shape[1], axis=1)
-        out0 = np.zeros_like(x0)
-        for i in range(len(x0)):
-            if i < pad or i >= len(x0) - pad:
-                out0[i] = x0[i]
-            else:
-                tmp = x0[i - pad:i + pad + 1] * fliter
-                out0[i] = np.sum(tmp, axis=0)
-        return out0
+        return smooth_frames(array, weight, edge = "replicate").squeeze()
+    return smooth_frames(array, weight, edge = "keep")
 
 def generate_face_mask():
     face_mask = np.zeros([256, 256], dtype=np.uint8)
@@ -0,0 +1,167 @@
+'''
+数字人网页的共享运行时
+
+web_source中与数字人无关的部分(混淆后的jsCode15、图标、404页面)只构建一次, 按内容哈希放在website/_runtime/<hash>/,
+每个数字人目录website/<id>/只包含:
+    index.html   脚本指向../_runtime/<hash>/jsCode15/
+    config.js    大模型身份信息、声音id、是否开启视觉(humanLogic.js读取window.avatarConfig)
+    assets/      01.mp4、数据文件、example.webm
+    image/       bg.jpg, 其余图标为共享运行时的硬链接
+web_source变化后哈希随之变化, 新训练的数字人使用新运行时, 旧数字人继续引用原来的目录
+混淆结果按脚本缓存在website/_runtime/_jscache/, web_source只改了部分脚本时只重新混淆这些脚本
+
+Usage: python -m talkingface.web_runtime [<web_source>] [<runtime_root>]
+预先构建共享运行时
+'''
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+
+WEB_SOURCE_DIR = os.path.join(root_dir, "web_source")
+RUNTIME_ROOT = os.path.join(root_dir, "website", "_runtime")
+JS_CACHE_DIR = "_jscache"
+_SCRIPT_PATTERN = re.compile(r'<script src="jsCode15/([\w.]+\.js)">')
+
+
+def _runtime_files(source_dir):
+    # 只打包index.html引用的脚本, logic_beifen.js等不再参与混淆
+    with open(os.path.join(source_dir, "index.html"), encoding="utf-8") as f:
+        scripts = _SCRIPT_PATTERN.findall(f.read())
+    files = ["index.html", "404.html", "test.js"] + ["js_source/" + i for i in scripts]
+    files += ["image/" + i for i in sorted(os.listdir(os.path.join(source_dir, "image")))]
+    return [i for i in files if os.path.isfile(os.path.join(source_dir, i))], scripts
+
+
+def runtime_hash(source_dir = WEB_SOURCE_DIR):
+    files, _ = _runtime_files(source_dir)
+    sha256 = hashlib.sha256()
+    for name in files:
+        sha256.update(name.encode("utf-8") + b"\0")
+        with open(os.path.join(source_dir, name), "rb") as f:
+            sha256.update(f.read())
+    return sha256.hexdigest()[:16]
+
+
+def _script_cache_key(options, code):
+    # 混淆配置(test.js)和源码都不变时混淆结果可以复用
+    return hashlib.sha256(options + b"\0" + code).hexdigest()[:32]
+
+
+def build_runtime(source_dir = WEB_SOURCE_DIR, runtime_root = RUNTIME_ROOT):
+    '''
+    构建共享运行时, 已存在时直接返回
+    每个脚本的混淆结果按(test.js, 源码)哈希缓存在website/_runtime/_jscache/, 只有变化的脚本才调用node重新混淆
+    Returns:
+        运行时目录website/_runtime/<hash>
+    '''
+    runtime_dir = os.path.join(runtime_root, runtime_hash(source_dir))
+    if os.path.isdir(runtime_dir):
+        return runtime_dir
+
+    files, scripts = _runtime_files(source_dir)
+    cache_dir = os.path.join(runtime_root, JS_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = "{}.tmp-{}".format(runtime_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    for name in files:
+        if name.startswith("js_source/"):
+            continue
+        os.makedirs(os.path.dirname(os.path.join(tmp_dir, name)), exist_ok=True)
+        shutil.copy(os.path.join(source_dir, name), os.path.join(tmp_dir, name))
+    os.makedirs(os.path.join(tmp_dir, "js_source"))
+    os.makedirs(os.path.join(tmp_dir, "jsCode15"))
+
+    with open(os.path.join(source_dir, "test.js"), "rb") as f:
+        options = f.read()
+    pending = []
+    for name in scripts:
+        with open(os.path.join(source_dir, "js_source", name), "rb") as f:
+            cache_path = os.path.join(cache_dir, _script_cache_key(options, f.read()) + ".js")
+        if os.path.isfile(cache_path):
+            shutil.copy(cache_path, os.path.join(tmp_dir, "jsCode15", name))
+        else:
+            shutil.copy(os.path.join(source_dir, "js_source", name), os.path.join(tmp_dir, "js_source", name))
+            pending.append((name, cache_path))
+
+    if pending:
+        print("混淆脚本: {}".format(", ".join(name for name, _ in pending)))
+        try:
+            subprocess.run(["node", os.path.join(tmp_dir, "test.js")], check=True, capture_output=True)
+        except Exception as e:
+            print(f"构建 jsCode15 失败: {e}")
+    plain = False
+    for name, cache_path in pending:
+        dst = os.path.join(tmp_dir, "jsCode15", name)
+        if os.path.exists(dst):
+            shutil.copy(dst, cache_path + ".tmp-{}".format(os.getpid()))
+            os.replace(cache_path + ".tmp-{}".format(os.getpid()), cache_path)
+        else:
+            # 混淆失败或node不可用时退化为直接复制 js_source, 不写入缓存
+            shutil.copy(os.path.join(tmp_dir, "js_source", name), dst)
+            plain = True
+    shutil.rmtree(os.path.join(tmp_dir, "js_source"))
+    os.remove(os.path.join(tmp_dir, "test.js"))
+    if plain:
+        # 未混淆的版本单独存放, 下次构建时重新尝试混淆
+        runtime_dir += "-plain"
+
+    try:
+        os.rename(tmp_dir, runtime_dir)
+    except OSError:
+        # 其他进程已构建完成
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return runtime_dir
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def create_avatar_site(website_dir, config, runtime_dir = None):
+    '''
+    创建数字人网页目录(不含assets中的视频和数据文件)
+    Args:
+        config: {"systemMessage": 大模型身份信息, "voiceType": 声音id, "isVLM": 是否开启视觉}
+        runtime_dir: 共享运行时目录, 默认按当前web_source构建
+    '''
+    runtime_dir = runtime_dir or build_runtime()
+    if os.path.exists(website_dir):
+        shutil.rmtree(website_dir)
+    os.makedirs(os.path.join(website_dir, "assets"))
+    os.makedirs(os.path.join(website_dir, "image"))
+
+    runtime_url = os.path.relpath(runtime_dir, website_dir).replace(os.sep, "/")
+    with open(os.path.join(runtime_dir, "index.html"), encoding="utf-8") as f:
+        index_html = f.read()
+    index_html = index_html.replace('<script src="jsCode15/humanLogic.js">',
+                                    '<script src="config.js"></script>\n  <script src="jsCode15/humanLogic.js">')
+    index_html = index_html.replace('src="jsCode15/', 'src="{}/jsCode15/'.format(runtime_url))
+    with open(os.path.join(website_dir, "index.html"), "w", encoding="utf-8") as f:
+        f.write(index_html)
+    with open(os.path.join(website_dir, "config.js"), "w", encoding="utf-8") as f:
+        f.write("var avatarConfig = {};\n".format(json.dumps(config, ensure_ascii=False)))
+
+    _link(os.path.join(runtime_dir, "404.html"), os.path.join(website_dir, "404.html"))
+    for name in os.listdir(os.path.join(runtime_dir, "image")):
+        _link(os.path.join(runtime_dir, "image", name), os.path.join(website_dir, "image", name))
+    return website_dir
+
+
+def main():
+    source_dir = sys.argv[1] if len(sys.argv) > 1 else WEB_SOURCE_DIR
+    runtime_root = sys.argv[2] if len(sys.argv) > 2 else RUNTIME_ROOT
+    print("共享运行时: {}".format(build_runtime(source_dir, runtime_root)))
+
+
+if __name__ == "__main__":
+    main()
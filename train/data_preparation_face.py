@@ -12,6 +12,7 @@ import glob
 import math
 import pickle
 from talkingface.util.smooth import smooth_array
+from talkingface.keypoint_store import save_keypoints, load_keypoints
 from talkingface.run_utils import calc_face_mat
 import tqdm
 from talkingface.utils import *
@@ -193,9 +194,8 @@ def run(video_path, export_imgs = True):
         out_size = 512
         scale = 512. / size
         pts_3d = (pts_3d - np.array([left_coincidence, top_coincidence, 0])) * scale
-        Path_output_pkl = "{}/keypoint_rotate.pkl".format(video_data_path)
-        with open(Path_output_pkl, "wb") as f:
-            pickle.dump(pts_3d, f)
+        save_keypoints("{}/keypoint_rotate.kps".format(video_data_path), pts_3d,
+                       {"width": out_size, "height": out_size, "frame_count": len(pts_3d)})
         os.makedirs("{}/image".format(video_data_path), exist_ok=True)
         ffmpeg_cmd = "ffmpeg -i {} -vf crop={}:{}:{}:{},scale=512:512:flags=neighbor -loglevel quiet -y {}/image/%06d.png".format(
             video_path,
@@ -211,10 +211,7 @@ def run(video_path, export_imgs = True):
     img_filelist = glob.glob("{}/image/*.png".format(video_data_path))
     img_filelist.sort()
 
-    Path_output_pkl = "{}/keypoint_rotate.pkl".format(video_data_path)
-
-    with open(Path_output_pkl, "rb") as f:
-        images_info = pickle.load(f)[:, main_keypoints_index, :]
+    images_info = load_keypoints("{}/keypoint_rotate.kps".format(video_data_path), mmap=True)[:, main_keypoints_index, :]
     pts_driven = images_info.reshape(len(images_info), -1)
     pts_driven = smooth_array(pts_driven).reshape(len(pts_driven), -1, 3)
 
@@ -0,0 +1,92 @@
+// 数字人数据文件(assets/data)的二进制格式解码, 格式见talkingface/avatar_data.py
+// 解码结果与旧的gzip JSON(combinedData)结构一致, 另外附带mesh(可直接送入WebGL的顶点和索引)
+
+const AVATAR_MAGIC = "DHAV";
+
+function isAvatarData(bytes) {
+    return bytes.length > 12 && String.fromCharCode(bytes[0], bytes[1], bytes[2], bytes[3]) === AVATAR_MAGIC;
+}
+
+// float16 -> float32, 直接拼float32的位(避免Math.pow)
+function halfToFloat32(half) {
+    const out = new Float32Array(half.length);
+    const bits = new Uint32Array(out.buffer);
+    for (let i = 0; i < half.length; i++) {
+        const h = half[i];
+        const s = (h & 0x8000) << 16;
+        const e = (h >> 10) & 0x1f;
+        const f = h & 0x03ff;
+        if (e === 0) {
+            out[i] = (s ? -1 : 1) * f * 5.960464477539063e-8; // 非规格化数: f * 2^-24
+        } else {
+            bits[i] = s | (e === 31 ? 0x7f800000 : (e + 112) << 23) | (f << 13);
+        }
+    }
+    return out;
+}
+
+function readSection(body, info) {
+    const count = info.shape.reduce((a, b) => a * b, 1);
+    const offset = body.byteOffset + info.offset;
+    switch (info.dtype) {
+        case "float32": return new Float32Array(body.buffer, offset, count);
+        case "float16": return halfToFloat32(new Uint16Array(body.buffer, offset, count));
+        case "int16": return new Int16Array(body.buffer, offset, count);
+        case "uint16": return new Uint16Array(body.buffer, offset, count);
+        default: throw new Error("不支持的数据类型: " + info.dtype);
+    }
+}
+
+function decodeAvatarData(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    const version = view.getUint32(4, true);
+    if (version !== 1) throw new Error("不支持的数据文件版本: " + version);
+    const headerLen = view.getUint32(8, true);
+    const header = JSON.parse(new TextDecoder().decode(bytes.subarray(12, 12 + headerLen)));
+    let body = bytes.subarray(12 + headerLen);
+    // 拷贝一份保证各数据段按元素大小对齐
+    body = header.compression === "zlib" ? pako.inflate(body) : body.slice();
+
+    const sections = header.sections;
+    const verts = readSection(body, sections.face_verts);
+    const faces = readSection(body, sections.face_faces);
+    const mats = readSection(body, sections.mats);
+    const rects = readSection(body, sections.rects);
+    const deltas = readSection(body, sections.points);
+
+    // 兼容旧格式的face3D_obj文本, wasm侧仍按文本读取
+    const face3D_obj = [];
+    for (let i = 0; i < verts.length; i += 5) {
+        face3D_obj.push("v " + verts[i].toFixed(3) + " " + verts[i + 1].toFixed(3) + " " + verts[i + 2].toFixed(3) + " " +
+            verts[i + 3].toFixed(2) + " " + verts[i + 4].toFixed(0) + "\n");
+    }
+    for (let i = 0; i < faces.length; i += 3) {
+        face3D_obj.push("f " + (faces[i] + 1) + " " + (faces[i + 1] + 1) + " " + (faces[i + 2] + 1) + "\n");
+    }
+
+    // points按帧差分存储, 逐帧累加还原
+    const frameNum = sections.points.shape[0];
+    const pointNum = sections.points.shape[1];
+    const scale = sections.points.scale;
+    const acc = new Int32Array(pointNum);
+    const json_data = [];
+    for (let f = 0; f < frameNum; f++) {
+        const points = new Float32Array(16 + pointNum);
+        points.set(mats.subarray(f * 16, f * 16 + 16));
+        for (let i = 0; i < pointNum; i++) {
+            acc[i] += deltas[f * pointNum + i];
+            points[16 + i] = acc[i] * scale;
+        }
+        json_data.push({ rect: Array.from(rects.subarray(f * 4, f * 4 + 4)), points: points });
+    }
+
+    return {
+        uid: header.uid,
+        frame_num: header.frame_num,
+        face3D_obj: face3D_obj,
+        ref_data: Array.from(readSection(body, sections.ref_data)),
+        json_data: json_data,
+        authorized: header.authorized,
+        mesh: { vertices: verts, faces: faces },
+    };
+}
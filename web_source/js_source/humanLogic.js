@@ -6,7 +6,7 @@ async function Initialized() {
 
 
 isCreateAudioFinish = false;
-isVLM = 是否开启视觉;
+isVLM = avatarConfig.isVLM; // 每个数字人的配置见config.js
  
 path = ".";
 const mp4url = path + '/assets/01.mp4';
@@ -372,8 +372,8 @@ let wsIsUsingPrimary = true;
 let wsHasTriedFallback = false;
 
 function handleOpen(event) {
-  const systemMessage = `大模型身份信息覆盖`;
-  const voiceType = "声音id信息覆盖"; 
+  const systemMessage = avatarConfig.systemMessage;
+  const voiceType = avatarConfig.voiceType;
 
   const data = {
     systemMessage: systemMessage,
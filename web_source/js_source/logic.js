@@ -71,13 +71,24 @@ class VideoProcessor {
     }
 
     async fetchVideoUtilData(data) {
-        let b = atob(data);
-        let compressedData = new Uint8Array(b.length);
-
-        for (let i = 0; i < b.length; i++) {
-            compressedData[i] = b.charCodeAt(i);
+        let compressedData;
+        if (data instanceof ArrayBuffer) {
+            compressedData = new Uint8Array(data);
+        } else {
+            // 旧版本把数据base64内联在logic.js中
+            let b = atob(data);
+            compressedData = new Uint8Array(b.length);
+
+            for (let i = 0; i < b.length; i++) {
+                compressedData[i] = b.charCodeAt(i);
+            }
         }
 
+        // 新的二进制格式(avatarData.js), 否则按旧的gzip JSON解析
+        if (isAvatarData(compressedData)) {
+            this.combinedData = decodeAvatarData(compressedData);
+            return;
+        }
         let decompressedData = pako.inflate(new Uint8Array(compressedData), { to: 'string' });
         this.combinedData = JSON.parse(decompressedData);
     }
@@ -276,7 +287,7 @@ function loadFaceFile(text) {
 
 
 function SetModule(module, combinedData) {
-    let { json_data, ...WasmInputJson } = combinedData;
+    let { json_data, mesh, ...WasmInputJson } = combinedData;
 
     let jsonString = JSON.stringify(WasmInputJson);
 
@@ -308,7 +319,7 @@ async function loadData() {
         dataSets = dataSets.concat(dataSets.slice().reverse());
 
         // 提取 objData
-        objData = loadFaceFile(videoProcessor.combinedData.face3D_obj.join('\n'));
+        objData = videoProcessor.combinedData.mesh || loadFaceFile(videoProcessor.combinedData.face3D_obj.join('\n'));
 
 
 
@@ -474,10 +485,20 @@ async function setupVBuffers() {
 }
 
 
+// 数据文件按内容哈希命名(assets/data.<hash>.bin), 由每次都校验的manifest.json指向, logic.js本身与数字人无关可长期缓存
+async function fetchAvatarData() {
+    let dataUrl = "assets/data";
+    const manifestResponse = await fetch("assets/manifest.json", { cache: "no-cache" });
+    if (manifestResponse.ok) {
+        dataUrl = (await manifestResponse.json()).data;
+    }
+    const response = await fetch(dataUrl);
+    if (!response.ok) throw new Error("数据文件加载失败: " + dataUrl);
+    return await response.arrayBuffer();
+}
+
 async function Init() {
-    //#region 
-    data = '数据文件需要替换的地方'
-    //#endregion
+    const data = await fetchAvatarData();
     await videoProcessor.init("assets/01.mp4", data);
     // 加载 combined_data.json.gz
     await loadData();